@@ -0,0 +1,209 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+STATE_PATH = os.path.join(ROOT, "data", "cache", "build_state.json")
+
+LINES = "data/stations/line20230824free.csv"
+JR_LINES = "data/stations/onlyJR_line20230824free.csv"
+STATIONS = "data/stations/station20230907free.csv"
+JR_STATIONS = "data/stations/JR_station20230907free.csv"
+STATION_GROUPS = "data/stations/station_groups.csv"
+HOTELS = "data/hotels/KNT_hotels.csv"
+NEAREST_STATION = "data/hotels/nearest_station.csv"
+HOTEL_ATTRIBUTES = "data/hotels/hotel_attributes.csv"
+HOTELS_SCORES = "data/hotels/hotels_scores.csv"
+STATION_SCORES = "data/hotels/station_scores.csv"
+
+
+def _run_module(module):
+    importlib.import_module(module)
+
+
+# a first build has no geocoding state: incremental geocoding then takes the curated coordinates
+# as they are and only fills the missing ones, so nothing runs when none are missing
+def _geocoding(changed):
+    geocoding_state = os.path.join(ROOT, "data", "cache", "geocoding_state.csv")
+    if not os.path.exists(geocoding_state):
+        import pandas as pd
+
+        hotels_df = pd.read_csv(os.path.join(ROOT, HOTELS), usecols=["latitude", "longitude"])
+        if not hotels_df.isnull().any(axis=1).any():
+            print("geocoding: no hotels without coordinates, skipped")
+            return
+    importlib.import_module("geocoding").main(incremental=True)
+
+
+def _station_groups(changed):
+    importlib.import_module("make_station_groups").main()
+
+
+def _nearest_station(changed):
+    # only the hotels whose coordinates changed are recomputed, unless the stations changed
+    importlib.import_module("find_nearest_station").main(
+        incremental=not changed & {STATIONS, LINES}
+    )
+
+
+def _hotels_scores(changed):
+    importlib.import_module("score_hotels").main()
+
+
+def _station_scores(changed):
+    importlib.import_module("station_scores").main()
+
+
+# stages in dependency order
+# each stage runs in its own directory, because the scripts use paths relative to it
+# run(changed) gets the set of inputs whose content changed since the stage last ran
+STAGES = [
+    {
+        "name": "jr_lines",
+        "directory": "loading/stations",
+        "inputs": [LINES],
+        "outputs": [JR_LINES],
+        "run": lambda changed: _run_module("make_JRline_data"),
+    },
+    {
+        "name": "jr_stations",
+        "directory": "loading/stations",
+        "inputs": [JR_LINES, STATIONS],
+        "outputs": [JR_STATIONS],
+        "run": lambda changed: _run_module("make_JRstations_data"),
+    },
+    {
+        # navitime_node_ids.csv is not an input: node ids learned at run time go to data/cache,
+        # and station_groups.load_station_groups reads both tables again at run time
+        "name": "station_groups",
+        "directory": "loading/stations",
+        "inputs": [STATIONS],
+        "outputs": [STATION_GROUPS],
+        "run": _station_groups,
+    },
+    {
+        "name": "geocoding",
+        "directory": "loading/hotels",
+        "inputs": [HOTELS],
+        "outputs": [HOTELS],
+        "run": _geocoding,
+    },
+    {
+        "name": "nearest_station",
+        "directory": "loading/hotels",
+        "inputs": [HOTELS, STATIONS, LINES],
+        "outputs": [NEAREST_STATION],
+        "run": _nearest_station,
+    },
+    {
+        "name": "hotels_scores",
+        "directory": "loading/hotels",
+        "inputs": [HOTELS, NEAREST_STATION, HOTEL_ATTRIBUTES],
+        "outputs": [HOTELS_SCORES],
+        "run": _hotels_scores,
+    },
+    {
+        "name": "station_scores",
+        "directory": "main",
+        "inputs": [NEAREST_STATION, HOTELS_SCORES],
+        "outputs": [STATION_SCORES],
+        "run": _station_scores,
+    },
+]
+
+
+def file_hash(path):
+    full_path = os.path.join(ROOT, path)
+    if not os.path.exists(full_path):
+        return None
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+# returns the inputs that changed since the stage last ran, or None if the stage is up to date
+# a stage whose outputs are missing or were edited by hand counts as having all inputs changed
+def changed_inputs(stage, state):
+    recorded = state.get(stage["name"])
+    if recorded is None:
+        return set(stage["inputs"])
+    for path in stage["outputs"]:
+        if path not in stage["inputs"] and file_hash(path) != recorded["outputs"].get(path):
+            return set(stage["inputs"])
+    changed = {
+        path for path in stage["inputs"] if file_hash(path) != recorded["inputs"].get(path)
+    }
+    return changed or None
+
+
+def run_stage(stage, changed):
+    directory = os.path.join(ROOT, stage["directory"])
+    cwd = os.getcwd()
+    sys.path.insert(0, directory)
+    os.chdir(directory)
+    try:
+        # scripts that do their work at import time have to be imported afresh
+        for module in list(sys.modules):
+            module_file = getattr(sys.modules[module], "__file__", None) or ""
+            if os.path.dirname(os.path.abspath(module_file)) == directory:
+                del sys.modules[module]
+        stage["run"](changed)
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(directory)
+
+
+# runs the stale stages in order and records the fingerprints of what they read and wrote
+def build(only=None, force=False, dry_run=False):
+    state = load_state()
+    for stage in STAGES:
+        if only and stage["name"] not in only:
+            continue
+        changed = set(stage["inputs"]) if force else changed_inputs(stage, state)
+        if changed is None:
+            print("{}: up to date".format(stage["name"]))
+            continue
+        print("{}: changed {}".format(stage["name"], ", ".join(sorted(changed))))
+        if dry_run:
+            continue
+
+        started = time.perf_counter()
+        run_stage(stage, changed)
+        state[stage["name"]] = {
+            "inputs": {path: file_hash(path) for path in stage["inputs"]},
+            "outputs": {path: file_hash(path) for path in stage["outputs"]},
+        }
+        save_state(state)
+        print("{}: done in {:.1f} s".format(stage["name"], time.perf_counter() - started))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rebuild the derived datasets that are out of date")
+    parser.add_argument("stages", nargs="*", help="stages to consider (default: all)")
+    parser.add_argument("--force", action="store_true", help="rebuild even if up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would run")
+    args = parser.parse_args()
+    build(only=args.stages, force=args.force, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from find_nearest_station import (
+    NEAREST_STATION_COLUMNS,
+    find_nearest_station,
+    find_nearest_stations_bulk,
+    load_stations,
+)
+
+
+# compares the per-hotel apply with the bulk pipeline on a sample of hotels
+# the per-hotel time is extrapolated to the full hotel list
+# run from the loading/hotels directory
+def main(sample_size=200, tolerance_m=1e-3):
+    hotels_df = pd.read_csv("../../data/hotels/KNT_hotels.csv")
+    station_df = load_stations()
+    sample_df = hotels_df.sample(
+        min(sample_size, len(hotels_df)), random_state=0
+    ).reset_index(drop=True)
+
+    start = time.perf_counter()
+    expected = pd.DataFrame(
+        sample_df.apply(
+            lambda row: find_nearest_station(
+                row["latitude"], row["longitude"], station_df
+            )
+            if not row[["latitude", "longitude"]].isnull().any()
+            else (None, None, None, None, None),
+            axis=1,
+        ).tolist(),
+        columns=NEAREST_STATION_COLUMNS,
+    )
+    apply_time = (time.perf_counter() - start) * len(hotels_df) / len(sample_df)
+
+    results = {}
+    for label, kwargs in [
+        ("bulk exact", dict(exact=True, workers=1)),
+        ("bulk haversine", dict(exact=False, workers=1)),
+        ("bulk exact, {} workers".format(os.cpu_count()), dict(exact=True, workers=os.cpu_count())),
+    ]:
+        start = time.perf_counter()
+        find_nearest_stations_bulk(hotels_df, station_df, **kwargs)
+        results[label] = time.perf_counter() - start
+
+    # checks the output stays identical within the tolerance on the sample
+    actual = find_nearest_stations_bulk(sample_df, station_df)
+    same_name = (
+        expected["nearest_station_name"].fillna("")
+        == actual["nearest_station_name"].fillna("")
+    )
+    distance_error = np.abs(
+        expected["distance"].fillna(0).to_numpy() - actual["distance"].fillna(0).to_numpy()
+    )
+
+    print("hotels: {}, stations: {}".format(len(hotels_df), len(station_df)))
+    print("per-hotel apply (extrapolated): {:.1f} s".format(apply_time))
+    for label, elapsed in results.items():
+        print("{}: {:.2f} s ({:.0f}x)".format(label, elapsed, apply_time / elapsed))
+    print("sample mismatched stations: {}".format((~same_name).sum()))
+    print(
+        "sample distances over {} m tolerance: {}".format(
+            tolerance_m, (distance_error > tolerance_m).sum()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
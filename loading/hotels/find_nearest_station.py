@@ -1,9 +1,37 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 from geopy.distance import geodesic
 
+# mean earth radius used by the haversine formula
+EARTH_RADIUS_M = 6371008.8
+# stations further than this many degrees in latitude or longitude are ignored
+SEARCH_BOX_DEG = 0.07
+# haversine differs from the WGS-84 geodesic by less than 0.6 %
+HAVERSINE_ERROR = 0.006
+
+STATIONS_PATH = "../../data/stations/station20230907free.csv"
+LINES_PATH = "../../data/stations/line20230824free.csv"
+# company_cd of the six JR passenger companies, as in make_JRline_data
+JR_COMPANY_CDS = range(1, 7)
+
+NEAREST_STATION_PATH = "../../data/hotels/nearest_station.csv"
+# hotel coordinates nearest_station.csv was last built from, for incremental updates
+BUILT_HOTELS_PATH = "../../data/cache/nearest_station_hotels.csv"
+
+NEAREST_STATION_COLUMNS = [
+    "nearest_station_name",
+    "nearest_station_latitude",
+    "nearest_station_longitude",
+    "distance",
+    "nearest_station_g_cd",
+]
+
 
 # finds nearest station from the given latitude and longitude
-# station_df: dataframe of stations that has columns "station_name", "latitude", "longitude"
+# station_df: dataframe of stations that has columns "station_name", "latitude", "longitude", "station_g_cd"
 def find_nearest_station(latitude, longitude, station_df):
     # calculates distance between two points
     # if the differece of latitude and longitude is more than or equal 0.07, skip the calculation and return 500000
@@ -19,47 +47,247 @@ def find_nearest_station(latitude, longitude, station_df):
     nearest_station_index = distances.idxmin()
     nearest_station = station_df.iloc[nearest_station_index]
     if distances[nearest_station_index] >= 500000:
-        return (None, None, None, None)
+        return (None, None, None, None, None)
 
     return (
         nearest_station["station_name"],
         nearest_station["latitude"],
         nearest_station["longitude"],
         distances[nearest_station_index],
+        nearest_station["station_g_cd"],
     )
 
 
-def main():
-    hotels_df = pd.read_csv("../../data/hotels/KNT_hotels.csv")
-    station_df = pd.read_csv("../../data/stations/JR_station20230907free.csv")
+# stations sorted by latitude, so the stations near a batch of hotels are one slice
+class StationIndex:
+    def __init__(self, station_df):
+        order = np.argsort(station_df["latitude"].to_numpy(), kind="stable")
+        self.positions = order
+        self.names = station_df["station_name"].to_numpy()[order]
+        self.g_cds = station_df["station_g_cd"].to_numpy()[order]
+        self.latitudes = station_df["latitude"].to_numpy(dtype=float)[order]
+        self.longitudes = station_df["longitude"].to_numpy(dtype=float)[order]
+
+    # returns the slice of stations whose latitude is within the search box of the batch
+    def band(self, min_latitude, max_latitude):
+        start = np.searchsorted(self.latitudes, min_latitude - SEARCH_BOX_DEG, "left")
+        end = np.searchsorted(self.latitudes, max_latitude + SEARCH_BOX_DEG, "right")
+        return slice(start, end)
+
+
+def haversine_matrix(latitudes, longitudes, station_latitudes, station_longitudes):
+    lat1 = np.radians(latitudes)[:, None]
+    lon1 = np.radians(longitudes)[:, None]
+    lat2 = np.radians(station_latitudes)[None, :]
+    lon2 = np.radians(station_longitudes)[None, :]
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# answers the k nearest stations for one batch of hotels and returns
+# a list of (station_name, latitude, longitude, distance, station_g_cd) tuples
+# if exact is True, the top k candidates are re-ranked with geopy's geodesic,
+# together with any station close enough that the haversine error could change the order
+def _nearest_stations_batch(index, latitudes, longitudes, k, exact):
+    results = [(None, None, None, None, None)] * len(latitudes)
+    band = index.band(latitudes.min(), latitudes.max())
+    station_latitudes = index.latitudes[band]
+    station_longitudes = index.longitudes[band]
+    if len(station_latitudes) == 0:
+        return results
+
+    distances = haversine_matrix(
+        latitudes, longitudes, station_latitudes, station_longitudes
+    )
+    outside = (
+        np.abs(latitudes[:, None] - station_latitudes[None, :]) >= SEARCH_BOX_DEG
+    ) | (np.abs(longitudes[:, None] - station_longitudes[None, :]) >= SEARCH_BOX_DEG)
+    distances[outside] = np.inf
+
+    k = min(k, distances.shape[1])
+    top_k = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    nearest = distances.min(axis=1)
+    for i, candidates in enumerate(top_k):
+        if not np.isfinite(nearest[i]):
+            continue
+        candidates = candidates[np.isfinite(distances[i, candidates])]
+        if exact:
+            close = np.flatnonzero(
+                distances[i] <= nearest[i] * (1 + 2 * HAVERSINE_ERROR)
+            )
+            candidates = np.union1d(candidates, close)
+            candidate_distances = np.array(
+                [
+                    geodesic(
+                        (latitudes[i], longitudes[i]),
+                        (station_latitudes[c], station_longitudes[c]),
+                    ).m
+                    for c in candidates
+                ]
+            )
+        else:
+            candidate_distances = distances[i, candidates]
+        # ties go to the station that comes first in the original csv
+        original = index.positions[band][candidates]
+        best = np.lexsort((original, candidate_distances))[0]
+        station = band.start + candidates[best]
+        results[i] = (
+            index.names[station],
+            index.latitudes[station],
+            index.longitudes[station],
+            candidate_distances[best],
+            index.g_cds[station],
+        )
+    return results
+
+
+# worker state for the process pool, so the index is only sent once per process
+_worker_index = None
+
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def _run_worker_batch(args):
+    latitudes, longitudes, k, exact = args
+    return _nearest_stations_batch(_worker_index, latitudes, longitudes, k, exact)
+
+
+# finds nearest stations for all hotels at once
+# hotels are sorted by latitude and processed in batches against the stations in the same latitude band
+# returns a dataframe with the same columns as find_nearest_station's tuples, in the order of hotels_df
+def find_nearest_stations_bulk(
+    hotels_df, station_df, k=4, exact=True, batch_size=256, workers=1
+):
+    index = StationIndex(station_df)
+    latitudes = hotels_df["latitude"].to_numpy(dtype=float)
+    longitudes = hotels_df["longitude"].to_numpy(dtype=float)
+    valid = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+    valid = valid[np.argsort(latitudes[valid], kind="stable")]
+
+    batches = [valid[i : i + batch_size] for i in range(0, len(valid), batch_size)]
+    tasks = [(latitudes[b], longitudes[b], k, exact) for b in batches]
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(index,)
+        ) as executor:
+            batch_results = list(executor.map(_run_worker_batch, tasks))
+    else:
+        batch_results = [
+            _nearest_stations_batch(index, *task) for task in tasks
+        ]
+
+    results = [(None, None, None, None, None)] * len(hotels_df)
+    for batch, batch_result in zip(batches, batch_results):
+        for position, result in zip(batch, batch_result):
+            results[position] = result
+    return pd.DataFrame(results, columns=NEAREST_STATION_COLUMNS)
+
+
+# the JR stations, one row per distinct point of each physical station (station_g_cd and name)
+# the (station, line) rows of a station sharing a point are searched once; a station whose lines
+# stop at different points keeps each of them, so distances are measured to the nearest platform
+# JR lines are picked by company at query time instead of from the JR-only csvs
+def load_stations():
+    station_df = pd.read_csv(STATIONS_PATH)
+    line_df = pd.read_csv(LINES_PATH)
+    jr_line_cds = line_df[line_df["company_cd"].isin(JR_COMPANY_CDS)]["line_cd"]
+    station_df = station_df[station_df["line_cd"].isin(jr_line_cds)]
+    station_df = station_df.drop_duplicates(["station_g_cd", "station_name", "lat", "lon"])
+    station_df = station_df.reset_index(drop=True)
 
     new_station_df = pd.DataFrame()
     new_station_df["station_name"] = station_df["station_name"]
     new_station_df["latitude"] = station_df["lat"]
     new_station_df["longitude"] = station_df["lon"]
+    new_station_df["station_g_cd"] = station_df["station_g_cd"]
+    return new_station_df
 
-    nearest_station_tupple = hotels_df.apply(
-        lambda row: find_nearest_station(
-            row["latitude"], row["longitude"], new_station_df
-        )
-        if not row[["latitude", "longitude"]].isnull().any()
-        else (None, None, None, None),
-        axis=1,
-    )
 
-    nearest_station_df = pd.DataFrame(
-        nearest_station_tupple.tolist(),
-        columns=[
-            "nearest_station_name",
-            "nearest_station_latitude",
-            "nearest_station_longitude",
-            "distance",
-        ],
+# recomputes only the hotels that are new or whose coordinates changed since previous_hotels_df
+# previous_nearest_df is the nearest_station.csv built from previous_hotels_df with the same stations
+def update_nearest_stations(
+    hotels_df, station_df, previous_nearest_df, previous_hotels_df, workers=1
+):
+    previous_df = previous_hotels_df[["hotelcode", "latitude", "longitude"]].merge(
+        previous_nearest_df[["hotelcode"] + NEAREST_STATION_COLUMNS], on="hotelcode"
+    ).drop_duplicates("hotelcode")
+    merged_df = hotels_df[["hotelcode", "latitude", "longitude"]].merge(
+        previous_df, on="hotelcode", how="left", suffixes=("", "_previous")
     )
+    unchanged = merged_df["hotelcode"].isin(previous_df["hotelcode"])
+    for column in ("latitude", "longitude"):
+        unchanged &= (merged_df[column] == merged_df[column + "_previous"]) | (
+            merged_df[column].isnull() & merged_df[column + "_previous"].isnull()
+        )
+
+    nearest_station_df = merged_df[NEAREST_STATION_COLUMNS].astype(object)
+    changed = ~unchanged.to_numpy()
+    if changed.any():
+        recomputed_df = find_nearest_stations_bulk(
+            hotels_df[changed], station_df, workers=workers
+        )
+        nearest_station_df.loc[changed, NEAREST_STATION_COLUMNS] = recomputed_df.to_numpy()
+    print("nearest stations recomputed for {} of {} hotels".format(changed.sum(), len(hotels_df)))
+    return nearest_station_df
+
+
+def main(bulk=True, workers=os.cpu_count(), incremental=False):
+    hotels_df = pd.read_csv("../../data/hotels/KNT_hotels.csv")
+    new_station_df = load_stations()
+
+    previous_nearest_df = None
+    if incremental and os.path.exists(NEAREST_STATION_PATH) and os.path.exists(BUILT_HOTELS_PATH):
+        previous_nearest_df = pd.read_csv(NEAREST_STATION_PATH)
+        # files built before the station groups have to be rebuilt in full
+        if "nearest_station_g_cd" not in previous_nearest_df.columns:
+            previous_nearest_df = None
+
+    if previous_nearest_df is not None:
+        nearest_station_df = update_nearest_stations(
+            hotels_df,
+            new_station_df,
+            previous_nearest_df,
+            pd.read_csv(BUILT_HOTELS_PATH),
+            workers=workers,
+        )
+    elif bulk:
+        nearest_station_df = find_nearest_stations_bulk(
+            hotels_df, new_station_df, workers=workers
+        )
+    else:
+        nearest_station_tupple = hotels_df.apply(
+            lambda row: find_nearest_station(
+                row["latitude"], row["longitude"], new_station_df
+            )
+            if not row[["latitude", "longitude"]].isnull().any()
+            else (None, None, None, None, None),
+            axis=1,
+        )
+
+        nearest_station_df = pd.DataFrame(
+            nearest_station_tupple.tolist(), columns=NEAREST_STATION_COLUMNS
+        )
+    nearest_station_df["nearest_station_g_cd"] = pd.to_numeric(
+        nearest_station_df["nearest_station_g_cd"]
+    ).astype("Int64")
     nearest_station_df["hotelcode"] = hotels_df["hotelcode"]
     nearest_station_df["hotelname"] = hotels_df["name"]
+    # new columns go last, so readers of the original layout are unaffected
+    nearest_station_df = nearest_station_df[
+        [column for column in nearest_station_df.columns if column != "nearest_station_g_cd"]
+        + ["nearest_station_g_cd"]
+    ]
+
+    nearest_station_df.to_csv(NEAREST_STATION_PATH, index=False)
 
-    nearest_station_df.to_csv("../../data/hotels/nearest_station.csv", index=False)
+    os.makedirs(os.path.dirname(BUILT_HOTELS_PATH), exist_ok=True)
+    hotels_df[["hotelcode", "latitude", "longitude"]].to_csv(BUILT_HOTELS_PATH, index=False)
 
 
 if __name__ == "__main__":
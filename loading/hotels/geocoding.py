@@ -1,18 +1,34 @@
+import csv
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
-import urllib
 import requests
 from geopy.geocoders import GoogleV3
 
+GSI_URL = "https://msearch.gsi.go.jp/address-search/AddressSearch"
+
+CACHE_PATH = "../../data/cache/geocode_cache.sqlite"
+CHECKPOINT_PATH = "../../data/cache/geocoding_checkpoint.csv"
+STATE_PATH = "../../data/cache/geocoding_state.csv"
+
 
 # gets latitude and longitude from address using GSI API
-def get_coordinates_GSI(address):
-    make_url = "https://msearch.gsi.go.jp/address-search/AddressSearch?q="
+def get_coordinates_GSI(address, base_url=GSI_URL, session=requests):
     s_quote = urllib.parse.quote(address)
-    response = requests.get(make_url + s_quote)
-    return (
-        response.json()[0]["geometry"]["coordinates"][1],
-        response.json()[0]["geometry"]["coordinates"][0],
-    )
+    response = session.get(base_url + "?q=" + s_quote, timeout=10)
+    response.raise_for_status()
+    results = response.json()
+    if not results:
+        return None, None
+    coordinates = results[0]["geometry"]["coordinates"]
+    return coordinates[1], coordinates[0]
 
 
 # gets latitude and longitude from address using geopy with google maps API
@@ -28,24 +44,208 @@ def get_coordinates_geopy(place_name):
     return location.latitude, location.longitude
 
 
+# provider name -> (geocoding function, hotel column it is given, requests per second)
+PROVIDERS = {
+    "google": (get_coordinates_geopy, "name", 10.0),
+    "gsi": (get_coordinates_GSI, "address", 1.0),
+}
+
+
+def normalize_query(query):
+    return " ".join(unicodedata.normalize("NFKC", str(query)).split())
+
+
+# spaces out calls to one provider across all worker threads
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+# persistent (provider, normalized query) -> coordinates cache
+# misses (no result) are cached too, so they are not asked again
+class GeocodeCache:
+    def __init__(self, path=CACHE_PATH):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS geocodes ("
+            "provider TEXT, query TEXT, latitude REAL, longitude REAL, "
+            "PRIMARY KEY (provider, query))"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    # returns (latitude, longitude), (None, None) for a cached miss, or None when not cached
+    def get(self, provider, query):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT latitude, longitude FROM geocodes WHERE provider = ? AND query = ?",
+                (provider, normalize_query(query)),
+            ).fetchone()
+        return row
+
+    def put(self, provider, query, latitude, longitude):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+                (provider, normalize_query(query), latitude, longitude),
+            )
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+# hash of the columns a hotel's coordinates depend on
+def row_fingerprint(row):
+    text = "\t".join(normalize_query(row[column]) for column in ("name", "address"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _read_csv_dict(path, value_columns):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8", newline="") as f:
+        return {
+            row["hotelcode"]: tuple(row[column] for column in value_columns)
+            for row in csv.DictReader(f)
+        }
+
+
+# fills in missing hotel coordinates with a pool of worker threads
+# - every answer goes to the geocode cache, so a rerun never asks the same query twice
+# - finished rows are appended to checkpoint_path, so an interrupted run resumes where it stopped
+# - with incremental=True, rows whose name or address changed since the last run
+#   (recorded in state_path) are geocoded again even if they already have coordinates;
+#   without a state file there is nothing to compare with, so the current rows are taken as
+#   up to date and only rows missing coordinates are geocoded
+# returns a copy of hotels_df with the new coordinates
+def geocode_hotels(
+    hotels_df,
+    provider="google",
+    geocode=None,
+    workers=4,
+    requests_per_second=None,
+    cache=None,
+    checkpoint_path=CHECKPOINT_PATH,
+    state_path=STATE_PATH,
+    incremental=False,
+):
+    default_geocode, column, default_rate = PROVIDERS[provider]
+    geocode = geocode or default_geocode
+    limiter = RateLimiter(requests_per_second or default_rate)
+    hotels_df = hotels_df.copy()
+
+    fingerprints = hotels_df.apply(row_fingerprint, axis=1)
+    targets = hotels_df[["latitude", "longitude"]].isnull().any(axis=1)
+    if incremental and state_path is not None and os.path.exists(state_path):
+        previous = _read_csv_dict(state_path, ["fingerprint"])
+        targets |= fingerprints != hotels_df["hotelcode"].map(
+            lambda code: previous.get(code, (None,))[0]
+        )
+    elif incremental and state_path is not None:
+        _write_state(state_path, hotels_df["hotelcode"], fingerprints)
+
+    # rows finished by an interrupted run
+    done = _read_csv_dict(checkpoint_path, ["latitude", "longitude"])
+    for position in hotels_df.index[targets]:
+        code = hotels_df.at[position, "hotelcode"]
+        if code in done:
+            latitude, longitude = done[code]
+            hotels_df.loc[position, ["latitude", "longitude"]] = [
+                float(latitude) if latitude else None,
+                float(longitude) if longitude else None,
+            ]
+            targets[position] = False
+
+    def _geocode(position):
+        query = hotels_df.at[position, column]
+        if cache is not None:
+            cached = cache.get(provider, query)
+            if cached is not None:
+                return position, cached
+        limiter.wait()
+        latitude, longitude = geocode(query)
+        if cache is not None:
+            cache.put(provider, query, latitude, longitude)
+        return position, (latitude, longitude)
+
+    checkpoint = None
+    if checkpoint_path is not None:
+        folder = os.path.dirname(checkpoint_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        write_header = not os.path.exists(checkpoint_path)
+        checkpoint = open(checkpoint_path, "a", encoding="utf-8", newline="")
+        writer = csv.writer(checkpoint)
+        if write_header:
+            writer.writerow(["hotelcode", "latitude", "longitude"])
+
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_geocode, p) for p in hotels_df.index[targets]]
+            for future in as_completed(futures):
+                try:
+                    position, (latitude, longitude) = future.result()
+                except Exception as e:
+                    failures += 1
+                    print("geocoding failed: {}".format(e))
+                    continue
+                hotels_df.loc[position, ["latitude", "longitude"]] = [latitude, longitude]
+                if checkpoint is not None:
+                    writer.writerow([hotels_df.at[position, "hotelcode"], latitude, longitude])
+                    checkpoint.flush()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    # the run is complete only when nothing failed; otherwise the checkpoint is kept for the rerun
+    if failures == 0:
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        if state_path is not None:
+            _write_state(state_path, hotels_df["hotelcode"], fingerprints)
+    return hotels_df
+
+
+def _write_state(state_path, hotelcodes, fingerprints):
+    folder = os.path.dirname(state_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    pd.DataFrame({"hotelcode": hotelcodes, "fingerprint": fingerprints}).to_csv(
+        state_path, index=False
+    )
+
+
 def count_no_coordnate_hotels():
     hotels_df = pd.read_csv("data/hotels/KNT_hotels.csv")
     return hotels_df["latitude"].isnull().sum()
 
 
-def main():
+def main(provider="google", incremental=False):
     hotels_df = pd.read_csv("../../data/hotels/KNT_hotels.csv")
 
     # if latitude and longitude are not given, get them from address
-    hotels_coordinate_tupple = hotels_df[["name", "latitude", "longitude"]].apply(
-        lambda row: get_coordinates_geopy(row["name"])
-        if row.isnull().any()
-        else (row["latitude"], row["longitude"]),
-        axis=1,
-    )
-    hotels_df[["latitude", "longitude"]] = pd.DataFrame(
-        hotels_coordinate_tupple.tolist(), columns=["latitude", "longitude"]
-    )
+    cache = GeocodeCache()
+    try:
+        hotels_df = geocode_hotels(
+            hotels_df, provider=provider, cache=cache, incremental=incremental
+        )
+    finally:
+        cache.close()
 
     hotels_df.to_csv("../../data/hotels/KNT_hotels.csv", index=False)
 
@@ -54,15 +254,7 @@ def test():
     hotels_df = pd.read_csv("../../data/hotels/test_hotels.csv")
 
     # if latitude and longitude are not given, get them from address
-    hotels_coordinate_tupple = hotels_df[["name", "latitude", "longitude"]].apply(
-        lambda row: get_coordinates_geopy(row["name"])
-        if row.isnull().any()
-        else (row["latitude"], row["longitude"]),
-        axis=1,
-    )
-    hotels_df[["latitude", "longitude"]] = pd.DataFrame(
-        hotels_coordinate_tupple.tolist(), columns=["latitude", "longitude"]
-    )
+    hotels_df = geocode_hotels(hotels_df, checkpoint_path=None, state_path=None)
 
     hotels_df.to_csv("../../data/hotels/test_res_hotels.csv", index=False)
 
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+HOTELS_PATH = "../../data/hotels/KNT_hotels.csv"
+NEAREST_STATION_PATH = "../../data/hotels/nearest_station.csv"
+# per-hotel attributes the score is computed from, all columns optional:
+# base_score (editorial / popularity score), rating (0-5), review_count
+ATTRIBUTES_PATH = "../../data/hotels/hotel_attributes.csv"
+HOTELS_SCORES_PATH = "../../data/hotels/hotels_scores.csv"
+
+CHUNK_SIZE = 100_000
+
+# hotels within WALK_M of their nearest station get full credit for access,
+# beyond it the credit halves every HALF_DISTANCE_M, down to MIN_ACCESS
+WALK_M = 800
+HALF_DISTANCE_M = 1000
+MIN_ACCESS = 0.1
+# reviews a rating needs before it counts as much as the average rating
+RATING_PRIOR_REVIEWS = 20
+MAX_RATING = 5.0
+
+
+# station access factor in [MIN_ACCESS, 1] for distances in meters, NaN counts as far away
+def access_factor(distances):
+    distances = np.asarray(distances, dtype=float)
+    excess = np.clip(np.nan_to_num(distances, nan=np.inf) - WALK_M, 0, None)
+    return np.maximum(np.exp2(-excess / HALF_DISTANCE_M), MIN_ACCESS)
+
+
+# bayesian average of the ratings in [0, 1]: few reviews pull a rating toward prior_rating
+def rating_quality(ratings, review_counts, prior_rating):
+    ratings = np.asarray(ratings, dtype=float)
+    counts = np.nan_to_num(np.asarray(review_counts, dtype=float))
+    rated = ~np.isnan(ratings)
+    average = np.where(
+        rated,
+        (RATING_PRIOR_REVIEWS * prior_rating + counts * np.nan_to_num(ratings))
+        / (RATING_PRIOR_REVIEWS + np.where(rated, counts, 0)),
+        prior_rating,
+    )
+    return average / MAX_RATING
+
+
+# hotel score = base_score x rating quality x station access
+# a missing base_score counts as 1 and a missing rating as the average rating
+def compute_scores(hotelcodes, attributes_df, distances, prior_rating):
+    rows = attributes_df.index.get_indexer(hotelcodes)
+    known = rows >= 0
+
+    def _column(name):
+        values = np.full(len(hotelcodes), np.nan)
+        if name in attributes_df.columns:
+            values[known] = attributes_df[name].to_numpy(dtype=float)[rows[known]]
+        return values
+
+    base_scores = np.nan_to_num(_column("base_score"), nan=1.0)
+    if "rating" in attributes_df.columns:
+        quality = rating_quality(_column("rating"), _column("review_count"), prior_rating)
+    else:
+        quality = np.ones(len(hotelcodes))
+    return base_scores * quality * access_factor(distances)
+
+
+def _prior_rating(attributes_df):
+    if "rating" not in attributes_df.columns:
+        return MAX_RATING
+    ratings = attributes_df["rating"].to_numpy(dtype=float)
+    weights = attributes_df.get("review_count", pd.Series(1.0, index=attributes_df.index))
+    weights = np.nan_to_num(weights.to_numpy(dtype=float))
+    rated = ~np.isnan(ratings) & (weights > 0)
+    if not rated.any():
+        return MAX_RATING
+    return float(np.average(ratings[rated], weights=weights[rated]))
+
+
+# streams the hotel catalogue in chunks and writes hotelcode,score for every hotel
+# only the hotelcode columns of the catalogue and the per-hotel lookups are held in memory
+def score_hotels(
+    hotels_path=HOTELS_PATH,
+    nearest_station_path=NEAREST_STATION_PATH,
+    attributes_path=ATTRIBUTES_PATH,
+    hotels_scores_path=HOTELS_SCORES_PATH,
+    chunk_size=CHUNK_SIZE,
+):
+    if os.path.exists(attributes_path):
+        attributes_df = pd.read_csv(attributes_path).drop_duplicates("hotelcode")
+        attributes_df = attributes_df.set_index("hotelcode")
+    else:
+        attributes_df = pd.DataFrame(index=pd.Index([], name="hotelcode"))
+    distances = (
+        pd.read_csv(nearest_station_path, usecols=["hotelcode", "distance"])
+        .drop_duplicates("hotelcode")
+        .set_index("hotelcode")["distance"]
+    )
+    prior_rating = _prior_rating(attributes_df)
+
+    # written to a temporary file first, so the planner never reads a half-written table
+    temporary_path = hotels_scores_path + ".tmp"
+    count = 0
+    header = True
+    for chunk in pd.read_csv(hotels_path, usecols=["hotelcode"], chunksize=chunk_size):
+        hotelcodes = chunk["hotelcode"].to_numpy()
+        scores = compute_scores(
+            hotelcodes, attributes_df, distances.reindex(hotelcodes).to_numpy(), prior_rating
+        )
+        pd.DataFrame({"hotelcode": hotelcodes, "score": scores}).to_csv(
+            temporary_path, mode="w" if header else "a", header=header, index=False
+        )
+        header = False
+        count += len(hotelcodes)
+    if header:
+        pd.DataFrame(columns=["hotelcode", "score"]).to_csv(temporary_path, index=False)
+    os.replace(temporary_path, hotels_scores_path)
+    print("scored {} hotels".format(count))
+
+
+def main():
+    score_hotels()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import pandas as pd
+
+STATIONS_PATH = "../../data/stations/station20230907free.csv"
+NODE_IDS_PATH = "../../data/stations/navitime_node_ids.csv"
+STATION_GROUPS_PATH = "../../data/stations/station_groups.csv"
+
+
+# one row per physical station instead of one per (station, line)
+# a physical station is a station_g_cd group and a name: groups also join transfer stations
+# with their own names (e.g. 大阪 and 北新地), which stay separate stations
+# its coordinates are those of the group's own row (station_cd == station_g_cd) when it has the name,
+# otherwise of its first row; line_cds lists every line calling there, space separated
+def make_station_groups(station_df, node_ids_df):
+    station_df = station_df.assign(
+        own_row=station_df["station_cd"] == station_df["station_g_cd"]
+    ).sort_values(["own_row", "station_cd"], ascending=[False, True], kind="stable")
+    keys = ["station_g_cd", "station_name"]
+
+    groups_df = station_df.drop_duplicates(keys)[keys + ["pref_cd", "lat", "lon"]]
+    line_cds = (
+        station_df.sort_values("line_cd")
+        .groupby(keys)["line_cd"]
+        .agg(lambda values: " ".join(str(value) for value in values.unique()))
+        .rename("line_cds")
+    )
+    groups_df = groups_df.merge(line_cds, left_on=keys, right_index=True)
+    # a station is closed only when every line calling there is
+    groups_df = groups_df.merge(
+        station_df.groupby(keys)["e_status"].min(), left_on=keys, right_index=True
+    )
+    groups_df = groups_df.merge(
+        node_ids_df.drop_duplicates("station_name", keep="last"), on="station_name", how="left"
+    )
+    return groups_df.sort_values("station_g_cd", kind="stable").reset_index(drop=True)
+
+
+def main():
+    station_df = pd.read_csv(STATIONS_PATH)
+    node_ids_df = pd.read_csv(NODE_IDS_PATH, dtype={"node_id": str})
+    groups_df = make_station_groups(station_df, node_ids_df)
+    groups_df.to_csv(STATION_GROUPS_PATH, index=False)
+    print("{} stations in {} groups".format(len(station_df), len(groups_df)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_bundle
+import fake_navitime
+import navitime_client
+import plan_cache
+import route_cache
+import station_scores
+import stop_options
+import trip_planner
+
+sys.path.insert(0, "../loading/hotels")
+import find_nearest_station  # noqa: E402
+import score_hotels  # noqa: E402
+
+HOTELS_PATH = "../data/hotels/KNT_hotels.csv"
+STATIONS_PATH = "../data/stations/JR_station20230907free.csv"
+START_TIME = datetime.datetime(2026, 1, 1, 9, 0)
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99}
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# samples this process's resident memory while the block runs
+# peak_mb is how far it rose above where it started (worker processes are not counted)
+# tracemalloc would be exact, but it slows the geodesic refinement down several times
+class PeakMemory:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, _rss_mb())
+
+    def __enter__(self):
+        self._start = self._peak = _rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self._peak, _rss_mb()) - self._start
+        return False
+
+
+# runs function once and returns (its result, a result record of the stage)
+def _measure(stage, scale, items, function):
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        result, latencies = function()
+        seconds = time.perf_counter() - started
+    record = {
+        "stage": stage,
+        "scale": scale,
+        "items": items,
+        "seconds": seconds,
+        "throughput": items / seconds if seconds else None,
+        "peak_mb": memory.peak_mb,
+    }
+    record.update(_percentiles(latencies))
+    return result, record
+
+
+# returns copies of the hotels and their scores repeated scale times
+# copies get a suffixed hotel code and coordinates moved by up to jitter_deg
+def synthetic_hotels(hotels_df, hotels_scores_df, scale, jitter_deg=0.01, seed=0):
+    if scale == 1:
+        return hotels_df, hotels_scores_df
+    rng = np.random.default_rng(seed)
+    copies = []
+    for i in range(scale):
+        copy_df = hotels_df.copy()
+        if i:
+            copy_df["hotelcode"] = copy_df["hotelcode"] + "x{}".format(i)
+            for column in ("latitude", "longitude"):
+                copy_df[column] = copy_df[column] + rng.uniform(
+                    -jitter_deg, jitter_deg, len(copy_df)
+                )
+        copies.append(copy_df)
+    scaled_hotels_df = pd.concat(copies, ignore_index=True)
+    scores = dict(zip(hotels_scores_df["hotelcode"], hotels_scores_df["score"]))
+    scaled_scores_df = pd.DataFrame(
+        {
+            "hotelcode": scaled_hotels_df["hotelcode"],
+            "score": [scores.get(code.split("x")[0], 0.0) for code in scaled_hotels_df["hotelcode"]],
+        }
+    )
+    return scaled_hotels_df, scaled_scores_df
+
+
+# one row per distinct point of each physical station, as find_nearest_station.load_stations
+def load_stations():
+    station_df = pd.read_csv(STATIONS_PATH)
+    station_df = station_df.drop_duplicates(["station_g_cd", "station_name", "lat", "lon"])
+    return pd.DataFrame(
+        {
+            "station_name": station_df["station_name"],
+            "latitude": station_df["lat"],
+            "longitude": station_df["lon"],
+            "station_g_cd": station_df["station_g_cd"],
+        }
+    )
+
+
+# points the planner at another hotel set by compiling it into a bundle in bundle_dir
+# use_bundle drops the station index and hotel search built over the previous set, and the
+# plan cache is replaced by an empty in-memory one, as its entries were planned with the
+# previous hotels; station_groups stays, as physical stations do not depend on the hotels
+def _use_hotels(planner, bundle_dir, nearest_station_df, hotels_scores_df, station_scores_df, hotels_df):
+    data_bundle.compile_frames(
+        nearest_station_df, hotels_scores_df, station_scores_df, hotels_df, bundle_dir
+    )
+    planner.use_bundle(data_bundle.DataBundle(bundle_dir))
+    planner.plan_cache = plan_cache.PlanCache()
+
+
+# (start name, goal name, start_time) requests along the recorded routes
+def planning_requests(fake, count):
+    goal_names = {}
+    start_names = []
+    for route in fake.routes:
+        goal = route["sections"][-1]
+        goal_names[goal["node_id"]] = goal["name"]
+        for section in route["sections"][:-1]:
+            stations = [section] if section.get("type") == "point" else (
+                section.get("transport", {}).get("calling_at", [])
+            )
+            for station in stations:
+                if station.get("name") in fake.node_ids and station["name"] not in start_names:
+                    start_names.append(station["name"])
+    goal_name = next(iter(goal_names.values()))
+    start_names = [name for name in start_names if name != goal_name]
+    return [
+        (
+            start_names[i % len(start_names)],
+            goal_name,
+            START_TIME + datetime.timedelta(minutes=5 * (i % 12)),
+        )
+        for i in range(count)
+    ]
+
+
+# plans every request on one client and returns (daily stop options per request, seconds per request)
+async def _plan(requests, client, cache, max_concurrency, max_travel_time, **lister_options):
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _one(start, goal, start_time):
+        async with semaphore:
+            started = time.perf_counter()
+            lister = await stop_options.StopOptionsLister.create(
+                start,
+                goal,
+                start_time,
+                max_travel_time=max_travel_time,
+                route_cache=cache,
+                client=client,
+                **lister_options
+            )
+            result = await lister.list_stop_stations()
+            return result, time.perf_counter() - started
+
+    results = await asyncio.gather(*(_one(*request) for request in requests))
+    return [result for result, _ in results], [seconds for _, seconds in results]
+
+
+# lister_options: e.g. the local router (see router_options)
+def bench_planning(planner, server, requests, scale, max_concurrency, max_travel_time, **lister_options):
+    records = []
+
+    async def _run():
+        client = navitime_client.AsyncNavitimeClient(
+            max_concurrency=max_concurrency,
+            requests_per_second=1000.0,
+            **server.client_urls(),
+        )
+        cache = route_cache.RouteCache()
+        try:
+            # the second pass is answered from the warm route cache
+            for stage in ("planning (cold cache)", "planning (warm cache)"):
+                server.fake.request_count = 0
+                with PeakMemory() as memory:
+                    started = time.perf_counter()
+                    trips, latencies = await _plan(
+                        requests, client, cache, max_concurrency, max_travel_time, **lister_options
+                    )
+                    scoring_started = time.perf_counter()
+                    planner.get_best_stations_batch(trips)
+                    scoring_seconds = time.perf_counter() - scoring_started
+                    seconds = time.perf_counter() - started
+                record = {
+                    "stage": stage,
+                    "scale": scale,
+                    "items": len(requests),
+                    "seconds": seconds,
+                    "throughput": len(requests) / seconds,
+                    "peak_mb": memory.peak_mb,
+                    "api_requests": server.fake.request_count,
+                    "nights": sum(len(trip) for trip in trips),
+                    "scoring_seconds": scoring_seconds,
+                }
+                record.update(_percentiles(latencies))
+                records.append(record)
+        finally:
+            await client.close()
+
+    asyncio.run(_run())
+    return records
+
+
+def bench_scale(planner, server, hotels_df, hotels_scores_df, station_df, scale, args, bundle_dir):
+    records = []
+    scaled_hotels_df, scaled_scores_df = synthetic_hotels(hotels_df, hotels_scores_df, scale)
+
+    # loading/: the nearest station builder
+    nearest_df, record = _measure(
+        "nearest_station build",
+        scale,
+        len(scaled_hotels_df),
+        lambda: (
+            find_nearest_station.find_nearest_stations_bulk(
+                scaled_hotels_df, station_df, workers=args.workers
+            ),
+            [],
+        ),
+    )
+    records.append(record)
+    nearest_df.insert(len(nearest_df.columns), "hotelcode", scaled_hotels_df["hotelcode"])
+
+    # hotel scoring: per-hotel scores from their attributes, then the station score table
+    attributes_df = scaled_scores_df.rename(columns={"score": "base_score"}).set_index("hotelcode")
+    _, record = _measure(
+        "hotel scores",
+        scale,
+        len(scaled_hotels_df),
+        lambda: (
+            score_hotels.compute_scores(
+                scaled_hotels_df["hotelcode"].to_numpy(),
+                attributes_df,
+                nearest_df["distance"].to_numpy(dtype=float),
+                score_hotels.MAX_RATING,
+            ),
+            [],
+        ),
+    )
+    records.append(record)
+
+    station_scores_df, record = _measure(
+        "station scores",
+        scale,
+        len(scaled_hotels_df),
+        lambda: (station_scores.compute_station_scores(nearest_df, scaled_scores_df), []),
+    )
+    records.append(record)
+
+    # per-station lookups, including the radius fallback for unknown names
+    stations = list(station_scores_df["station_name"][: args.lookups])
+    coordinates = nearest_df.drop_duplicates("nearest_station_name").set_index(
+        "nearest_station_name"
+    )
+
+    def _lookups():
+        latencies = []
+        for name in stations:
+            latitude = coordinates.at[name, "nearest_station_latitude"]
+            longitude = coordinates.at[name, "nearest_station_longitude"]
+            for lookup_name in (name, name + "?"):
+                started = time.perf_counter()
+                planner.get_station_score(lookup_name, latitude, longitude)
+                latencies.append(time.perf_counter() - started)
+        return None, latencies
+
+    _use_hotels(planner, bundle_dir, nearest_df, scaled_scores_df, station_scores_df, scaled_hotels_df)
+    _, record = _measure("station score lookups", scale, 2 * len(stations), _lookups)
+    records.append(record)
+
+    requests = planning_requests(server.fake, args.requests)
+    records += bench_planning(
+        planner,
+        server,
+        requests,
+        scale,
+        args.concurrency,
+        args.max_travel_time,
+        **router_options(planner, args)
+    )
+    return records
+
+
+# StopOptionsLister options of --local-router, --offline and --speculative, as TripPlanner passes them
+def router_options(planner, args):
+    if not (args.local_router or args.offline):
+        return {"speculative": args.speculative} if args.speculative else {}
+    return {
+        "local_router": planner.rail_graph(),
+        "speculative": max(args.speculative, 1 if args.local_router else 0),
+        "offline": args.offline,
+    }
+
+
+def print_records(records):
+    print(
+        "{:<24} {:>5} {:>8} {:>9} {:>11} {:>9} {:>9} {:>9} {:>8}".format(
+            "stage", "scale", "items", "seconds", "items/s", "p50 ms", "p95 ms", "p99 ms", "+MB"
+        )
+    )
+    for record in records:
+        latencies = [
+            "{:.2f}".format(record[p] * 1000) if record[p] is not None else "-"
+            for p in ("p50", "p95", "p99")
+        ]
+        print(
+            "{:<24} {:>5} {:>8} {:>9.3f} {:>11.1f} {:>9} {:>9} {:>9} {:>8.1f}".format(
+                record["stage"],
+                record["scale"],
+                record["items"],
+                record["seconds"],
+                record["throughput"],
+                *latencies,
+                record["peak_mb"],
+            )
+        )
+    print(
+        "max rss: {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    )
+
+
+# returns the stages whose throughput fell more than tolerance below the baseline
+def regressions(records, baseline, tolerance):
+    previous = {(r["stage"], r["scale"]): r["throughput"] for r in baseline}
+    return [
+        (record["stage"], record["scale"], previous[record["stage"], record["scale"]], record["throughput"])
+        for record in records
+        if previous.get((record["stage"], record["scale"]))
+        and record["throughput"] < previous[record["stage"], record["scale"]] * (1 - tolerance)
+    ]
+
+
+# end-to-end benchmark of the builders, hotel scoring and planning against a fake NAVITIME
+# that replays test_results.json with the injected latency; run from the main directory
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the planning pipeline")
+    parser.add_argument("--scales", default="1,10,100", help="hotel set sizes (comma separated)")
+    parser.add_argument("--requests", type=int, default=50, help="trips planned per scale")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake api call")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--max-travel-time", type=int, default=180)
+    parser.add_argument("--lookups", type=int, default=200, help="stations for score lookups")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--local-router", action="store_true", help="plan with the offline JR graph predicting each day"
+    )
+    parser.add_argument(
+        "--offline", action="store_true", help="answer from the offline JR graph, confirmed by the fake api"
+    )
+    parser.add_argument(
+        "--speculative", type=int, default=0, help="next-day queries fired ahead for the top N stop options"
+    )
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--baseline", help="json results to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    hotels_df = pd.read_csv(HOTELS_PATH)
+    planner = trip_planner.TripPlanner()
+    hotels_scores_df = planner.bundle.hotels_scores_df()
+    station_df = load_stations()
+
+    records = []
+    with tempfile.TemporaryDirectory(prefix="bundle") as bundle_dir, fake_navitime.FakeNavitimeServer(
+        latency=args.latency, jitter=args.jitter
+    ) as server:
+        for scale in [int(s) for s in args.scales.split(",")]:
+            records += bench_scale(
+                planner, server, hotels_df, hotels_scores_df, station_df, scale, args, bundle_dir
+            )
+    print_records(records)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(records, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            slower = regressions(records, json.load(f), args.tolerance)
+        for stage, scale, before, after in slower:
+            print("regression: {} x{}: {:.1f} -> {:.1f} items/s".format(stage, scale, before, after))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
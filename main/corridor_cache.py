@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import instrumentation
+from data_bundle import StringTable
+
+CORRIDOR_DIR = "../data/corridors"
+# bumped whenever the layout of a build changes; builds of another version are ignored
+FORMAT_VERSION = 1
+# start times are matched to the minute bucket they fall in, as in route_cache
+TIME_BUCKET_MINUTES = 5
+# builds older than this are reported as stale
+STALE_AFTER_DAYS = 7
+
+
+def _bucket(start_time):
+    minute = start_time.minute - start_time.minute % TIME_BUCKET_MINUTES
+    return start_time.replace(minute=minute, second=0, microsecond=0)
+
+
+# one day of a trip: the stop options from start_node towards goal_node departing at start_time
+def segment_key(start_node, goal_node, start_time):
+    return "{}|{}|{}".format(
+        start_node, goal_node, _bucket(start_time).strftime("%Y-%m-%dT%H:%M")
+    )
+
+
+def _hash(keys):
+    return np.array(
+        [
+            int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+            for key in keys
+        ],
+        dtype=np.uint64,
+    )
+
+
+# the lister parameters a build was made with; segments only serve listers with the same ones
+def lister_params(max_travel_time, latest_stop_time, window_minutes):
+    return {
+        "max_travel_time": max_travel_time,
+        "latest_stop_time": latest_stop_time,
+        "window_minutes": window_minutes,
+    }
+
+
+# read-only view of the current corridor build
+# segments are found by binary search over memory-mapped key hashes, and only the matched
+# segment's json is decoded
+class CorridorCache:
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        with open(os.path.join(build_dir, "manifest.json"), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.hashes = self._array("hashes")
+        self.built_at = self._array("built_at")
+        self.keys = StringTable(self._array("keys.data"), self._array("keys.offsets"))
+        self.values = StringTable(self._array("values.data"), self._array("values.offsets"))
+
+    def _array(self, name):
+        return np.load(os.path.join(self.build_dir, name + ".npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.hashes)
+
+    # returns (stop options, terminal station) for the day, or None when it was not precomputed
+    def get(self, start_node, goal_node, start_time, max_travel_time, latest_stop_time, window_minutes):
+        if lister_params(max_travel_time, latest_stop_time, window_minutes) != self.manifest["params"]:
+            return None
+        key = segment_key(start_node, goal_node, start_time)
+        h = _hash([key])[0]
+        i = int(np.searchsorted(self.hashes, h))
+        while i < len(self.hashes) and self.hashes[i] == h:
+            if self.keys[i] == key:
+                instrumentation.count("corridor_cache.hits")
+                stop_options, terminal_station = json.loads(self.values[i])
+                return stop_options, terminal_station
+            i += 1
+        instrumentation.count("corridor_cache.misses")
+        return None
+
+
+def _current_path(corridor_dir):
+    return os.path.join(corridor_dir, "CURRENT")
+
+
+# returns the current CorridorCache, or None when nothing usable was built yet
+def load_corridor_cache(corridor_dir=CORRIDOR_DIR):
+    try:
+        with open(_current_path(corridor_dir), encoding="utf-8") as f:
+            build_dir = os.path.join(corridor_dir, f.read().strip())
+        cache = CorridorCache(build_dir)
+    except (OSError, ValueError, KeyError):
+        return None
+    if cache.manifest.get("format_version") != FORMAT_VERSION:
+        return None
+    return cache
+
+
+# writes segments {key: (stop options, terminal station, built at)} as a new build
+# and then points CURRENT at it, so readers never see a half-written build
+def write_build(segments, manifest, corridor_dir=CORRIDOR_DIR, keep=2):
+    build_id = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    build_dir = os.path.join(corridor_dir, build_id)
+    os.makedirs(build_dir, exist_ok=True)
+
+    keys = list(segments)
+    hashes = _hash(keys)
+    order = np.argsort(hashes, kind="stable")
+    keys = [keys[i] for i in order]
+    np.save(os.path.join(build_dir, "hashes.npy"), hashes[order])
+    np.save(
+        os.path.join(build_dir, "built_at.npy"),
+        np.array([segments[key][2] for key in keys], dtype=np.float64),
+    )
+    for name, strings in (
+        ("keys", keys),
+        ("values", [json.dumps(segments[key][:2], ensure_ascii=False) for key in keys]),
+    ):
+        data, offsets = StringTable.build(strings)
+        np.save(os.path.join(build_dir, name + ".data.npy"), data)
+        np.save(os.path.join(build_dir, name + ".offsets.npy"), offsets)
+
+    manifest = dict(manifest, format_version=FORMAT_VERSION, build_id=build_id, segments=len(keys))
+    with open(os.path.join(build_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    temporary_path = _current_path(corridor_dir) + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        f.write(build_id)
+    os.replace(temporary_path, _current_path(corridor_dir))
+
+    # older builds are removed, except the few most recent for readers still holding them
+    builds = sorted(
+        name for name in os.listdir(corridor_dir)
+        if os.path.isdir(os.path.join(corridor_dir, name))
+    )
+    for name in builds[:-keep]:
+        shutil.rmtree(os.path.join(corridor_dir, name), ignore_errors=True)
+    return build_dir
+
+
+def read_corridors(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return [
+            (row["start"], row["goal"]) for row in csv.DictReader(f) if row.get("start")
+        ]
+
+
+def date_range(first_date, last_date):
+    days = (last_date - first_date).days
+    return [first_date + datetime.timedelta(days=i) for i in range(days + 1)]
+
+
+# walks every corridor and departure day the way list_stop_stations does, one day at a time,
+# and stores each day's (stop options, terminal station), including the final day with none
+# segments of the current build that are not re-walked are carried over
+async def warm(
+    corridors,
+    dates,
+    departure_times=(datetime.time(9, 0),),
+    max_travel_time=60 * 6,
+    latest_stop_time=19,
+    window_minutes=40,
+    corridor_dir=CORRIDOR_DIR,
+    max_concurrency=8,
+    **lister_options,
+):
+    import navitime_client
+    import station_groups
+    import stop_options
+
+    params = lister_params(max_travel_time, latest_stop_time, window_minutes)
+    segments = {}
+    previous = load_corridor_cache(corridor_dir)
+    if previous is not None and previous.manifest["params"] != params:
+        previous = None
+    if previous is not None:
+        for i in range(len(previous)):
+            stop_options_list, terminal_station = json.loads(previous.values[i])
+            segments[previous.keys[i]] = (
+                stop_options_list, terminal_station, float(previous.built_at[i])
+            )
+
+    # the days are stored as the planner's listers would parse them, one stop per physical station
+    if "station_groups" not in lister_options:
+        lister_options["station_groups"] = station_groups.load_station_groups()
+    client = lister_options.pop("client", None)
+    owns_client = client is None
+    if owns_client:
+        client = navitime_client.AsyncNavitimeClient(max_concurrency=max_concurrency)
+    failures = []
+
+    async def _walk(start, goal, start_time):
+        lister = await stop_options.StopOptionsLister.create(
+            start,
+            goal,
+            start_time,
+            max_travel_time,
+            latest_stop_time,
+            window_minutes=window_minutes,
+            client=client,
+            **lister_options,
+        )
+        node, day_start = lister.start_station, start_time
+        seen = set()
+        while node not in seen:
+            seen.add(node)
+            stop_options_list, terminal_station = await lister.next_stop_stations(
+                node, lister.goal_station, day_start
+            )
+            key = segment_key(node, lister.goal_station, day_start)
+            segments[key] = (stop_options_list, terminal_station, time.time())
+            if not stop_options_list:
+                break
+            node = terminal_station
+            day_start = (day_start + datetime.timedelta(days=1)).replace(hour=9, minute=0, second=0)
+
+    async def _walk_safely(start, goal, start_time):
+        try:
+            await _walk(start, goal, start_time)
+        except Exception as e:
+            failures.append({"start": start, "goal": goal, "start_time": start_time.isoformat(), "error": str(e)})
+
+    try:
+        await asyncio.gather(
+            *(
+                _walk_safely(start, goal, datetime.datetime.combine(date, departure_time))
+                for start, goal in corridors
+                for date in dates
+                for departure_time in departure_times
+            )
+        )
+    finally:
+        if owns_client:
+            await client.close()
+
+    manifest = {
+        "params": params,
+        "corridors": [list(corridor) for corridor in corridors],
+        "first_date": min(dates).isoformat(),
+        "last_date": max(dates).isoformat(),
+        "departure_times": sorted({t.strftime("%H:%M") for t in departure_times}),
+        "built_at": time.time(),
+        "failures": failures,
+    }
+    # the carried-over segments keep the previous build's corridors and dates covered
+    if previous is not None:
+        old = previous.manifest
+        manifest["corridors"] += [c for c in old["corridors"] if c not in manifest["corridors"]]
+        manifest["first_date"] = min(manifest["first_date"], old["first_date"])
+        manifest["last_date"] = max(manifest["last_date"], old["last_date"])
+        manifest["departure_times"] = sorted(
+            set(manifest["departure_times"]) | set(old["departure_times"])
+        )
+    return write_build(segments, manifest, corridor_dir)
+
+
+# coverage and staleness of the current build, as a dict (see print_report)
+def report(corridor_dir=CORRIDOR_DIR, today=None, stale_after_days=STALE_AFTER_DAYS):
+    cache = load_corridor_cache(corridor_dir)
+    if cache is None:
+        return None
+    today = today or datetime.date.today()
+    now = time.time()
+    ages = (now - np.asarray(cache.built_at)) / 86400 if len(cache) else np.zeros(0)
+    days = np.array(
+        [datetime.date.fromisoformat(cache.keys[i].rsplit("|", 1)[1][:10]) for i in range(len(cache))]
+    )
+    manifest = cache.manifest
+    last_date = datetime.date.fromisoformat(manifest["last_date"])
+    return {
+        "build_id": manifest["build_id"],
+        "params": manifest["params"],
+        "corridors": len(manifest["corridors"]),
+        "dates": "{} .. {}".format(manifest["first_date"], manifest["last_date"]),
+        "segments": len(cache),
+        "past_segments": int((days < today).sum()) if len(days) else 0,
+        "days_left": (last_date - today).days,
+        "age_days": {
+            "min": float(ages.min()) if len(ages) else None,
+            "median": float(np.median(ages)) if len(ages) else None,
+            "max": float(ages.max()) if len(ages) else None,
+        },
+        "stale_segments": int((ages > stale_after_days).sum()),
+        "failures": manifest.get("failures", []),
+    }
+
+
+def print_report(summary):
+    if summary is None:
+        print("no corridor build")
+        return
+    print("build {} ({} corridors, {})".format(summary["build_id"], summary["corridors"], summary["dates"]))
+    print("segments: {} ({} for past days)".format(summary["segments"], summary["past_segments"]))
+    print("days of departures left: {}".format(summary["days_left"]))
+    ages = summary["age_days"]
+    if ages["min"] is not None:
+        print("age: {:.1f} / {:.1f} / {:.1f} days (min / median / max)".format(ages["min"], ages["median"], ages["max"]))
+    print("stale segments (> {} days): {}".format(STALE_AFTER_DAYS, summary["stale_segments"]))
+    for failure in summary["failures"]:
+        print("failed: {start} -> {goal} at {start_time}: {error}".format(**failure))
+
+
+# python corridor_cache.py warm corridors.csv --from 2026-01-01 --to 2026-01-31
+# python corridor_cache.py report
+# run from the main directory
+def main():
+    parser = argparse.ArgumentParser(description="precompute the stop options of busy corridors")
+    commands = parser.add_subparsers(dest="command", required=True)
+    warm_parser = commands.add_parser("warm", help="precompute a corridor list over a date range")
+    warm_parser.add_argument("corridors", help="csv with start and goal columns")
+    warm_parser.add_argument("--from", dest="first_date", required=True)
+    warm_parser.add_argument("--to", dest="last_date", required=True)
+    warm_parser.add_argument("--times", default="09:00", help="departure times (comma separated)")
+    warm_parser.add_argument("--max-travel-time", type=int, default=60 * 6)
+    warm_parser.add_argument("--latest-stop-time", type=int, default=19)
+    warm_parser.add_argument("--window-minutes", type=int, default=40)
+    commands.add_parser("report", help="coverage and staleness of the current build")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        print_report(report())
+        return
+
+    import route_cache
+
+    dates = date_range(
+        datetime.date.fromisoformat(args.first_date), datetime.date.fromisoformat(args.last_date)
+    )
+    departure_times = [datetime.time.fromisoformat(t) for t in args.times.split(",")]
+    build_dir = asyncio.run(
+        warm(
+            read_corridors(args.corridors),
+            dates,
+            departure_times,
+            args.max_travel_time,
+            args.latest_stop_time,
+            args.window_minutes,
+            route_cache=route_cache.RouteCache("../data/cache/route_cache.sqlite"),
+        )
+    )
+    print("written {}".format(build_dir))
+    print_report(report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+
+import station_scores
+
+BUNDLE_DIR = "../data/bundle"
+# bumped whenever arrays are added or change meaning, so older bundles are recompiled
+BUNDLE_VERSION = 5
+HOTELS_PATH = "../data/hotels/KNT_hotels.csv"
+
+# csv files compiled into the bundle
+# pandas is only imported to compile or to build dataframes, so the planner's lookups
+# and string tables (e.g. corridor_cache) do not need it
+SOURCES = {
+    "nearest_station": station_scores.NEAREST_STATION_PATH,
+    "hotels_scores": station_scores.HOTELS_SCORES_PATH,
+    "station_scores": station_scores.STATION_SCORES_PATH,
+    "hotels": HOTELS_PATH,
+}
+
+
+# interned strings stored as one utf-8 buffer and an offsets array, both memory-mappable
+class StringTable:
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._strings = None
+
+    @staticmethod
+    def build(strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return data, offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8")
+
+    # position of a string in a table built from sorted strings, or -1
+    # binary search over the mapped buffer, decoding only the strings it compares with
+    def find(self, s):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self[lo] == s else -1
+
+    # decodes every string once, for building dataframes; the result is private to the process
+    def to_array(self):
+        if self._strings is None:
+            self._strings = np.array([self[i] for i in range(len(self))], dtype=object)
+        return self._strings
+
+
+# returns a tuple of (sorted unique strings, int32 codes into them), NaN becomes -1
+def _intern(values):
+    import pandas as pd
+
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), sort=True)
+    return [str(u) for u in uniques], codes.astype(np.int32)
+
+
+def _save_table(build_dir, name, strings):
+    data, offsets = StringTable.build(strings)
+    np.save(os.path.join(build_dir, name + ".data.npy"), data)
+    np.save(os.path.join(build_dir, name + ".offsets.npy"), offsets)
+
+
+# "<table>.by_<key>" orders the rows by the key and "<table>.<key>_sorted" holds the sorted keys,
+# so DataBundle.rows finds the rows of a key by binary search
+def _key_index(arrays, table, key, values):
+    order = np.argsort(values, kind="stable")
+    arrays["{}.by_{}".format(table, key)] = order
+    arrays["{}.{}_sorted".format(table, key)] = values[order]
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def _current_path(bundle_dir):
+    return os.path.join(bundle_dir, "CURRENT")
+
+
+# compiles the planner's csv files into memory-mappable numpy arrays
+def compile_bundle(bundle_dir=BUNDLE_DIR):
+    import pandas as pd
+
+    manifest = {name: _source_stamp(path) for name, path in SOURCES.items()}
+    return compile_frames(
+        pd.read_csv(SOURCES["nearest_station"]),
+        pd.read_csv(SOURCES["hotels_scores"]),
+        station_scores.load_station_scores_df(),
+        pd.read_csv(SOURCES["hotels"]),
+        bundle_dir,
+        manifest,
+    )
+
+
+# writes the planner's tables as a new build of the bundle and then points CURRENT at it
+# with one os.replace, so readers and concurrent compiles never see a half-written bundle;
+# older builds are removed except the few most recent, for readers still holding them
+def compile_frames(
+    nearest_station_df, hotels_scores_df, station_scores_df, hotels_df, bundle_dir=BUNDLE_DIR,
+    manifest=None, keep=2,
+):
+    import pandas as pd
+
+    build_id = "{}-{}".format(datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f"), os.getpid())
+    build_dir = os.path.join(bundle_dir, build_id)
+    os.makedirs(build_dir)
+
+    # hotel codes of every file share one table
+    hotelcodes, _ = _intern(
+        pd.concat(
+            [hotels_df["hotelcode"], nearest_station_df["hotelcode"], hotels_scores_df["hotelcode"]]
+        )
+    )
+    hotel_ids = {code: i for i, code in enumerate(hotelcodes)}
+    station_names, _ = _intern(
+        pd.concat(
+            [nearest_station_df["nearest_station_name"], station_scores_df["station_name"]]
+        ).dropna()
+    )
+    station_ids = {name: i for i, name in enumerate(station_names)}
+
+    def _codes(values, ids):
+        return np.array([ids.get(v, -1) for v in values], dtype=np.int32)
+
+    hotel_names = [""] * len(hotelcodes)
+    for code, name in zip(hotels_df["hotelcode"], hotels_df["name"]):
+        if code in hotel_ids:
+            hotel_names[hotel_ids[code]] = str(name)
+
+    hotels_scores_hotels = _codes(hotels_scores_df["hotelcode"], hotel_ids)
+    # the hotels_scores row of each hotel (its first one), -1 for hotels without a score
+    score_rows = np.full(len(hotelcodes), -1, dtype=np.int32)
+    for row in range(len(hotels_scores_hotels) - 1, -1, -1):
+        if hotels_scores_hotels[row] >= 0:
+            score_rows[hotels_scores_hotels[row]] = row
+
+    nearest_stations = _codes(nearest_station_df["nearest_station_name"], station_ids)
+    nearest_groups = (
+        nearest_station_df["nearest_station_g_cd"].fillna(-1).to_numpy(np.int64)
+        if "nearest_station_g_cd" in nearest_station_df.columns
+        else np.full(len(nearest_station_df), -1, dtype=np.int64)
+    )
+    score_stations = _codes(station_scores_df["station_name"], station_ids)
+    score_groups = station_scores_df["station_g_cd"].to_numpy(np.int64)
+
+    arrays = {
+        "nearest_station.station": nearest_stations,
+        "nearest_station.latitude": nearest_station_df["nearest_station_latitude"].to_numpy(float),
+        "nearest_station.longitude": nearest_station_df["nearest_station_longitude"].to_numpy(float),
+        "nearest_station.distance": nearest_station_df["distance"].to_numpy(float),
+        # station_g_cd of the nearest station, -1 when there is none
+        "nearest_station.group": nearest_groups,
+        "nearest_station.hotel": _codes(nearest_station_df["hotelcode"], hotel_ids),
+        "hotels_scores.hotel": hotels_scores_hotels,
+        "hotels_scores.score": hotels_scores_df["score"].to_numpy(float),
+        "station_scores.station": score_stations,
+        "station_scores.group": score_groups,
+        "station_scores.score": station_scores_df["score"].to_numpy(float),
+        "hotels.hotel": _codes(hotels_df["hotelcode"], hotel_ids),
+        "hotels.latitude": hotels_df["latitude"].to_numpy(float),
+        "hotels.longitude": hotels_df["longitude"].to_numpy(float),
+        "hotel_ids.score_row": score_rows,
+        "station_scores.hotels": np.stack(
+            [_codes(station_scores_df[column], hotel_ids) for column in station_scores.HOTEL_COLUMNS],
+            axis=1,
+        ),
+    }
+    _key_index(arrays, "nearest_station", "group", nearest_groups)
+    _key_index(arrays, "nearest_station", "station", nearest_stations)
+    _key_index(arrays, "station_scores", "group", score_groups)
+    _key_index(arrays, "station_scores", "station", score_stations)
+    for name, array in arrays.items():
+        np.save(os.path.join(build_dir, name + ".npy"), array)
+    _save_table(build_dir, "hotelcodes", hotelcodes)
+    _save_table(build_dir, "hotel_names", hotel_names)
+    _save_table(build_dir, "station_names", station_names)
+
+    manifest = dict(manifest or {}, version=BUNDLE_VERSION, build_id=build_id)
+    with open(os.path.join(build_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    temporary_path = "{}.{}.tmp".format(_current_path(bundle_dir), build_id)
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        f.write(build_id)
+    os.replace(temporary_path, _current_path(bundle_dir))
+
+    builds = sorted(
+        name for name in os.listdir(bundle_dir) if os.path.isdir(os.path.join(bundle_dir, name))
+    )
+    for name in builds[:-keep]:
+        shutil.rmtree(os.path.join(bundle_dir, name), ignore_errors=True)
+    return build_dir
+
+
+# the directory of the current build, or None before the first compile
+def current_build(bundle_dir=BUNDLE_DIR):
+    try:
+        with open(_current_path(bundle_dir), encoding="utf-8") as f:
+            build_dir = os.path.join(bundle_dir, f.read().strip())
+    except OSError:
+        return None
+    return build_dir if os.path.isdir(build_dir) else None
+
+
+def is_stale(bundle_dir=BUNDLE_DIR):
+    build_dir = current_build(bundle_dir)
+    if build_dir is None or station_scores.is_stale():
+        return True
+    try:
+        with open(os.path.join(build_dir, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except OSError:
+        return True
+    return manifest.get("version") != BUNDLE_VERSION or any(
+        manifest.get(name) != _source_stamp(path) for name, path in SOURCES.items()
+    )
+
+
+# read-only view of a compiled bundle
+# arrays are memory-mapped and the planner's lookups read them in place (binary searches over
+# the sorted key arrays and string tables), so processes planning from the same bundle share
+# its pages through the page cache; only the *_df methods copy, for building dataframes
+class DataBundle:
+    def __init__(self, bundle_dir=BUNDLE_DIR):
+        self.bundle_dir = bundle_dir
+        self.build_dir = current_build(bundle_dir)
+        if self.build_dir is None:
+            raise FileNotFoundError("no bundle in {}".format(bundle_dir))
+        self._arrays = {}
+        self.hotelcodes = self._table("hotelcodes")
+        self.hotel_names = self._table("hotel_names")
+        self.station_names = self._table("station_names")
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.build_dir, name + ".npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    def _table(self, name):
+        return StringTable(self.array(name + ".data"), self.array(name + ".offsets"))
+
+    # positions of the rows of a table whose key equals value, in table order
+    # e.g. rows("nearest_station", "group", station_g_cd)
+    def rows(self, table, key, value):
+        sorted_keys = self.array("{}.{}_sorted".format(table, key))
+        start = np.searchsorted(sorted_keys, value, side="left")
+        end = np.searchsorted(sorted_keys, value, side="right")
+        return np.sort(self.array("{}.by_{}".format(table, key))[start:end])
+
+    # hotel codes of hotel ids, "none" for -1
+    def hotelcode_list(self, hotel_ids):
+        return [self.hotelcodes[i] if i >= 0 else "none" for i in hotel_ids]
+
+    # the hotel id of a hotel code, or -1
+    def hotel_id(self, hotelcode):
+        return self.hotelcodes.find(str(hotelcode))
+
+    # the id of a station name, or -1
+    def station_id(self, station_name):
+        return self.station_names.find(str(station_name))
+
+    @staticmethod
+    def _decode(table, codes):
+        codes = np.asarray(codes)
+        values = table.to_array()[np.maximum(codes, 0)]
+        values[codes < 0] = np.nan
+        return values
+
+    # the source tables as dataframes, for the loading scripts and the benchmark
+    def nearest_station_df(self):
+        import pandas as pd
+
+        return pd.DataFrame(
+            {
+                "nearest_station_name": self._decode(
+                    self.station_names, self.array("nearest_station.station")
+                ),
+                "nearest_station_latitude": self.array("nearest_station.latitude"),
+                "nearest_station_longitude": self.array("nearest_station.longitude"),
+                "distance": self.array("nearest_station.distance"),
+                "nearest_station_g_cd": self.array("nearest_station.group"),
+                "hotelcode": self._decode(self.hotelcodes, self.array("nearest_station.hotel")),
+            }
+        )
+
+    def hotels_scores_df(self):
+        import pandas as pd
+
+        return pd.DataFrame(
+            {
+                "hotelcode": self._decode(self.hotelcodes, self.array("hotels_scores.hotel")),
+                "score": self.array("hotels_scores.score"),
+            }
+        )
+
+    def station_scores_df(self):
+        import pandas as pd
+
+        station_scores_df = pd.DataFrame(
+            {
+                "station_g_cd": self.array("station_scores.group"),
+                "station_name": self._decode(
+                    self.station_names, self.array("station_scores.station")
+                ),
+                "score": self.array("station_scores.score"),
+            }
+        )
+        hotels = self.array("station_scores.hotels")
+        for i, column in enumerate(station_scores.HOTEL_COLUMNS):
+            codes = np.asarray(hotels[:, i])
+            values = self._decode(self.hotelcodes, codes)
+            values[codes < 0] = "none"
+            station_scores_df[column] = values
+        return station_scores_df
+
+    # hotel codes and coordinates of the hotel catalogue (KNT_hotels.csv)
+    def hotels_df(self):
+        import pandas as pd
+
+        return pd.DataFrame(
+            {
+                "hotelcode": self._decode(self.hotelcodes, self.array("hotels.hotel")),
+                "latitude": self.array("hotels.latitude"),
+                "longitude": self.array("hotels.longitude"),
+            }
+        )
+
+    def hotel_name(self, hotelcode):
+        i = self.hotel_id(hotelcode)
+        return self.hotel_names[i] if i >= 0 else None
+
+
+# returns the bundle, compiling it first when it is missing or older than its csv files
+# process pools call it once before forking, so the workers do not each compile it
+def load_bundle(bundle_dir=BUNDLE_DIR):
+    if is_stale(bundle_dir):
+        compile_bundle(bundle_dir)
+    return DataBundle(bundle_dir)
+
+
+_MEASURE_CODE = """
+import resource, sys, time
+started = time.perf_counter()
+if sys.argv[1] == "csv":
+    import pandas as pd
+    pd.read_csv("../data/hotels/nearest_station.csv")
+    pd.read_csv("../data/hotels/hotels_scores.csv")
+    pd.read_csv("../data/hotels/station_scores.csv")
+    pd.read_csv("../data/hotels/KNT_hotels.csv")
+else:
+    import data_bundle
+    bundle = data_bundle.DataBundle()
+    bundle.rows("station_scores", "station", bundle.station_id("東京"))
+    bundle.hotel_name("S010001")
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+# time (including imports) and peak rss of loading the planner data
+# from csv and from the bundle, each in a fresh interpreter; run from the main directory
+def benchmark(repeat=5):
+    load_bundle()
+    for mode in ("csv", "bundle"):
+        runs = [
+            subprocess.run(
+                [sys.executable, "-c", _MEASURE_CODE, mode],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.split()
+            for _ in range(repeat)
+        ]
+        seconds = sorted(float(run[0]) for run in runs)[len(runs) // 2]
+        rss_mb = sorted(int(run[1]) for run in runs)[len(runs) // 2] / 1024
+        print("{}: {:.3f} s, {:.1f} MB peak rss".format(mode, seconds, rss_mb))
+
+
+if __name__ == "__main__":
+    benchmark()
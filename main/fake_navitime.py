@@ -0,0 +1,173 @@
+import copy
+import datetime
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import route_parser
+
+RECORDINGS = ["../test_results.json"]
+NODE_IDS_PATH = "../data/stations/navitime_node_ids.csv"
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S+09:00"
+# minutes between the requested start_time and the first departure of a replayed route
+WAIT_MINUTES = 5
+
+
+def _shift_times(value, offset):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ("from_time", "to_time") and isinstance(item, str):
+                value[key] = (route_parser.parse_time(item) + offset).strftime(TIME_FORMAT)
+            else:
+                _shift_times(item, offset)
+    elif isinstance(value, list):
+        for item in value:
+            _shift_times(item, offset)
+
+
+def _point(station):
+    return {
+        "type": "point",
+        "coord": station.get("coord"),
+        "name": station.get("name"),
+        "node_id": station.get("node_id"),
+        "node_types": station.get("node_types", ["station"]),
+    }
+
+
+# returns the sections of a recorded route from the start node on, or None when the route
+# does not pass it; a start in the middle of a move becomes a point plus the rest of that move
+def _trim(sections, start):
+    for i, section in enumerate(sections):
+        if section.get("type") == "point" and section.get("node_id") == start:
+            return copy.deepcopy(sections[i:])
+        calling_at = section.get("transport", {}).get("calling_at", [])
+        for j, station in enumerate(calling_at):
+            if station.get("node_id") == start:
+                move = copy.deepcopy(section)
+                move["from_time"] = station.get("from_time") or station.get("to_time")
+                move["transport"]["calling_at"] = copy.deepcopy(calling_at[j + 1 :])
+                return [_point(station), move] + copy.deepcopy(sections[i + 1 :])
+    return None
+
+
+# answers transport_node and route_transit like the NAVITIME API, from recorded responses
+# - transport_node looks the word up in the station name -> node id table
+# - route_transit replays the recorded route that passes the start and ends at the goal,
+#   cut at the start station and moved to the requested start_time
+# latency seconds (plus up to jitter seconds) are slept before each answer
+class FakeNavitime:
+    def __init__(self, recordings=RECORDINGS, node_ids_path=NODE_IDS_PATH, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.routes = []
+        for path in recordings:
+            with open(path, encoding="utf-8") as f:
+                self.routes += json.load(f).get("items", [])
+        node_ids_df = pd.read_csv(node_ids_path, dtype=str)
+        self.node_ids = dict(zip(node_ids_df["station_name"], node_ids_df["node_id"]))
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def transport_node(self, params):
+        word = params.get("word", "")
+        node_id = self.node_ids.get(word)
+        return {"items": [{"id": node_id, "name": word}] if node_id else []}
+
+    def route_transit(self, params):
+        start, goal = params.get("start"), params.get("goal")
+        start_time = datetime.datetime.strptime(params["start_time"][:19], "%Y-%m-%dT%H:%M:%S")
+        for route in self.routes:
+            if route["sections"][-1].get("node_id") != goal:
+                continue
+            sections = _trim(route["sections"], start)
+            if sections is None or len(sections) < 2:
+                continue
+            departure = route_parser.parse_time(sections[1]["from_time"])
+            offset = start_time + datetime.timedelta(minutes=WAIT_MINUTES) - departure
+            _shift_times(sections, offset)
+            return {
+                "items": [
+                    {
+                        "summary": {"start": _point(sections[0]), "goal": _point(sections[-1])},
+                        "sections": sections,
+                    }
+                ]
+            }
+        return {"items": []}
+
+    # returns the json body for a request path and query parameters, or None for an unknown path
+    def answer(self, path, params):
+        with self._lock:
+            self.request_count += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+        if path.endswith("/transport_node"):
+            return self.transport_node(params)
+        if path.endswith("/route_transit"):
+            return self.route_transit(params)
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = self.server.fake.answer(url.path, params)
+        if body is None:
+            self.send_error(404)
+            return
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+# serves a FakeNavitime on a local port from a background thread
+# with FakeNavitimeServer(latency=0.05) as server:
+#     client = navitime_client.AsyncNavitimeClient(**server.client_urls())
+class FakeNavitimeServer:
+    def __init__(self, host="127.0.0.1", port=0, **kwargs):
+        self.fake = FakeNavitime(**kwargs)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self.fake
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    # keyword arguments pointing AsyncNavitimeClient at this server
+    def client_urls(self):
+        return {
+            "transport_node_url": self.url + "/transport_node",
+            "route_transit_url": self.url + "/route_transit",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
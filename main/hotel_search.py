@@ -0,0 +1,94 @@
+import numpy as np
+
+from spatial_index import SpatialIndex
+
+# hotels further than this from a stop are not considered
+RADIUS_M = 800
+# a hotel's score halves every HALF_DISTANCE_M it is away from the stop
+HALF_DISTANCE_M = 400
+TOP_HOTELS = 5
+
+
+# scores stops by every hotel around them rather than by the hotels whose nearest station they are
+# a hotel counts with its hotels_scores.csv score, decayed by its distance to the stop;
+# the station score is the average of the top 5 decayed scores (missing hotels count as 0),
+# as in station_scores
+# hotelcodes is anything indexable by hotel position (e.g. the bundle's StringTable),
+# only the codes of the top hotels are read
+class HotelSearch:
+    def __init__(self, hotelcodes, latitudes, longitudes, scores, cell_size_m=1000):
+        self.hotelcodes = hotelcodes
+        self.scores = np.asarray(scores, dtype=float)
+        self.index = SpatialIndex(latitudes, longitudes, cell_size_m)
+
+    # returns a tuple of station scores and top hotel code lists ("none" padded), one per stop
+    def score_stops(
+        self, latitudes, longitudes, radius_m=RADIUS_M, half_distance_m=HALF_DISTANCE_M
+    ):
+        stops, hotels, distances = self.index.query_radius_many(latitudes, longitudes, radius_m)
+        weighted = self.scores[hotels] * np.exp2(-distances / half_distance_m)
+
+        # best first within each stop, then the first TOP_HOTELS of every stop
+        order = np.lexsort((-weighted, stops))
+        stops, hotels, weighted = stops[order], hotels[order], weighted[order]
+        group_starts = np.flatnonzero(np.r_[True, stops[1:] != stops[:-1]]) if len(stops) else stops
+        ranks = np.arange(len(stops)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(stops)]))
+        top = ranks < TOP_HOTELS
+        stops, hotels, weighted, ranks = stops[top], hotels[top], weighted[top], ranks[top]
+
+        station_scores = np.bincount(stops, weights=weighted, minlength=len(latitudes)) / TOP_HOTELS
+        codes = np.full((len(latitudes), TOP_HOTELS), "none", dtype=object)
+        codes[stops, ranks] = [self.hotelcodes[hotel] for hotel in hotels]
+        return station_scores, codes.tolist()
+
+
+# searches the hotels of KNT_hotels.csv straight from the bundle's arrays
+# a hotel's score is its first hotels_scores row, 0 when it has none
+def from_bundle(bundle):
+    hotel_ids = np.asarray(bundle.array("hotels.hotel"))
+    known = hotel_ids >= 0
+    hotel_ids = hotel_ids[known]
+    score_rows = np.asarray(bundle.array("hotel_ids.score_row"))[hotel_ids]
+    scores = np.where(
+        score_rows >= 0, np.asarray(bundle.array("hotels_scores.score"))[np.maximum(score_rows, 0)], 0
+    )
+    return HotelSearch(
+        _Codes(bundle.hotelcodes, hotel_ids),
+        np.asarray(bundle.array("hotels.latitude"))[known],
+        np.asarray(bundle.array("hotels.longitude"))[known],
+        scores,
+    )
+
+
+# hotel codes of the searched hotels, decoded from the bundle's table when read
+class _Codes:
+    def __init__(self, table, hotel_ids):
+        self.table = table
+        self.hotel_ids = hotel_ids
+
+    def __getitem__(self, i):
+        return self.table[self.hotel_ids[i]]
+
+
+def test(radius_m=RADIUS_M):
+    import time
+
+    import pandas as pd
+
+    import data_bundle
+
+    bundle = data_bundle.load_bundle()
+    search = from_bundle(bundle)
+    station_df = pd.read_csv("../data/stations/JR_station20230907free.csv")
+    started = time.perf_counter()
+    scores, codes = search.score_stops(station_df["lat"], station_df["lon"], radius_m)
+    elapsed = time.perf_counter() - started
+    print(
+        "{} stops in {:.1f} ms, {} with hotels within {} m".format(
+            len(station_df), elapsed * 1000, int((scores > 0).sum()), radius_m
+        )
+    )
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,235 @@
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+logger = logging.getLogger("trip_planner.metrics")
+
+# latest samples kept per timer for the percentiles
+RESERVOIR_SIZE = 10000
+
+
+# timers and counters of the planning pipeline
+# everything is a no-op until enable() is called (or PLANNER_METRICS is set),
+# so instrumented functions only pay for one attribute check when it is off
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(float)
+            self.samples = defaultdict(lambda: deque(maxlen=RESERVOIR_SIZE))
+            self.totals = defaultdict(float)
+            self.calls = defaultdict(int)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds, started_at=None, attributes=None):
+        with self._lock:
+            self.samples[name].append(seconds)
+            self.totals[name] += seconds
+            self.calls[name] += 1
+        for sink in self.sinks:
+            on_span = getattr(sink, "on_span", None)
+            if on_span is not None:
+                on_span(name, started_at, seconds, attributes or {})
+
+    # returns {"counters": {...}, "timers": {name: {count, total, p50, p95, p99}}}
+    def summary(self):
+        with self._lock:
+            timers = {}
+            for name, samples in self.samples.items():
+                ordered = sorted(samples)
+                timers[name] = {
+                    "count": self.calls[name],
+                    "total": self.totals[name],
+                    "p50": _percentile(ordered, 50),
+                    "p95": _percentile(ordered, 95),
+                    "p99": _percentile(ordered, 99),
+                }
+            return {"counters": dict(self.counters), "timers": timers}
+
+    def export(self):
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.export(summary)
+        return summary
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+metrics = Metrics()
+
+
+def enable(*sinks):
+    metrics.sinks = list(sinks)
+    metrics.enabled = True
+
+
+def disable():
+    metrics.enabled = False
+
+
+def count(name, value=1):
+    metrics.count(name, value)
+
+
+# context manager timing a block under the given name
+class timer:
+    __slots__ = ("name", "attributes", "started_at", "_start")
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        if metrics.enabled:
+            self.started_at = time.time()
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if metrics.enabled:
+            metrics.observe(
+                self.name,
+                time.perf_counter() - self._start,
+                self.started_at,
+                self.attributes,
+            )
+        return False
+
+
+# decorator timing every call of a function or coroutine function
+def timed(name):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not metrics.enabled:
+                    return await function(*args, **kwargs)
+                started_at, start = time.time(), time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    metrics.observe(name, time.perf_counter() - start, started_at)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            started_at, start = time.time(), time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start, started_at)
+
+        return wrapper
+
+    return decorator
+
+
+# logs one line per counter and timer
+class LoggingSink:
+    def __init__(self, log=logger, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def export(self, summary):
+        for name, value in sorted(summary["counters"].items()):
+            self.log.log(self.level, "%s = %g", name, value)
+        for name, timer_summary in sorted(summary["timers"].items()):
+            self.log.log(
+                self.level,
+                "%s: %d calls, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms",
+                name,
+                timer_summary["count"],
+                timer_summary["p50"] * 1000,
+                timer_summary["p95"] * 1000,
+                timer_summary["p99"] * 1000,
+            )
+
+
+def _metric_name(name):
+    return "planner_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+# renders the prometheus text exposition format; the latest text is kept in self.text
+# and written to path when one is given (e.g. for the node exporter's textfile collector)
+class PrometheusSink:
+    def __init__(self, path=None):
+        self.path = path
+        self.text = ""
+
+    def export(self, summary):
+        lines = []
+        for name, value in sorted(summary["counters"].items()):
+            metric = _metric_name(name) + "_total"
+            lines += ["# TYPE {} counter".format(metric), "{} {}".format(metric, value)]
+        for name, timer_summary in sorted(summary["timers"].items()):
+            metric = _metric_name(name) + "_seconds"
+            lines.append("# TYPE {} summary".format(metric))
+            for quantile in ("50", "95", "99"):
+                lines.append(
+                    '{}{{quantile="0.{}"}} {}'.format(metric, quantile, timer_summary["p" + quantile])
+                )
+            lines.append("{}_sum {}".format(metric, timer_summary["total"]))
+            lines.append("{}_count {}".format(metric, timer_summary["count"]))
+        self.text = "\n".join(lines) + "\n"
+        if self.path is not None:
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(self.text)
+
+
+# collects opentelemetry-style span records (name, start, duration, attributes)
+# or hands each one to on_finish, e.g. to forward them to a tracer
+class SpanSink:
+    def __init__(self, on_finish=None, max_spans=RESERVOIR_SIZE):
+        self.on_finish = on_finish
+        self.spans = deque(maxlen=max_spans)
+
+    def on_span(self, name, started_at, seconds, attributes):
+        span = {
+            "name": name,
+            "start_time": started_at,
+            "end_time": started_at + seconds if started_at is not None else None,
+            "duration": seconds,
+            "attributes": attributes,
+        }
+        if self.on_finish is not None:
+            self.on_finish(span)
+        else:
+            self.spans.append(span)
+
+    def export(self, summary):
+        pass
+
+
+# PLANNER_METRICS=logging or PLANNER_METRICS=prometheus[:path] turns metrics on at import
+_setting = os.getenv("PLANNER_METRICS")
+if _setting:
+    _kind, _, _path = _setting.partition(":")
+    if _kind == "prometheus":
+        enable(PrometheusSink(_path or None))
+    elif _kind == "spans":
+        enable(SpanSink())
+    else:
+        enable(LoggingSink())
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# a leased job not completed within this many seconds goes back to the queue
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 4
+# a failed job waits RETRY_DELAY x 2^(attempts - 1) seconds before it can be leased again
+RETRY_DELAY = 30
+
+
+# jobs of the same corridor share route searches and precomputed days, so they go to one worker
+def shard_key(request):
+    return "{}|{}".format(str(request["start"]).strip(), str(request["goal"]).strip())
+
+
+# the same trip always gets the same job id, so enqueueing it twice plans it once
+def job_id(request):
+    if request.get("id") not in (None, ""):
+        return str(request["id"])
+    key = "{}|{}".format(shard_key(request), str(request["start_time"]).strip())
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+# durable queue of plan requests in a SQLite file, shared by the worker processes using it
+# - lease: a worker takes up to limit jobs of one corridor (shard) no other worker holds,
+#   preferring the shard it worked on last; the jobs are its own until the lease expires
+# - complete: the first result of a job is kept, later writes (an expired lease finishing late,
+#   a re-enqueued request) are ignored, so every trip is planned and written once
+# - fail: the job is retried with exponential backoff up to max_attempts, then marked failed
+# several machines can share one file only on a filesystem with working locks (not NFS with WAL)
+class JobQueue:
+    def __init__(
+        self,
+        path,
+        lease_seconds=LEASE_SECONDS,
+        max_attempts=MAX_ATTEMPTS,
+        retry_delay=RETRY_DELAY,
+        wal=True,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        # autocommit, transactions are opened explicitly where several statements must agree
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        if wal:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, shard TEXT NOT NULL, request TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_expires REAL, available_at REAL NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status_shard ON jobs (status, shard)")
+
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+
+    # adds the requests not queued yet, returns how many were added
+    def enqueue(self, requests):
+        now = time.time()
+        rows = [
+            (job_id(request), shard_key(request), json.dumps(request, ensure_ascii=False), now, now)
+            for request in requests
+        ]
+        self._transaction()
+        try:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO jobs (id, shard, request, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            added = self._db.total_changes - before
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return added
+
+    # returns a list of (job id, request dict) of one shard, empty when nothing is ready
+    def lease(self, worker, limit=8, prefer_shard=None):
+        now = time.time()
+        self._transaction()
+        try:
+            # expired leases go back to the queue, counting as a failed attempt
+            self._db.execute(
+                "UPDATE jobs SET status = 'pending', worker = NULL, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ?",
+                (now, now),
+            )
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired too often', updated_at = ? "
+                "WHERE status = 'pending' AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            # shards another worker is still working on are skipped
+            ready = (
+                "SELECT shard, MIN(created_at) FROM jobs j WHERE status = 'pending' "
+                "AND available_at <= ? AND NOT EXISTS (SELECT 1 FROM jobs l "
+                "WHERE l.shard = j.shard AND l.status = 'leased' AND l.worker != ?) "
+                "GROUP BY shard ORDER BY shard = ? DESC, MIN(created_at) LIMIT 1"
+            )
+            row = self._db.execute(ready, (now, worker, prefer_shard)).fetchone()
+            if row is None:
+                self._db.execute("COMMIT")
+                return []
+            jobs = self._db.execute(
+                "SELECT id, request FROM jobs WHERE shard = ? AND status = 'pending' "
+                "AND available_at <= ? ORDER BY rowid LIMIT ?",
+                (row[0], now, limit),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(worker, now + self.lease_seconds, now, id_) for id_, _ in jobs],
+            )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return [(id_, json.loads(request)) for id_, request in jobs]
+
+    # extends the lease of the worker's jobs still leased to it, returns how many were extended
+    def renew(self, worker, job_ids):
+        now = time.time()
+        cursor = self._db.executemany(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            [(now + self.lease_seconds, now, id_, worker) for id_ in job_ids],
+        )
+        return cursor.rowcount
+
+    # stores the job's result unless it already has one, returns whether it was stored
+    def complete(self, job_id, result):
+        now = time.time()
+        cursor = self._db.execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, worker = NULL, "
+            "lease_expires = NULL, updated_at = ? WHERE id = ? AND status != 'done'",
+            (json.dumps(result, ensure_ascii=False), now, job_id),
+        )
+        return cursor.rowcount > 0
+
+    # gives the job back for a retry after a backoff, or marks it failed after max_attempts
+    def fail(self, worker, job_id, error):
+        now = time.time()
+        row = self._db.execute(
+            "SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND status = 'leased'",
+            (job_id, worker),
+        ).fetchone()
+        if row is None:
+            return
+        if row[0] >= self.max_attempts:
+            status, available_at = "failed", now
+        else:
+            status, available_at = "pending", now + self.retry_delay * 2 ** (row[0] - 1)
+        self._db.execute(
+            "UPDATE jobs SET status = ?, error = ?, available_at = ?, worker = NULL, "
+            "lease_expires = NULL, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (status, error, available_at, now, job_id, worker),
+        )
+
+    # yields the result dicts of finished jobs, and an error dict for jobs that failed for good
+    def results(self):
+        rows = self._db.execute(
+            "SELECT status, request, result, error FROM jobs "
+            "WHERE status IN ('done', 'failed') ORDER BY rowid"
+        )
+        for status, request, result, error in rows:
+            if status == "done":
+                yield json.loads(result)
+            else:
+                request = json.loads(request)
+                failed = {key: request[key] for key in ("id", "start", "goal", "start_time") if key in request}
+                failed["error"] = error
+                yield failed
+
+    # whether every job is done or failed for good
+    def drained(self):
+        row = self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')"
+        ).fetchone()
+        return row[0] == 0
+
+    def stats(self):
+        counts = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        return {
+            status: counts.get(status, 0) for status in ("pending", "leased", "done", "failed")
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+# renews the lease of a worker's jobs every interval seconds while they are planned, so a batch
+# running longer than the lease is not handed to another worker
+# runs in a thread with its own connection, as sqlite connections stay in the thread opening them
+class LeaseHeartbeat:
+    def __init__(self, path, worker, job_ids, lease_seconds=LEASE_SECONDS, interval=None):
+        self.path = path
+        self.worker = worker
+        self.job_ids = list(job_ids)
+        self.lease_seconds = lease_seconds
+        self.interval = interval if interval is not None else lease_seconds / 3
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        queue = JobQueue(self.path, lease_seconds=self.lease_seconds)
+        try:
+            while not self._stop.wait(self.interval):
+                queue.renew(self.worker, self.job_ids)
+        finally:
+            queue.close()
@@ -0,0 +1,149 @@
+import asyncio
+import random
+import time
+import urllib.parse
+
+import aiohttp
+
+import instrumentation
+from navitime_session import RAPIDAPI_KEY, ROUTE_TRANSIT_URL, TRANSPORT_NODE_URL
+
+
+# token bucket limiting the request rate to one RapidAPI host
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # empties the bucket, e.g. when the API reports the quota window is used up
+    def pause(self, seconds):
+        self.tokens = -seconds * self.rate
+
+
+# one aiohttp session and connection pool shared by every request of the process
+# - at most max_concurrency requests in flight
+# - per host token bucket of requests_per_second
+# - 429 and 5xx responses are retried with exponential backoff, honoring Retry-After
+# the endpoint urls can point at another server, e.g. fake_navitime.FakeNavitimeServer
+class AsyncNavitimeClient:
+    def __init__(
+        self,
+        max_concurrency=8,
+        requests_per_second=5.0,
+        max_retries=4,
+        backoff=0.5,
+        timeout=30,
+        transport_node_url=TRANSPORT_NODE_URL,
+        route_transit_url=ROUTE_TRANSIT_URL,
+    ):
+        self.transport_node_url = transport_node_url
+        self.route_transit_url = route_transit_url
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+        self.request_count = 0
+        self.retry_count = 0
+        self._semaphore = None
+        self._session = None
+        self._buckets = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.requests_per_second)
+        return self._buckets[host]
+
+    def _retry_delay(self, attempt, response):
+        retry_after = response.headers.get("Retry-After") if response else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2**attempt * (1 + random.random() / 2)
+
+    # returns the json body of a GET request to a RapidAPI host
+    # raises aiohttp.ClientError once the retries are used up
+    async def get_json(self, url, params):
+        host = urllib.parse.urlsplit(url).hostname
+        headers = {"X-RapidAPI-Host": host}
+        # no key is needed (or set) when talking to a local fake server
+        if RAPIDAPI_KEY:
+            headers["X-RapidAPI-Key"] = RAPIDAPI_KEY
+        session = self.session
+        bucket = self._bucket(host)
+        endpoint = urllib.parse.urlsplit(url).path.strip("/")
+
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            async with self._semaphore:
+                self.request_count += 1
+                instrumentation.count("api." + endpoint + ".calls")
+                try:
+                    async with session.get(url, headers=headers, params=params) as response:
+                        if response.status == 429 or response.status >= 500:
+                            if attempt == self.max_retries:
+                                response.raise_for_status()
+                            delay = self._retry_delay(attempt, response)
+                            if response.status == 429:
+                                bucket.pause(delay)
+                        else:
+                            response.raise_for_status()
+                            body = await response.read()
+                            instrumentation.count("api." + endpoint + ".bytes", len(body))
+                            return await response.json()
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self._retry_delay(attempt, None)
+            self.retry_count += 1
+            instrumentation.count("api." + endpoint + ".retries")
+            await asyncio.sleep(delay)
+
+    # returns the first node id transport_node finds for the word, or None
+    async def station_name_to_id(self, station_name):
+        data = await self.get_json(self.transport_node_url, {"word": station_name})
+        items = data.get("items", [])
+        return items[0]["id"] if items else None
+
+    async def route_transit(self, querystring):
+        return await self.get_json(self.route_transit_url, querystring)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
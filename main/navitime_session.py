@@ -0,0 +1,171 @@
+import os
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+
+import requests
+from dotenv import load_dotenv
+
+import instrumentation
+
+# httpx (with h2) is optional, it is only needed for http2=True
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+load_dotenv()
+
+RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
+
+TRANSPORT_NODE_URL = "https://navitime-transport.p.rapidapi.com/transport_node"
+ROUTE_TRANSIT_URL = "https://navitime-route-totalnavi.p.rapidapi.com/route_transit"
+
+
+# synchronous counterpart of navitime_client.AsyncNavitimeClient, shared by every caller of the process
+# - one pooled keep-alive session (requests, or httpx over HTTP/2 with http2=True)
+# - connect and read timeouts
+# - 429 and 5xx responses and connection errors are retried with exponential backoff,
+#   honoring Retry-After; the last error is raised once the retries are used up
+# - gzip responses
+# - identical queries made while one is in flight wait for its response instead of sending their own
+class NavitimeClient:
+    def __init__(
+        self,
+        pool_size=8,
+        max_retries=4,
+        backoff=0.5,
+        connect_timeout=5,
+        read_timeout=30,
+        http2=False,
+        transport_node_url=TRANSPORT_NODE_URL,
+        route_transit_url=ROUTE_TRANSIT_URL,
+    ):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self.transport_node_url = transport_node_url
+        self.route_transit_url = route_transit_url
+
+        self.request_count = 0
+        self.retry_count = 0
+        self.coalesced_count = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        headers = {"Accept-Encoding": "gzip, deflate"}
+        if http2:
+            if httpx is None:
+                raise ImportError("http2=True needs httpx[http2]")
+            self._session = httpx.Client(
+                http2=True,
+                headers=headers,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size),
+            )
+            self._transient_errors = (httpx.TransportError,)
+        else:
+            self._session = requests.Session()
+            self._session.headers.update(headers)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size
+            )
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+            self._transient_errors = (requests.ConnectionError, requests.Timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _retry_delay(self, attempt, response):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2**attempt * (1 + random.random() / 2)
+
+    def _get(self, url, params):
+        host = urllib.parse.urlsplit(url).hostname
+        endpoint = urllib.parse.urlsplit(url).path.strip("/")
+        headers = {"X-RapidAPI-Host": host}
+        # no key is needed (or set) when talking to a local fake server
+        if RAPIDAPI_KEY:
+            headers["X-RapidAPI-Key"] = RAPIDAPI_KEY
+        timeout = self.timeout
+        if httpx is not None and isinstance(self._session, httpx.Client):
+            timeout = httpx.Timeout(self.timeout[1], connect=self.timeout[0])
+
+        for attempt in range(self.max_retries + 1):
+            self.request_count += 1
+            instrumentation.count("api." + endpoint + ".calls")
+            try:
+                response = self._session.get(url, headers=headers, params=params, timeout=timeout)
+            except self._transient_errors:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, None)
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    instrumentation.count("api." + endpoint + ".bytes", len(response.content))
+                    return response.json()
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                delay = self._retry_delay(attempt, response)
+            self.retry_count += 1
+            instrumentation.count("api." + endpoint + ".retries")
+            time.sleep(delay)
+
+    # returns the json body of a GET request to a RapidAPI host
+    def get_json(self, url, params):
+        key = (url, tuple(sorted((name, str(value)) for name, value in params.items())))
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            self.coalesced_count += 1
+            instrumentation.count("api.coalesced")
+            return future.result()
+
+        try:
+            future.set_result(self._get(url, params))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+    # returns the first node id transport_node finds for the word, or None
+    def station_name_to_id(self, station_name):
+        data = self.get_json(self.transport_node_url, {"word": station_name})
+        items = data.get("items", [])
+        return items[0]["id"] if items else None
+
+    def route_transit(self, querystring):
+        return self.get_json(self.route_transit_url, querystring)
+
+    def close(self):
+        self._session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+# the client shared by every caller that does not bring its own
+def default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = NavitimeClient()
+        return _default_client
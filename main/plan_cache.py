@@ -0,0 +1,222 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import data_bundle
+import instrumentation
+import station_groups
+import station_resolver
+import station_scores
+
+# the datasets a plan is computed from: the hotel scores and catalogue, and the physical
+# stations stops are located among (node ids learned at run time only add ids, so they are left out)
+DATASET_PATHS = [
+    station_scores.HOTELS_SCORES_PATH,
+    station_scores.NEAREST_STATION_PATH,
+    data_bundle.HOTELS_PATH,
+    station_groups.STATION_GROUPS_PATH,
+    station_resolver.NODE_IDS_PATH,
+]
+
+
+# content hash of the dataset files, rehashed only when a file's mtime or size changes
+class DatasetVersion:
+    def __init__(self, paths=DATASET_PATHS):
+        self.paths = list(paths)
+        self._stamps = None
+        self._hash = None
+
+    def _stamp(self):
+        stamps = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stamps.append(None)
+                continue
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(stamps)
+
+    def current(self):
+        stamps = self._stamp()
+        if stamps != self._stamps:
+            digest = hashlib.blake2b(digest_size=16)
+            for path in self.paths:
+                digest.update(path.encode("utf-8") + b"\0")
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b""):
+                            digest.update(chunk)
+            self._stamps = stamps
+            self._hash = digest.hexdigest()
+        return self._hash
+
+
+# two-tier cache for plan_trip results
+# entries are stored under the dataset version the planner loaded its data from;
+# while the files on disk hold another version (they changed after loading) nothing is served
+# or stored; entries of other versions are left to the ttl and size eviction, as other processes
+# sharing the disk tier may still hold that version
+# - memory tier: LRU with at most max_memory_entries results
+# - disk tier (optional): SQLite file with a ttl, as route results age with the timetable
+class PlanCache:
+    def __init__(
+        self,
+        path=None,
+        dataset_version=None,
+        ttl=24 * 60 * 60,
+        max_memory_entries=1024,
+        max_disk_entries=100_000,
+        time_bucket_minutes=5,
+    ):
+        self.path = path
+        self.dataset_version = dataset_version if dataset_version is not None else DatasetVersion()
+        # the version of the data the planner holds in memory
+        self.loaded_version = self.dataset_version.current()
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.time_bucket_minutes = time_bucket_minutes
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "key TEXT PRIMARY KEY, version TEXT NOT NULL, result TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS plans_accessed_at ON plans (accessed_at)")
+            self._evict_disk(time.time())
+            self._db.commit()
+
+    # returns the cache key of a plan_trip call
+    # start and goal are node ids (or the names when they do not resolve locally),
+    # start_time is rounded down to time_bucket_minutes
+    def make_key(self, start, goal, start_time, **options):
+        bucket = start_time.replace(second=0, microsecond=0)
+        bucket -= datetime.timedelta(minutes=bucket.minute % self.time_bucket_minutes)
+        key = {
+            "datasets": self.loaded_version,
+            "start": str(start),
+            "goal": str(goal),
+            "start_time": bucket.strftime("%Y-%m-%dT%H:%M"),
+            "options": {name: value for name, value in options.items() if value is not None},
+        }
+        return json.dumps(key, sort_keys=True, ensure_ascii=False, default=str)
+
+    # whether the files on disk still hold the data the planner loaded
+    def usable(self):
+        if self.dataset_version.current() == self.loaded_version:
+            return True
+        self.bypassed += 1
+        instrumentation.count("plan_cache.bypassed")
+        return False
+
+    # returns the cached result for the key, or None
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                result, created_at = entry
+                if time.time() - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    instrumentation.count("plan_cache.memory_hits")
+                    return _copy(result)
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result, created_at FROM plans WHERE key = ? AND version = ?",
+                    (key, self.loaded_version),
+                ).fetchone()
+                if row is not None and time.time() - row[1] <= self.ttl:
+                    self._db.execute(
+                        "UPDATE plans SET accessed_at = ? WHERE key = ?", (time.time(), key)
+                    )
+                    self._db.commit()
+                    result = _decode(row[0])
+                    self._remember(key, result, row[1])
+                    self.disk_hits += 1
+                    instrumentation.count("plan_cache.disk_hits")
+                    return _copy(result)
+
+            self.misses += 1
+            instrumentation.count("plan_cache.misses")
+            return None
+
+    def put(self, key, result):
+        now = time.time()
+        result = tuple((name, tuple(hotels) if hotels is not None else None) for name, hotels in result)
+        with self._lock:
+            self._remember(key, result, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?)",
+                    (key, self.loaded_version, json.dumps(result, ensure_ascii=False), now, now),
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def _remember(self, key, result, created_at):
+        self._memory[key] = (result, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    # drops expired rows, then the least recently used rows beyond max_disk_entries
+    def _evict_disk(self, now):
+        self._db.execute("DELETE FROM plans WHERE created_at < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM plans WHERE key IN (SELECT key FROM plans ORDER BY accessed_at DESC "
+            "LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM plans")
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+# results are kept as tuples, and handed out as the list of (name, hotel list) plan_trip returns
+def _copy(result):
+    return [(name, list(hotels) if hotels is not None else None) for name, hotels in result]
+
+
+def _decode(text):
+    return tuple((name, tuple(hotels) if hotels is not None else None) for name, hotels in json.loads(text))
@@ -0,0 +1,354 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import data_bundle
+import instrumentation
+import job_queue
+import trip_planner
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# start_time formats accepted in requests
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y/%m/%d %H:%M", "%Y-%m-%d %H:%M"]
+
+
+def parse_start_time(value):
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value[:19], time_format)
+        except ValueError:
+            continue
+    raise ValueError("unknown start_time format: {}".format(value))
+
+
+# yields request dicts with "start", "goal", "start_time" (and optionally "id")
+# from a jsonl file, or a csv file with those columns
+def read_requests(f, file_format="jsonl"):
+    if file_format == "csv":
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+# the planner of this process; one per worker so each keeps its own caches warm
+_planner = None
+
+
+def _get_planner():
+    global _planner
+    if _planner is None:
+        _planner = trip_planner.TripPlanner()
+    return _planner
+
+
+# plan_trip options of every request (local_router, offline, speculative), set from the command line
+# in this process and handed to the pool's workers
+_plan_options = {}
+
+
+def _configure(plan_options):
+    _plan_options.clear()
+    _plan_options.update(plan_options)
+
+
+# whether an error is worth retrying later: rate limits (429) and server errors outlasting the
+# client's retries, and connection failures; other errors (a 4xx, a bad response) are stored
+def is_transient(error):
+    if aiohttp is not None:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status == 429 or error.status >= 500
+        if isinstance(error, aiohttp.ClientConnectionError):
+            return True
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+def _result_head(request):
+    return {key: request.get(key) for key in ("id", "start", "goal", "start_time") if key in request}
+
+
+def _error(result, e):
+    result["error"] = "{}: {}".format(type(e).__name__, e)
+    return result
+
+
+def _format_result(request, planner, suggests):
+    result = _result_head(request)
+    result["stops"] = [
+        {
+            "night": night + 1,
+            "station": station_name,
+            "hotels": [
+                {"hotelcode": hotelcode, "name": planner.bundle.hotel_name(hotelcode)}
+                for hotelcode in hotels or []
+                if hotelcode != "none"
+            ],
+        }
+        for night, (station_name, hotels) in enumerate(suggests)
+    ]
+    return result
+
+
+# plans one request and returns the result as a json-serializable dict
+def plan_request(request):
+    try:
+        planner = _get_planner()
+        suggests = planner.plan_trip(
+            request["start"], request["goal"], parse_start_time(request["start_time"]), **_plan_options
+        )
+    except Exception as e:
+        return _error(_result_head(request), e)
+    return _format_result(request, planner, suggests)
+
+
+def _write(out, result):
+    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    out.flush()
+
+
+# plans every request and writes one jsonl line per trip as soon as it finishes
+# with workers > 1 the requests are spread over a process pool, so lines come out of order
+def run_batch(requests, out, workers=1):
+    if workers <= 1:
+        for request in requests:
+            _write(out, plan_request(request))
+        return
+    # compiled once here rather than by every worker finding it stale
+    data_bundle.load_bundle()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_configure, initargs=(dict(_plan_options),)
+    ) as executor:
+        futures = [executor.submit(plan_request, request) for request in requests]
+        for future in as_completed(futures):
+            _write(out, future.result())
+
+
+# pulls jobs from the queue until it is drained, planning each leased batch (one corridor)
+# with concurrent route searches; transient errors are retried, others are stored as results
+def run_worker(queue_path, batch_size=8, poll_seconds=5, max_concurrency=8):
+    queue = job_queue.JobQueue(queue_path)
+    worker = job_queue.worker_name()
+    planner = _get_planner()
+    shard = None
+    planned = 0
+    try:
+        while True:
+            jobs = queue.lease(worker, batch_size, prefer_shard=shard)
+            if not jobs:
+                if queue.drained():
+                    return planned
+                time.sleep(poll_seconds)
+                continue
+            shard = job_queue.shard_key(jobs[0][1])
+
+            trips = []
+            for id_, request in jobs:
+                try:
+                    trips.append((id_, request, parse_start_time(request["start_time"])))
+                except (KeyError, ValueError) as e:
+                    queue.complete(id_, _error(_result_head(request), e))
+            # the leases are renewed while the batch is planned
+            with job_queue.LeaseHeartbeat(
+                queue_path, worker, [id_ for id_, _, _ in trips], queue.lease_seconds
+            ):
+                results = planner.plan_trips(
+                    [(request["start"], request["goal"], start_time) for _, request, start_time in trips],
+                    max_concurrency=max_concurrency,
+                    **_plan_options
+                )
+            for (id_, request, _), result in zip(trips, results):
+                if is_transient(result):
+                    queue.fail(worker, id_, "{}: {}".format(type(result).__name__, result))
+                elif isinstance(result, BaseException):
+                    queue.complete(id_, _error(_result_head(request), result))
+                else:
+                    queue.complete(id_, _format_result(request, planner, result))
+                planned += 1
+    finally:
+        queue.close()
+
+
+# runs the given number of worker processes on the queue, returns when every job is done or failed for good
+def run_queue(queue_path, workers=1, batch_size=8):
+    if workers <= 1:
+        run_worker(queue_path, batch_size)
+        return
+    data_bundle.load_bundle()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_configure, initargs=(dict(_plan_options),)
+    ) as executor:
+        for future in [executor.submit(run_worker, queue_path, batch_size) for _ in range(workers)]:
+            future.result()
+
+
+# POST /plan with one json request returns one json result,
+# a jsonl body returns jsonl results streamed in request order
+# GET /metrics returns the prometheus text of the planner's metrics (when enabled)
+class PlanHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        sink = instrumentation.PrometheusSink()
+        sink.export(instrumentation.metrics.summary())
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.end_headers()
+        self.wfile.write(sink.text.encode("utf-8"))
+
+    def do_POST(self):
+        if self.path != "/plan":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        try:
+            requests = [json.loads(line) for line in body.splitlines() if line.strip()]
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_response(200)
+        if len(requests) == 1:
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(plan_request(requests[0]), ensure_ascii=False).encode("utf-8"))
+            return
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for request in requests:
+            self.wfile.write((json.dumps(plan_request(request), ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def _report_metrics():
+    instrumentation.metrics.export()
+    for sink in instrumentation.metrics.sinks:
+        if isinstance(sink, instrumentation.PrometheusSink):
+            sys.stderr.write(sink.text)
+
+
+def serve(host="127.0.0.1", port=8000):
+    _get_planner()
+    server = ThreadingHTTPServer((host, port), PlanHandler)
+    print("serving on http://{}:{}/plan".format(host, port), file=sys.stderr)
+    server.serve_forever()
+
+
+def run_queued(args):
+    if not args.join:
+        file_format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+        f = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8", newline="")
+        try:
+            queue = job_queue.JobQueue(args.queue)
+            added = queue.enqueue(read_requests(f, file_format))
+            print("enqueued {} new jobs".format(added), file=sys.stderr)
+            queue.close()
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    run_queue(args.queue, workers=args.workers, batch_size=args.batch_size)
+    if args.metrics:
+        _report_metrics()
+
+    queue = job_queue.JobQueue(args.queue)
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for result in queue.results():
+            _write(out, result)
+        print("jobs: {}".format(queue.stats()), file=sys.stderr)
+    finally:
+        queue.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="plan trips without a display")
+    parser.add_argument("input", nargs="?", default="-", help="jsonl or csv requests (default: stdin)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None)
+    parser.add_argument("--output", default="-", help="jsonl results (default: stdout)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--serve", action="store_true", help="run the http service instead")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--queue",
+        help="sqlite job queue: the input is enqueued, planned by the workers, and every result "
+        "in the queue is written to the output; other processes or machines can join with --join",
+    )
+    parser.add_argument(
+        "--join", action="store_true", help="only work on the jobs already in --queue, enqueue nothing"
+    )
+    parser.add_argument("--batch-size", type=int, default=8, help="jobs leased at a time per worker")
+    parser.add_argument(
+        "--local-router",
+        action="store_true",
+        help="predict each day on the offline JR graph and query the next day ahead of time",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="answer each day from the offline JR graph, confirmed by NAVITIME when it is reachable",
+    )
+    parser.add_argument(
+        "--speculative",
+        type=int,
+        default=0,
+        help="fire the next day's route searches of the top N stop options before the next start "
+        "is known; the speculation.* counters of --metrics show how many were used",
+    )
+    parser.add_argument(
+        "--metrics",
+        choices=["logging", "prometheus"],
+        help="record per-stage timings and counters of this process, printed to stderr after a batch",
+    )
+    args = parser.parse_args()
+    _configure(
+        {"local_router": args.local_router, "offline": args.offline, "speculative": args.speculative}
+    )
+
+    if args.metrics:
+        logging.basicConfig(level=logging.INFO)
+        instrumentation.enable(
+            instrumentation.LoggingSink()
+            if args.metrics == "logging"
+            else instrumentation.PrometheusSink()
+        )
+
+    if args.serve:
+        serve(args.host, args.port)
+        return
+
+    if args.queue:
+        run_queued(args)
+        return
+
+    file_format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+    f = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8", newline="")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        run_batch(read_requests(f, file_format), out, workers=args.workers)
+        if args.metrics:
+            _report_metrics()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
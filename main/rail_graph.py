@@ -0,0 +1,417 @@
+import datetime
+import heapq
+
+import numpy as np
+
+JR_STATIONS_PATH = "../data/stations/JR_station20230907free.csv"
+JR_LINES_PATH = "../data/stations/onlyJR_line20230824free.csv"
+
+# without a timetable, local trains are assumed to average this speed including stops
+# fitted with accuracy() on the recorded 品川 -> 仙台 routes: median error 1.5 min, worst 33 min
+# over 389 stations (40 km/h put 仙台 at 19:27 instead of 16:04)
+LOCAL_SPEED_KMH = 58
+RECORDINGS = ["../test_results.json"]
+# track length is longer than the straight line between stations
+DETOUR_FACTOR = 1.2
+TRANSFER_MINUTES = 5
+# a ride on one line is split into trains of at most this long, as NAVITIME's routes are
+# (the recorded local trains run 9 to 154 minutes)
+MAX_TRAIN_MINUTES = 150
+EARTH_RADIUS_M = 6371008.8
+# a station of the same name within this distance of a response's coordinates is that station
+NAME_MATCH_DISTANCE_M = 1000
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S+09:00"
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# optional timetable layer: departures and arrivals between adjacent stations
+# edges without a timetable use the graph's static travel time
+class Timetable:
+    def __init__(self):
+        self._trains = {}
+
+    # csv columns: from_station_cd, to_station_cd, departure, arrival (HH:MM)
+    @staticmethod
+    def from_csv(path):
+        import pandas as pd
+
+        timetable = Timetable()
+        timetable_df = pd.read_csv(path, dtype={"departure": str, "arrival": str})
+        for (from_cd, to_cd), trains_df in timetable_df.groupby(
+            ["from_station_cd", "to_station_cd"]
+        ):
+            timetable.add(
+                from_cd,
+                to_cd,
+                [_minutes(t) for t in trains_df["departure"]],
+                [_minutes(t) for t in trains_df["arrival"]],
+            )
+        return timetable
+
+    def add(self, from_station_cd, to_station_cd, departures, arrivals):
+        order = np.argsort(departures)
+        self._trains[(int(from_station_cd), int(to_station_cd))] = (
+            np.asarray(departures, dtype=np.int32)[order],
+            np.asarray(arrivals, dtype=np.int32)[order],
+        )
+
+    def __contains__(self, edge):
+        return edge in self._trains
+
+    # returns the arrival minute of the first train leaving at or after the given minute, or None
+    def arrival(self, from_station_cd, to_station_cd, minute):
+        departures, arrivals = self._trains[(from_station_cd, to_station_cd)]
+        i = np.searchsorted(departures, minute % (24 * 60))
+        if i == len(departures):
+            return None
+        day = minute - minute % (24 * 60)
+        arrival = arrivals[i] if arrivals[i] >= departures[i] else arrivals[i] + 24 * 60
+        return int(day + arrival)
+
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+# JR rail network as a CSR graph
+# nodes are (station, line) rows of JR_station20230907free.csv, travel edges join
+# neighbouring stations of a line and transfer edges join rows of the same station_g_cd
+# shinkansen lines are left out, like the unuse parameter of route_transit does
+class RailGraph:
+    def __init__(
+        self,
+        stations_path=JR_STATIONS_PATH,
+        lines_path=JR_LINES_PATH,
+        exclude_shinkansen=True,
+        node_ids=None,
+        timetable=None,
+        speed_kmh=LOCAL_SPEED_KMH,
+    ):
+        # only the graph build reads csv files with pandas, so importing the module stays light
+        import pandas as pd
+
+        line_df = pd.read_csv(lines_path)
+        if exclude_shinkansen:
+            line_df = line_df[~line_df["line_name"].str.contains("新幹線")]
+        station_df = pd.read_csv(stations_path)
+        station_df = station_df[
+            (station_df["e_status"] == 0) & station_df["line_cd"].isin(line_df["line_cd"])
+        ]
+        station_df = station_df.sort_values(["line_cd", "e_sort"]).reset_index(drop=True)
+
+        self.station_cds = station_df["station_cd"].to_numpy()
+        self.group_cds = station_df["station_g_cd"].to_numpy()
+        self.names = station_df["station_name"].to_numpy()
+        self.latitudes = station_df["lat"].to_numpy(dtype=float)
+        self.longitudes = station_df["lon"].to_numpy(dtype=float)
+        self.line_cds = station_df["line_cd"].to_numpy()
+        self.line_names = dict(zip(line_df["line_cd"], line_df["line_name"]))
+        self.timetable = timetable
+        self.speed_kmh = speed_kmh
+
+        # travel edges between neighbouring stations of the same line, both directions
+        n = len(station_df)
+        same_line = np.flatnonzero(self.line_cds[1:] == self.line_cds[:-1])
+        a, b = same_line, same_line + 1
+        minutes = (
+            haversine_m(
+                self.latitudes[a], self.longitudes[a], self.latitudes[b], self.longitudes[b]
+            )
+            * DETOUR_FACTOR
+            / (speed_kmh * 1000 / 60)
+        )
+        sources = [a, b]
+        targets = [b, a]
+        weights = [minutes, minutes]
+
+        # transfer edges between rows of the same physical station
+        group_order = np.argsort(self.group_cds, kind="stable")
+        groups = np.split(
+            group_order, np.flatnonzero(np.diff(self.group_cds[group_order])) + 1
+        )
+        transfer_pairs = [
+            (i, j) for group in groups if len(group) > 1 for i in group for j in group if i != j
+        ]
+        if transfer_pairs:
+            transfer_pairs = np.array(transfer_pairs)
+            sources.append(transfer_pairs[:, 0])
+            targets.append(transfer_pairs[:, 1])
+            weights.append(np.full(len(transfer_pairs), TRANSFER_MINUTES, dtype=float))
+
+        sources = np.concatenate(sources)
+        order = np.argsort(sources, kind="stable")
+        self.indices = np.concatenate(targets)[order].astype(np.int32)
+        self.weights = np.concatenate(weights)[order].astype(np.float32)
+        self.indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(sources, minlength=n)))
+        ).astype(np.int32)
+
+        self.group_nodes = {int(self.group_cds[group[0]]): group for group in groups}
+        self.name_groups = {}
+        for group_cd, name in zip(self.group_cds, self.names):
+            groups_of_name = self.name_groups.setdefault(name, [])
+            if group_cd not in groups_of_name:
+                groups_of_name.append(int(group_cd))
+
+        # NAVITIME node id <-> physical station (station_g_cd)
+        # node_ids (station name -> node id, e.g. StationResolver.node_id_table()) only seeds the
+        # names a single station has; the others are learned with their coordinates (learn_from_route)
+        self._groups_by_node_id = {}
+        self._node_ids_by_group = {}
+        for name, node_id in (node_ids or {}).items():
+            if len(self.name_groups.get(name, [])) == 1:
+                self._learn(self.name_groups[name][0], node_id)
+
+    def __len__(self):
+        return len(self.station_cds)
+
+    def _learn(self, group, node_id):
+        self._groups_by_node_id[node_id] = group
+        self._node_ids_by_group[group] = node_id
+
+    # the physical station (station_g_cd) of a station name, or None
+    # a name several stations share (福島, 郡山, 白石) is told apart by the coordinates, and
+    # without them it is not guessed; NAVITIME's own suffix (福島（福島県）) is dropped
+    def _locate(self, name, latitude=None, longitude=None):
+        name = str(name)
+        groups = self.name_groups.get(name) or self.name_groups.get(name.split("（")[0], [])
+        if not groups or latitude is None or longitude is None:
+            return groups[0] if len(groups) == 1 else None
+        nodes = [self.group_nodes[group][0] for group in groups]
+        distances = haversine_m(self.latitudes[nodes], self.longitudes[nodes], latitude, longitude)
+        best = int(np.argmin(distances))
+        return groups[best] if distances[best] <= NAME_MATCH_DISTANCE_M else None
+
+    # returns the graph nodes of a NAVITIME node id or a station name (with its coordinates
+    # when several stations have that name), empty when the station is not known
+    def nodes_of(self, station, latitude=None, longitude=None):
+        group = self._groups_by_node_id.get(station)
+        if group is None:
+            group = self._locate(station, latitude, longitude)
+        return self.group_nodes[group] if group is not None else []
+
+    # the NAVITIME node id of a node's station, None when it has not been learned
+    # (ids are never made up, as they would reach route_transit and the caches)
+    def node_id(self, node):
+        return self._node_ids_by_group.get(int(self.group_cds[node]))
+
+    # learns the node id of every station in a route_transit response from its coordinates
+    def learn_from_route(self, response):
+        for route in response.get("items", []):
+            for section in route.get("sections", []):
+                stations = [section] if section.get("type") == "point" else []
+                stations += section.get("transport", {}).get("calling_at", [])
+                for station in stations:
+                    node_id, coord = station.get("node_id"), station.get("coord") or {}
+                    if not node_id or node_id in self._groups_by_node_id:
+                        continue
+                    group = self._locate(station.get("name", ""), coord.get("lat"), coord.get("lon"))
+                    if group is not None:
+                        self._learn(group, node_id)
+
+    def _arrival(self, node, edge, minute):
+        target = self.indices[edge]
+        if self.timetable is not None:
+            key = (int(self.station_cds[node]), int(self.station_cds[target]))
+            if key in self.timetable:
+                return self.timetable.arrival(*key, minute)
+        return minute + float(self.weights[edge])
+
+    # earliest arrival dijkstra from any start node to any goal node
+    # returns a list of (node, arrival minute) along the path, or None
+    def shortest_path(self, start_nodes, goal_nodes, depart_minute=0):
+        arrival, previous, node = self._dijkstra(start_nodes, goal_nodes, depart_minute)
+        if node is None:
+            return None
+        path = [(node, float(arrival[node]))]
+        while previous[node] >= 0:
+            node = int(previous[node])
+            path.append((node, float(arrival[node])))
+        return path[::-1]
+
+    # earliest arrival minute at every node (inf where unreachable)
+    def arrivals(self, start_nodes, depart_minute=0):
+        return self._dijkstra(start_nodes, (), depart_minute)[0]
+
+    # returns the arrival and previous node arrays and the goal node reached (None if none was),
+    # searching every node when there are no goal nodes
+    def _dijkstra(self, start_nodes, goal_nodes, depart_minute):
+        goal_nodes = set(int(node) for node in goal_nodes)
+        arrival = np.full(len(self), np.inf)
+        previous = np.full(len(self), -1, dtype=np.int64)
+        heap = []
+        for node in start_nodes:
+            arrival[node] = depart_minute
+            heapq.heappush(heap, (depart_minute, int(node)))
+
+        while heap:
+            minute, node = heapq.heappop(heap)
+            if minute > arrival[node]:
+                continue
+            if node in goal_nodes:
+                return arrival, previous, node
+            for edge in range(self.indptr[node], self.indptr[node + 1]):
+                next_minute = self._arrival(node, edge, minute)
+                target = int(self.indices[edge])
+                if next_minute is not None and next_minute < arrival[target]:
+                    arrival[target] = next_minute
+                    previous[target] = node
+                    heapq.heappush(heap, (next_minute, target))
+        return arrival, previous, None
+
+    # answers a route_transit querystring locally
+    # returns a response in the same shape as test_results.json, or None if a station is unknown
+    def route_transit(self, querystring):
+        start_nodes = self.nodes_of(querystring["start"])
+        goal_nodes = self.nodes_of(querystring["goal"])
+        if len(start_nodes) == 0 or len(goal_nodes) == 0:
+            return None
+        start_time = querystring["start_time"]
+        if isinstance(start_time, str):
+            start_time = datetime.datetime.fromisoformat(start_time[:19])
+        midnight = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        depart_minute = (start_time - midnight).total_seconds() / 60
+
+        path = self.shortest_path(start_nodes, goal_nodes, depart_minute)
+        if path is None:
+            return {"items": []}
+        return {"items": [{"sections": self._sections(path, midnight)}]}
+
+    def _point(self, node):
+        point = {
+            "type": "point",
+            "coord": {"lat": float(self.latitudes[node]), "lon": float(self.longitudes[node])},
+            "name": self.names[node],
+        }
+        node_id = self.node_id(node)
+        if node_id is not None:
+            point["node_id"] = node_id
+        return point
+
+    # splits a path into point and move sections, one move per train: a line ridden for longer
+    # than MAX_TRAIN_MINUTES is split into several trains
+    def _sections(self, path, midnight):
+        def _time(minute):
+            return (midnight + datetime.timedelta(minutes=round(minute))).strftime(TIME_FORMAT)
+
+        runs = []
+        for (node, minute), (next_node, next_minute) in zip(path, path[1:]):
+            if self.group_cds[node] == self.group_cds[next_node]:
+                continue
+            if (
+                runs
+                and runs[-1][-1][0] == node
+                and self.line_cds[node] == self.line_cds[next_node]
+                and next_minute - runs[-1][0][1] <= MAX_TRAIN_MINUTES
+            ):
+                runs[-1].append((next_node, next_minute))
+            else:
+                runs.append([(node, minute), (next_node, next_minute)])
+
+        sections = [self._point(path[0][0])]
+        for run in runs:
+            line_name = self.line_names.get(self.line_cds[run[0][0]], "")
+            sections.append(
+                {
+                    "type": "move",
+                    "move": "local_train",
+                    "transport": {
+                        "name": line_name,
+                        "calling_at": [
+                            dict(self._point(node), from_time=_time(minute), to_time=_time(minute))
+                            for node, minute in run[1:-1]
+                        ],
+                    },
+                    "from_time": _time(run[0][1]),
+                    "to_time": _time(run[-1][1]),
+                    "time": round(run[-1][1] - run[0][1]),
+                    "line_name": line_name,
+                }
+            )
+            sections.append(self._point(run[-1][0]))
+        return sections
+
+
+# compares the graph's travel times with recorded route_transit responses: every station a
+# recorded route calls at is estimated from the route's first station at its departure time
+# returns a dict with the number of stations compared, the median and largest error in minutes
+# (estimate - recorded, so positive is too slow) and the speed that would have fitted them
+def accuracy(graph, responses):
+    errors = []
+    recorded_total = estimated_total = 0.0
+    for response in responses:
+        for route in response.get("items", []):
+            sections = route.get("sections", [])
+            moves = [section for section in sections if section.get("type") == "move"]
+            start_nodes = graph.nodes_of(*_station(sections[0])) if sections else []
+            if not moves or len(start_nodes) == 0:
+                continue
+            departure = datetime.datetime.fromisoformat(moves[0]["from_time"][:19])
+            midnight = departure.replace(hour=0, minute=0, second=0)
+            depart_minute = (departure - midnight).total_seconds() / 60
+            arrival = graph.arrivals(start_nodes, depart_minute)
+
+            recorded = []
+            for i, section in enumerate(sections):
+                if section.get("type") == "move":
+                    recorded += [
+                        (station, station.get("to_time"))
+                        for station in section.get("transport", {}).get("calling_at", [])
+                    ]
+                elif i > 0 and sections[i - 1].get("type") == "move":
+                    recorded.append((section, sections[i - 1].get("to_time")))
+            for station, to_time in recorded:
+                nodes = graph.nodes_of(*_station(station))
+                if not to_time or len(nodes) == 0 or not np.isfinite(arrival[nodes].min()):
+                    continue
+                recorded_minutes = (
+                    datetime.datetime.fromisoformat(to_time[:19]) - midnight
+                ).total_seconds() / 60 - depart_minute
+                estimated_minutes = float(arrival[nodes].min()) - depart_minute
+                errors.append(estimated_minutes - recorded_minutes)
+                recorded_total += recorded_minutes
+                estimated_total += estimated_minutes
+
+    errors = np.asarray(errors)
+    return {
+        "stations": len(errors),
+        "median_error_minutes": float(np.median(errors)) if len(errors) else None,
+        "max_error_minutes": float(errors[np.argmax(np.abs(errors))]) if len(errors) else None,
+        "fitted_speed_kmh": (
+            graph.speed_kmh * estimated_total / recorded_total if recorded_total else None
+        ),
+    }
+
+
+# (name, latitude, longitude) of a station in a response, for RailGraph.nodes_of
+def _station(station):
+    coord = station.get("coord") or {}
+    return station.get("name"), coord.get("lat"), coord.get("lon")
+
+
+# prints the accuracy of the graph against the recorded responses; run from the main directory
+def test(recordings=RECORDINGS):
+    import json
+
+    import station_resolver
+
+    responses = []
+    for path in recordings:
+        with open(path, encoding="utf-8") as f:
+            responses.append(json.load(f))
+    graph = RailGraph(node_ids=station_resolver.StationResolver().node_id_table())
+    print(accuracy(graph, responses))
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,165 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import instrumentation
+
+
+# two-tier cache for route_transit responses
+# responses are stored exactly as returned by the API (the same shape as test_results.json)
+# - memory tier: LRU with at most max_memory_entries responses
+# - disk tier (optional): SQLite file with a ttl and a total size limit, evicting the least recently used
+class RouteCache:
+    def __init__(
+        self,
+        path=None,
+        ttl=24 * 60 * 60,
+        max_memory_entries=256,
+        max_disk_bytes=200 * 1024 * 1024,
+        time_bucket_minutes=5,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.time_bucket_minutes = time_bucket_minutes
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS routes ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS routes_accessed_at ON routes (accessed_at)"
+            )
+            self._db.commit()
+
+    # returns the cache key of a route_transit querystring
+    # start_time is rounded down to time_bucket_minutes, unuse and options are order-insensitive
+    def make_key(self, querystring):
+        start_time = querystring["start_time"]
+        if isinstance(start_time, str):
+            start_time = datetime.datetime.fromisoformat(start_time[:19])
+        bucket = start_time.replace(second=0, microsecond=0)
+        bucket -= datetime.timedelta(minutes=bucket.minute % self.time_bucket_minutes)
+
+        key = {
+            name: ".".join(sorted(str(value).split(".")))
+            if name in ("unuse", "options")
+            else str(value)
+            for name, value in querystring.items()
+            if name != "start_time"
+        }
+        key["start_time"] = bucket.strftime("%Y-%m-%dT%H:%M")
+        return json.dumps(key, sort_keys=True, ensure_ascii=False)
+
+    # returns the cached response for the querystring, or None
+    def get(self, querystring):
+        key = self.make_key(querystring)
+        with self._lock:
+            if key in self._memory:
+                response, created_at = self._memory[key]
+                if time.time() - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    instrumentation.count("route_cache.memory_hits")
+                    return response
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT response, created_at FROM routes WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and time.time() - row[1] <= self.ttl:
+                    self._db.execute(
+                        "UPDATE routes SET accessed_at = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    self._db.commit()
+                    response = json.loads(row[0])
+                    self._remember(key, response, row[1])
+                    self.disk_hits += 1
+                    instrumentation.count("route_cache.disk_hits")
+                    return response
+
+            self.misses += 1
+            instrumentation.count("route_cache.misses")
+            return None
+
+    def put(self, querystring, response):
+        key = self.make_key(querystring)
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._db is not None:
+                text = json.dumps(response, ensure_ascii=False)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?)",
+                    (key, text, len(text.encode("utf-8")), now, now),
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def _remember(self, key, response, created_at):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    # drops expired rows, then the least recently used rows until the file fits max_disk_bytes
+    def _evict_disk(self, now):
+        self._db.execute("DELETE FROM routes WHERE created_at < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM routes").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self._db.execute(
+            "SELECT key, size FROM routes ORDER BY accessed_at"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            self._db.execute("DELETE FROM routes WHERE key = ?", (key,))
+            total -= size
+
+    # stores a recorded route_transit response (e.g. test_results.json) for the querystring
+    def load_fixture(self, path, querystring):
+        with open(path, encoding="utf-8") as f:
+            self.put(querystring, json.load(f))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM routes")
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,236 @@
+import datetime
+import json
+import time
+from functools import lru_cache
+
+# orjson and ijson are optional, the standard json module is used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# parses the fixed "YYYY-MM-DDTHH:MM:SS+09:00" format of route_transit (the offset is dropped)
+# the same timestamps repeat across sections and calling_at entries, so results are cached
+@lru_cache(maxsize=4096)
+def parse_time(time_str):
+    return datetime.datetime(
+        int(time_str[0:4]),
+        int(time_str[5:7]),
+        int(time_str[8:10]),
+        int(time_str[11:13]),
+        int(time_str[14:16]),
+        int(time_str[17:19]),
+    )
+
+
+class Stop:
+    __slots__ = ("name", "node_id", "lat", "lon", "to_time")
+
+    def __init__(self, name, node_id, lat, lon, to_time=None):
+        self.name = name
+        self.node_id = node_id
+        self.lat = lat
+        self.lon = lon
+        self.to_time = to_time
+
+    @staticmethod
+    def from_json(station):
+        coord = station.get("coord") or {}
+        to_time = station.get("to_time")
+        return Stop(
+            station.get("name"),
+            station.get("node_id"),
+            coord.get("lat"),
+            coord.get("lon"),
+            parse_time(to_time) if to_time else None,
+        )
+
+    # the stop option dict used by StopOptionsLister and TripPlanner
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "node_id": self.node_id,
+            "coord": {"lat": self.lat, "lon": self.lon},
+        }
+
+
+# a point section has a stop, a move section has an arrival time and the stations it calls at
+class Section:
+    __slots__ = ("type", "stop", "to_time", "calling_at")
+
+    def __init__(self, type, stop=None, to_time=None, calling_at=()):
+        self.type = type
+        self.stop = stop
+        self.to_time = to_time
+        self.calling_at = calling_at
+
+    @staticmethod
+    def from_json(section):
+        if section.get("type") == "point":
+            return Section("point", stop=Stop.from_json(section))
+        to_time = section.get("to_time") or section.get("arrival", {}).get("time")
+        return Section(
+            section.get("type"),
+            to_time=parse_time(to_time) if to_time else None,
+            calling_at=[
+                Stop.from_json(station)
+                for station in section.get("transport", {}).get("calling_at", [])
+            ],
+        )
+
+
+# returns the first route of a route_transit response as a list of sections, or None
+# res may be the decoded dict, the raw bytes/str of the response, or a binary file object
+# a file is read incrementally with ijson when it is installed, so only items[0] is decoded
+def first_route(res):
+    if hasattr(res, "read"):
+        if ijson is not None:
+            for route in ijson.items(res, "items.item", use_float=True):
+                return [Section.from_json(section) for section in route.get("sections", [])]
+            return None
+        res = res.read()
+    if isinstance(res, (bytes, str)):
+        res = orjson.loads(res) if orjson is not None else json.loads(res)
+    items = res.get("items")
+    if not items:
+        return None
+    return [Section.from_json(section) for section in items[0].get("sections", [])]
+
+
+# returns every route of a route_transit response as lists of sections (the decoded dict only)
+def all_routes(res):
+    return [
+        [Section.from_json(section) for section in route.get("sections", [])]
+        for route in res.get("items") or []
+    ]
+
+
+# picks the day's stop options out of the first route
+# the stop is the station before the first move that ends past max_travel_time minutes
+# or after latest_stop_time o'clock, plus the stations the previous train called at
+# within window_minutes before it
+# returns a tuple of stop option dicts (unique by node_id) and the terminal station's node id
+def stop_options(
+    sections, start_time, max_travel_time, latest_stop_time, window_minutes=40
+):
+    stops, terminal_station = _route_stops(
+        sections, start_time, max_travel_time, latest_stop_time, window_minutes
+    )
+    return [stop.to_dict() for stop in stops], terminal_station
+
+
+# the candidates of stop_options over every route of a response, unique by node_id
+# returns a tuple of Stop objects, the terminal station's node id of the route each came from
+# (the first route having it) and the first route's terminal station's node id
+def candidate_stops(
+    routes, start_time, max_travel_time, latest_stop_time, window_minutes=40
+):
+    candidates = {}
+    first_terminal = None
+    for i, sections in enumerate(routes):
+        stops, terminal_station = _route_stops(
+            sections, start_time, max_travel_time, latest_stop_time, window_minutes
+        )
+        if i == 0:
+            first_terminal = terminal_station
+        for stop in stops:
+            candidates.setdefault(stop.node_id, (stop, terminal_station))
+    stops = [stop for stop, _ in candidates.values()]
+    terminals = [terminal_station for _, terminal_station in candidates.values()]
+    return stops, terminals, first_terminal
+
+
+# returns a tuple of Stop objects (unique by node_id) and the terminal station's node id
+def _route_stops(sections, start_time, max_travel_time, latest_stop_time, window_minutes):
+    if not sections:
+        return [], None
+
+    stops = []
+    travel_time = 0
+    last_section_id = None
+    terminal_station = None
+    previous_start_time = start_time
+
+    for section_id, section in enumerate(sections):
+        if section.type != "move" or section.to_time is None:
+            continue
+        travel_time += (section.to_time - previous_start_time).total_seconds() // 60
+        previous_start_time = section.to_time
+
+        if travel_time > max_travel_time or section.to_time.hour > latest_stop_time:
+            previous_section = sections[section_id - 1] if section_id > 0 else None
+            if previous_section is not None and previous_section.stop is not None:
+                stops.append(previous_section.stop)
+                last_section_id = section_id - 2
+                terminal_station = previous_section.stop.node_id
+            break
+
+    if last_section_id is None or last_section_id < 0:
+        return stops, terminal_station
+
+    terminal_section = sections[last_section_id]
+    for station in terminal_section.calling_at:
+        if station.to_time is None or terminal_section.to_time is None:
+            continue
+        if (terminal_section.to_time - station.to_time).total_seconds() < window_minutes * 60:
+            stops.append(station)
+
+    unique_stops = {}
+    for stop in stops:
+        if stop.node_id is not None:
+            unique_stops.setdefault(stop.node_id, stop)
+    return list(unique_stops.values()), terminal_station
+
+
+# micro-benchmark of the parsing steps against the recorded response
+# run from the main directory
+def benchmark(path="../test_results.json", repeat=200):
+    with open(path, "rb") as f:
+        raw = f.read()
+    res = json.loads(raw)
+    timestamps = [
+        value
+        for route in res["items"]
+        for section in route["sections"]
+        for value in [section.get("to_time")]
+        + [station.get("to_time") for station in section.get("transport", {}).get("calling_at", [])]
+        if value
+    ]
+    start_time = parse_time(timestamps[0]).replace(hour=9, minute=0)
+
+    def _time(function):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - started) / repeat * 1000
+
+    results = {
+        "json.loads": _time(lambda: json.loads(raw)),
+        "strptime (all timestamps)": _time(
+            lambda: [
+                datetime.datetime.strptime(t, "%Y-%m-%dT%H:%M:%S+09:00") for t in timestamps
+            ]
+        ),
+        "parse_time (all timestamps, uncached)": _time(
+            lambda: [parse_time.__wrapped__(t) for t in timestamps]
+        ),
+        "first_route (decoded dict)": _time(lambda: first_route(res)),
+        "first_route + stop_options (raw bytes)": _time(
+            lambda: stop_options(first_route(raw), start_time, 60 * 6, 19)
+        ),
+    }
+    if orjson is not None:
+        results["orjson.loads"] = _time(lambda: orjson.loads(raw))
+
+    print("{} bytes, {} routes, {} timestamps".format(len(raw), len(res["items"]), len(timestamps)))
+    for label, milliseconds in results.items():
+        print("{}: {:.3f} ms".format(label, milliseconds))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,31 +1,30 @@
-import requests
 import datetime
-import os
-from dotenv import load_dotenv
-load_dotenv()
 
-RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
+import instrumentation
+import navitime_session
+import route_parser
 
-# 兼容带/不带时区的时间解析
 def datetime_to_str(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%S")
 
-def str_to_datetime(time_str):
-    try:
-        # 优先解析带时区的格式（API 标准返回）
-        return datetime.datetime.strptime(time_str, "%Y-%m-%dT%H:%M:%S+09:00")
-    except ValueError:
-        # 兼容无时区的格式
-        return datetime.datetime.strptime(time_str, "%Y-%m-%dT%H:%M:%S")
-
 class StopOptionsLister:
     def __init__(
-        self, start, goal, start_time, max_travel_time=60 * 6, latest_stop_time=19
+        self,
+        start,
+        goal,
+        start_time,
+        max_travel_time=60 * 6,
+        latest_stop_time=19,
+        route_cache=None,
+        station_resolver=None,
+        client=None,
     ):
-        self._headers = {
-            "X-RapidAPI-Key": RAPIDAPI_KEY,
-            "X-RapidAPI-Host": "navitime-transport.p.rapidapi.com",
-        }
+        # 共享的 HTTP 客户端（navitime_session.NavitimeClient：连接池、超时、重试、合并相同请求）
+        self.client = client or navitime_session.default_client()
+        # route_transit 响应缓存（route_cache.RouteCache，None 表示不缓存）
+        self.route_cache = route_cache
+        # 本地站名解析（station_resolver.StationResolver，None 表示每次调用 API）
+        self.station_resolver = station_resolver
         # 修复1：站点ID获取增加容错（避免无结果时报错）
         self.start_station = self._station_name_to_id(start)
         self.goal_station = self._station_name_to_id(goal)
@@ -37,29 +36,31 @@ class StopOptionsLister:
         self.latest_stop_time = latest_stop_time  # 最晚停留时间（小时）
         self.stop_options_lists = []  # 每日停留站点列表
 
+    @instrumentation.timed("station_name_to_id")
     def _station_name_to_id(self, station_name):
         """站点名称转ID（增加空值校验）"""
-        url = "https://navitime-transport.p.rapidapi.com/transport_node"
-        querystring = {"word": station_name}
+        if self.station_resolver is not None:
+            node_id = self.station_resolver.resolve(station_name)
+            if node_id:
+                return node_id
+        # 重试用尽后的网络/HTTP 错误直接抛出，不当作「未找到」
         try:
-            response = requests.get(url, headers=self._headers, params=querystring)
-            response.raise_for_status()  # 捕获HTTP错误
-            items = response.json().get("items", [])
-            return items[0]["id"] if items else None
-        except (requests.exceptions.RequestException, IndexError, KeyError):
+            node_id = self.client.station_name_to_id(station_name)
+        except (IndexError, KeyError):
+            node_id = None
+        if not node_id:
             print(f"警告：站点「{station_name}」未找到，请核对名称")
             return None
+        if self.station_resolver is not None:
+            self.station_resolver.learn(station_name, node_id)
+        return node_id
 
     def get_stop_options_lists(self):
         return self.stop_options_lists
 
     # 搜索路线（严格按API规范解析字段）
+    @instrumentation.timed("search_route")
     def search_route(self, start, goal, start_time):
-        url = "https://navitime-route-totalnavi.p.rapidapi.com/route_transit"
-        headers = {
-            "X-RapidAPI-Key": RAPIDAPI_KEY,
-            "X-RapidAPI-Host": "navitime-route-totalnavi.p.rapidapi.com",
-        }
         querystring = {
             "unuse": "domestic_flight.superexpress_train.sleeper_ultraexpress.ultraexpress_train.express_train.semiexpress_train.shuttle_bus",
             "options": "railway_calling_at",
@@ -67,13 +68,18 @@ class StopOptionsLister:
             "goal": goal,
             "start_time": datetime_to_str(start_time)
         }
-        try:
-            response = requests.get(url, headers=headers, params=querystring)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"路线搜索失败：{e}")
-            return {"items": []}
+        if self.route_cache is not None:
+            cached = self.route_cache.get(querystring)
+            if cached is not None:
+                return cached
+        # 重试用尽后抛出异常，避免把临时故障当成「没有路线」而提前结束行程
+        result = self.client.route_transit(querystring)
+        # 只缓存有结果的响应
+        if self.route_cache is not None and result.get("items"):
+            self.route_cache.put(querystring, result)
+        if self.station_resolver is not None:
+            self.station_resolver.learn_from_route(result)
+        return result
 
     # 生成每日停留站点列表
     def list_stop_stations(self):
@@ -94,73 +100,16 @@ class StopOptionsLister:
 
         return self.stop_options_lists
 
-    # 获取下一批停留站点（核心字段修复）
+    # 获取下一批停留站点（按 test_results.json 的实际响应格式解析，按 node_id 去重）
+    @instrumentation.timed("next_stop_stations")
     def next_stop_stations(self, start, goal, start_time):
         res = self.search_route(start, goal, start_time)
-        # 容错：无路线结果时直接返回空
-        if not res.get("items"):
-            return [], None
-        route = res["items"][0]
-        stop_options = []
-        travel_time = 0
-        last_section_id = None
-        terminal_station = None
-        previous_start_time = start_time
-
-        for section_id, section in enumerate(route.get("sections", [])):
-            # 仅处理「移动」类型的section
-            if section.get("type") != "move":
-                continue
-            # 修复3：使用API规范的departure/arrival字段
-            departure = section.get("departure", {})
-            arrival = section.get("arrival", {})
-            # 过滤无时间信息的无效section
-            if not departure.get("time") or not arrival.get("time"):
-                continue
-
-            # 计算行程耗时
-            section_to_time = str_to_datetime(arrival["time"])
-            duration = (section_to_time - previous_start_time).total_seconds() // 60
-            travel_time += duration
-            previous_start_time = section_to_time
-
-            # 判断是否需要停留
-            if travel_time > self.max_travel_time or section_to_time.hour > self.latest_stop_time:
-                # 取上一个section的站点作为停留点
-                prev_section = route["sections"][section_id - 1] if section_id > 0 else {}
-                prev_arrival = prev_section.get("arrival", {})
-                if prev_arrival.get("name") and prev_arrival.get("node_id"):
-                    stop_options.append({
-                        "name": prev_arrival["name"],
-                        "node_id": prev_arrival["node_id"],
-                        "coord": prev_arrival.get("coord", {"lat": None, "lon": None})
-                    })
-                    last_section_id = section_id - 2
-                    terminal_station = prev_arrival["node_id"]
-                break
-
-        # 补充途经站（过滤无效calling_at数据）
-        if last_section_id is not None and last_section_id >= 0:
-            transport = route["sections"][last_section_id].get("transport", {})
-            calling_at = transport.get("calling_at", [])
-            terminal_section = route["sections"][last_section_id]
-            terminal_to_time = str_to_datetime(terminal_section["arrival"]["time"])
-            
-            for station in calling_at:
-                if not station.get("to_time"):
-                    continue
-                to_time = str_to_datetime(station["to_time"])
-                # 40分钟内的途经站加入候选
-                if (terminal_to_time - to_time).total_seconds() < 40 * 60:
-                    stop_options.append({
-                        "name": station["name"],
-                        "node_id": station["node_id"],
-                        "coord": station.get("coord", {"lat": None, "lon": None})
-                    })
-
-        # 去重（避免重复站点）
-        stop_options = [dict(t) for t in {tuple(d.items()) for d in stop_options}]
-        return stop_options, terminal_station
+        return route_parser.stop_options(
+            route_parser.first_route(res),
+            start_time,
+            self.max_travel_time,
+            self.latest_stop_time,
+        )
 
 # 测试代码
 def main():
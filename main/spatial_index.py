@@ -0,0 +1,175 @@
+import numpy as np
+
+# mean earth radius used by the haversine formula
+EARTH_RADIUS_M = 6371008.8
+# length of one degree of latitude
+METERS_PER_DEGREE = 111_195.0
+# haversine differs from the WGS-84 geodesic by less than 0.6 %
+HAVERSINE_ERROR = 0.006
+
+
+# vectorized great circle distance in meters
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# grid index over (latitude, longitude) points
+# points are bucketed into square cells of cell_size_m and sorted by cell,
+# so a radius query only looks at the few cells around the query point
+class SpatialIndex:
+    def __init__(self, latitudes, longitudes, cell_size_m=1000):
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        valid = ~(np.isnan(latitudes) | np.isnan(longitudes))
+
+        self.cell_deg = cell_size_m / METERS_PER_DEGREE
+        positions = np.flatnonzero(valid)
+        rows, cols = self._cell(latitudes[valid], longitudes[valid])
+        order = np.lexsort((cols, rows))
+
+        # original row positions and coordinates, sorted by cell
+        self.positions = positions[order]
+        self.latitudes = latitudes[valid][order]
+        self.longitudes = longitudes[valid][order]
+
+        # cell -> (start, end) slice into the sorted arrays
+        rows, cols = rows[order], cols[order]
+        change = np.flatnonzero(np.diff(rows) | np.diff(cols)) + 1
+        starts = np.concatenate(([0], change))
+        ends = np.concatenate((change, [len(order)]))
+        self.cells = {
+            (int(rows[s]), int(cols[s])): (int(s), int(e))
+            for s, e in zip(starts, ends)
+        }
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell(self, latitude, longitude):
+        return (
+            np.floor(np.asarray(latitude) / self.cell_deg).astype(np.int64),
+            np.floor(np.asarray(longitude) / self.cell_deg).astype(np.int64),
+        )
+
+    # returns the sorted-array indices of all points in cells overlapping the circle
+    def _candidates(self, latitude, longitude, radius_m):
+        lat_span = radius_m / METERS_PER_DEGREE
+        lon_span = lat_span / max(np.cos(np.radians(abs(latitude) + lat_span)), 1e-6)
+        row_min, col_min = self._cell(latitude - lat_span, longitude - lon_span)
+        row_max, col_max = self._cell(latitude + lat_span, longitude + lon_span)
+        slices = [
+            self.cells[(row, col)]
+            for row in range(int(row_min), int(row_max) + 1)
+            for col in range(int(col_min), int(col_max) + 1)
+            if (row, col) in self.cells
+        ]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(s, e) for s, e in slices])
+
+    # returns a tuple of original row positions and distances in meters
+    # of all points within radius_m from the given latitude and longitude
+    # if exact is True, points near the boundary are re-checked with geopy's geodesic
+    def query_radius(self, latitude, longitude, radius_m, exact=False):
+        candidates = self._candidates(latitude, longitude, radius_m)
+        distances = haversine_m(
+            latitude, longitude, self.latitudes[candidates], self.longitudes[candidates]
+        )
+        if not exact:
+            inside = distances <= radius_m
+            return self.positions[candidates[inside]], distances[inside]
+
+        inside = distances <= radius_m * (1 + HAVERSINE_ERROR)
+        candidates, distances = candidates[inside], distances[inside]
+        border = np.flatnonzero(distances > radius_m * (1 - HAVERSINE_ERROR))
+        if len(border):
+            from geopy.distance import geodesic
+
+            for i in border:
+                distances[i] = geodesic(
+                    (self.latitudes[candidates[i]], self.longitudes[candidates[i]]),
+                    (latitude, longitude),
+                ).m
+            inside = distances <= radius_m
+            candidates, distances = candidates[inside], distances[inside]
+        return self.positions[candidates], distances
+
+    # radius query for many points at once, with a single haversine over all candidate pairs
+    # returns a tuple of query indices, original row positions and distances in meters
+    def query_radius_many(self, latitudes, longitudes, radius_m):
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        candidates = [
+            self._candidates(latitude, longitude, radius_m)
+            if not (np.isnan(latitude) or np.isnan(longitude))
+            else np.empty(0, dtype=np.int64)
+            for latitude, longitude in zip(latitudes, longitudes)
+        ]
+        counts = np.array([len(c) for c in candidates], dtype=np.int64)
+        queries = np.repeat(np.arange(len(candidates)), counts)
+        if not len(queries):
+            return queries, queries.copy(), np.empty(0)
+        candidates = np.concatenate(candidates)
+        distances = haversine_m(
+            latitudes[queries],
+            longitudes[queries],
+            self.latitudes[candidates],
+            self.longitudes[candidates],
+        )
+        inside = distances <= radius_m
+        return queries[inside], self.positions[candidates[inside]], distances[inside]
+
+
+# compares the index against the row-wise geodesic scan it replaces
+# run from the main directory
+def test(sample_size=50, radius_m=100):
+    import pandas as pd
+    from geopy.distance import geodesic
+
+    nearest_station_df = pd.read_csv("../data/hotels/nearest_station.csv")
+    station_df = pd.read_csv("../data/stations/JR_station20230907free.csv")
+    index = SpatialIndex(
+        nearest_station_df["nearest_station_latitude"],
+        nearest_station_df["nearest_station_longitude"],
+    )
+
+    sample = station_df.sample(min(sample_size, len(station_df)), random_state=0)
+    mismatches = 0
+    max_error = 0.0
+    for _, station in sample.iterrows():
+        expected = nearest_station_df.apply(
+            lambda row: geodesic(
+                (row["nearest_station_latitude"], row["nearest_station_longitude"]),
+                (station["lat"], station["lon"]),
+            ).m
+            if not row.isnull().any()
+            else 1000,
+            axis=1,
+        )
+        expected_codes = set(nearest_station_df[expected <= radius_m]["hotelcode"])
+        positions, distances = index.query_radius(
+            station["lat"], station["lon"], radius_m, exact=True
+        )
+        actual_codes = set(nearest_station_df["hotelcode"].iloc[positions])
+        if expected_codes != actual_codes:
+            mismatches += 1
+
+        positions, distances = index.query_radius(station["lat"], station["lon"], 1000)
+        reference = expected.iloc[positions].to_numpy()
+        nonzero = reference > 0
+        if nonzero.any():
+            error = np.abs(distances - reference)[nonzero] / reference[nonzero]
+            max_error = max(max_error, float(error.max()))
+
+    print("stations checked: {}".format(len(sample)))
+    print("mismatched hotel sets: {}".format(mismatches))
+    print("max relative haversine error: {:.5f}".format(max_error))
+
+
+if __name__ == "__main__":
+    test()
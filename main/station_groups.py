@@ -0,0 +1,180 @@
+import csv
+import math
+import os
+
+import numpy as np
+
+from spatial_index import SpatialIndex, haversine_m
+
+STATION_GROUPS_PATH = "../data/stations/station_groups.csv"
+LINES_PATH = "../data/stations/line20230824free.csv"
+NODE_IDS_PATH = "../data/stations/navitime_node_ids.csv"
+LEARNED_NODE_IDS_PATH = "../data/cache/navitime_node_ids.csv"
+
+# company_cd of the six JR passenger companies, as in make_JRline_data
+JR_COMPANY_CDS = range(1, 7)
+# a stop further than this from the station of its name is matched by coordinates instead
+NAME_MATCH_DISTANCE_M = 500
+# stops matched by coordinates must be this close to the station, as the planner's 100 m hotel fallback
+FALLBACK_RADIUS_M = 100
+
+
+# the physical stations of station_groups.csv (loading/stations/make_station_groups.py),
+# with one bitset per station over the lines calling there
+# - line_bits: uint64 words, bit i of a station is set when self.line_cds[i] calls there
+# - line_mask / select: filter stations by line, company or line name at query time
+# - locate: the station a route's stop (name, latitude, longitude) is, also when NAVITIME's
+#   name differs from the csv (福島（福島県） is 福島 here)
+# groups and lines are lists of csv row dicts, read without pandas as the planner loads them at start
+class StationGroups:
+    def __init__(self, groups, lines):
+        lines = sorted(lines, key=lambda line: int(line["line_cd"]))
+        self.line_cds = np.array([int(line["line_cd"]) for line in lines], dtype=np.int64)
+        self.line_company_cds = np.array([int(line["company_cd"]) for line in lines], dtype=np.int64)
+        self.line_names = [line["line_name"] for line in lines]
+
+        line_positions = {line_cd: i for i, line_cd in enumerate(self.line_cds)}
+        self.line_bits = np.zeros((len(groups), (len(self.line_cds) + 63) // 64), np.uint64)
+        for row, group in enumerate(groups):
+            for line_cd in str(group["line_cds"]).split():
+                position = line_positions.get(int(line_cd))
+                if position is not None:
+                    self.line_bits[row, position // 64] |= np.uint64(1) << np.uint64(position % 64)
+
+        self.g_cds = np.array([int(group["station_g_cd"]) for group in groups], dtype=np.int64)
+        self.names = np.array([group["station_name"] for group in groups], dtype=object)
+        self.latitudes = np.array([_float(group["lat"]) for group in groups], dtype=float)
+        self.longitudes = np.array([_float(group["lon"]) for group in groups], dtype=float)
+        self.e_status = np.array([int(group["e_status"]) for group in groups], dtype=np.int64)
+        self.node_ids = [group.get("node_id") or None for group in groups]
+        self.index = SpatialIndex(self.latitudes, self.longitudes)
+
+        self._rows_by_name = {}
+        for row, name in enumerate(self.names):
+            self._rows_by_name.setdefault(name, []).append(row)
+        # a node id learned for a name several stations share (e.g. 大久保) tells none of them apart
+        rows_by_node_id = {}
+        for row, node_id in enumerate(self.node_ids):
+            if node_id is not None:
+                rows_by_node_id.setdefault(node_id, []).append(row)
+        self._row_by_node_id = {
+            node_id: rows[0] for node_id, rows in rows_by_node_id.items() if len(rows) == 1
+        }
+
+    def __len__(self):
+        return len(self.g_cds)
+
+    # bitset of the lines matching every given condition (None matches any)
+    def line_mask(self, line_cds=None, company_cds=None, line_name_contains=None):
+        selected = np.ones(len(self.line_cds), dtype=bool)
+        if line_cds is not None:
+            selected &= np.isin(self.line_cds, list(line_cds))
+        if company_cds is not None:
+            selected &= np.isin(self.line_company_cds, list(company_cds))
+        if line_name_contains is not None:
+            selected &= np.array([line_name_contains in name for name in self.line_names], dtype=bool)
+        mask = np.zeros(self.line_bits.shape[1], np.uint64)
+        for position in np.flatnonzero(selected):
+            mask[position // 64] |= np.uint64(1) << np.uint64(position % 64)
+        return mask
+
+    # boolean array of the stations served by at least one line of the mask
+    def on_lines(self, mask):
+        return (self.line_bits & mask).any(axis=1)
+
+    # rows of the stations on the mask's lines (every station when mask is None),
+    # open ones only unless include_closed
+    def select(self, mask=None, include_closed=False):
+        selected = np.ones(len(self), dtype=bool) if mask is None else self.on_lines(mask)
+        if not include_closed:
+            selected &= self.e_status == 0
+        return np.flatnonzero(selected)
+
+    def jr_mask(self):
+        return self.line_mask(company_cds=JR_COMPANY_CDS)
+
+    # returns the row of the station a stop is, or None
+    # node id first, then the station of the same name nearest the stop (within NAME_MATCH_DISTANCE_M),
+    # then the nearest station within FALLBACK_RADIUS_M
+    def locate(self, name, latitude=None, longitude=None, node_id=None):
+        if node_id is not None and node_id in self._row_by_node_id:
+            return self._row_by_node_id[node_id]
+        rows = self._rows_by_name.get(name, [])
+        if latitude is None or longitude is None or math.isnan(latitude) or math.isnan(longitude):
+            return rows[0] if len(rows) == 1 else None
+        if rows:
+            distances = haversine_m(self.latitudes[rows], self.longitudes[rows], latitude, longitude)
+            best = int(np.argmin(distances))
+            if distances[best] <= NAME_MATCH_DISTANCE_M:
+                return rows[best]
+        positions, distances = self.index.query_radius(latitude, longitude, FALLBACK_RADIUS_M)
+        if len(positions) == 0:
+            return None
+        return int(positions[np.argmin(distances)])
+
+    # station_g_cd of the station a stop is, or None
+    def g_cd(self, name, latitude=None, longitude=None, node_id=None):
+        row = self.locate(name, latitude, longitude, node_id)
+        return None if row is None else int(self.g_cds[row])
+
+    # stop option dicts with one stop per physical station, in order
+    # a stop is kept unless an earlier one is the same station
+    def dedup(self, stop_options):
+        unique = {}
+        for stop in stop_options:
+            coord = stop.get("coord") or {}
+            row = self.locate(stop["name"], coord.get("lat"), coord.get("lon"), stop.get("node_id"))
+            unique.setdefault(("row", row) if row is not None else ("node", stop.get("node_id")), stop)
+        return list(unique.values())
+
+
+# returns the station groups, or None until make_station_groups.py has been run
+# node ids shipped or learned by station_resolver since the groups were built are filled in
+def load_station_groups(
+    station_groups_path=STATION_GROUPS_PATH,
+    lines_path=LINES_PATH,
+    node_ids_paths=(LEARNED_NODE_IDS_PATH, NODE_IDS_PATH),
+):
+    if not os.path.exists(station_groups_path):
+        return None
+    groups = _read_csv(station_groups_path)
+    for node_ids_path in node_ids_paths:
+        if not os.path.exists(node_ids_path):
+            continue
+        # the last id of a name wins, as later rows were learned later
+        node_ids = {row["station_name"]: row["node_id"] for row in _read_csv(node_ids_path)}
+        for group in groups:
+            if not group.get("node_id"):
+                group["node_id"] = node_ids.get(group["station_name"])
+    return StationGroups(groups, _read_csv(lines_path))
+
+
+def _read_csv(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def _float(value):
+    return float(value) if value not in (None, "") else math.nan
+
+
+def test():
+    import time
+
+    groups = load_station_groups()
+    jr = groups.jr_mask()
+    jr_east = groups.line_mask(company_cds=[2])
+    print(
+        "{} stations, {} on JR lines, {} on JR East lines".format(
+            len(groups), len(groups.select(jr)), len(groups.select(jr_east))
+        )
+    )
+    started = time.perf_counter()
+    for name, latitude, longitude in [("福島（福島県）", 37.754123, 140.45968), ("東京", 35.681391, 139.766103)]:
+        row = groups.locate(name, latitude, longitude)
+        print(name, "->", groups.names[row], groups.g_cds[row])
+    print("{:.2f} ms".format((time.perf_counter() - started) * 1000))
+
+
+if __name__ == "__main__":
+    test()
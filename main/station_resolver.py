@@ -0,0 +1,176 @@
+import asyncio
+import bisect
+import csv
+import difflib
+import os
+import threading
+import unicodedata
+
+STATIONS_PATH = "../data/stations/station20230907free.csv"
+# node ids shipped with the repository, read only
+NODE_IDS_PATH = "../data/stations/navitime_node_ids.csv"
+# node ids learned at run time, kept out of the tracked data
+LEARNED_NODE_IDS_PATH = "../data/cache/navitime_node_ids.csv"
+
+# stations sharing a name more than this many degrees apart are different stations
+AMBIGUOUS_SPAN_DEG = 0.02
+
+
+# NFKC, no surrounding spaces and no trailing 駅
+def normalize_name(name):
+    name = unicodedata.normalize("NFKC", str(name)).strip()
+    if len(name) > 1 and name.endswith("駅"):
+        name = name[:-1]
+    return name
+
+
+# normalized name with hiragana turned into katakana
+def normalize_kana(name):
+    return "".join(
+        chr(ord(c) + 0x60) if "ぁ" <= c <= "ゖ" else c for c in normalize_name(name)
+    )
+
+
+def normalize_romaji(name):
+    return normalize_name(name).lower().replace(" ", "").replace("-", "")
+
+
+# resolves station names typed by users to NAVITIME node ids without calling transport_node
+# names are matched against the local station csv (exact, kana, romaji, prefix, then fuzzy),
+# and the matched station name is looked up in a name -> node id table: the shipped one,
+# then the one learned from transport_node and route_transit responses
+# with exact=True only exact, kana or romaji matches count, for keys (e.g. plan_cache_key)
+# where a guessed station would be a wrong key
+class StationResolver:
+    def __init__(
+        self,
+        stations_path=STATIONS_PATH,
+        node_ids_path=NODE_IDS_PATH,
+        learned_path=LEARNED_NODE_IDS_PATH,
+        max_concurrency=4,
+    ):
+        self._exact = {}
+        self._kana = {}
+        self._romaji = {}
+        # name -> [min lat, max lat, min lon, max lon] of the open stations of that name
+        bounds = {}
+        with open(stations_path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                if row["e_status"] != "0":
+                    continue
+                name, kana, romaji = row["station_name"], row["station_name_k"], row["station_name_r"]
+                self._exact.setdefault(normalize_name(name), name)
+                if kana:
+                    self._kana.setdefault(normalize_kana(kana), name)
+                if romaji:
+                    self._romaji.setdefault(normalize_romaji(romaji), name)
+                lat, lon = float(row["lat"]), float(row["lon"])
+                box = bounds.setdefault(name, [lat, lat, lon, lon])
+                box[0], box[1] = min(box[0], lat), max(box[1], lat)
+                box[2], box[3] = min(box[2], lon), max(box[3], lon)
+        self._sorted_names = sorted(self._exact)
+        self._ambiguous = {
+            name
+            for name, (min_lat, max_lat, min_lon, max_lon) in bounds.items()
+            if max_lat - min_lat > AMBIGUOUS_SPAN_DEG or max_lon - min_lon > AMBIGUOUS_SPAN_DEG
+        }
+
+        self.learned_path = learned_path
+        self._node_ids = {}
+        for path in (node_ids_path, learned_path):
+            if path is not None and os.path.exists(path):
+                with open(path, encoding="utf-8", newline="") as f:
+                    for row in csv.DictReader(f):
+                        self._node_ids[row["station_name"]] = row["node_id"]
+        self._lock = threading.Lock()
+        self.max_concurrency = max_concurrency
+
+    # returns the station name in the local csv that best matches the given name, or None
+    def match(self, name, exact=False):
+        normalized = normalize_name(name)
+        if normalized in self._exact:
+            return self._exact[normalized]
+        if normalize_kana(name) in self._kana:
+            return self._kana[normalize_kana(name)]
+        if normalize_romaji(name) in self._romaji:
+            return self._romaji[normalize_romaji(name)]
+        if exact:
+            return None
+
+        # otherwise the shortest station name starting with the given text
+        start = bisect.bisect_left(self._sorted_names, normalized)
+        prefixed = []
+        for candidate in self._sorted_names[start:]:
+            if not candidate.startswith(normalized):
+                break
+            prefixed.append(candidate)
+        if prefixed:
+            return self._exact[min(prefixed, key=len)]
+
+        close = difflib.get_close_matches(normalized, self._sorted_names, n=1, cutoff=0.75)
+        return self._exact[close[0]] if close else None
+
+    # returns the NAVITIME node id for the given name, or None when it has not been learned yet
+    def resolve(self, name, exact=False):
+        station_name = self.match(name, exact)
+        if station_name is not None and station_name in self._node_ids:
+            return self._node_ids[station_name]
+        return self._node_ids.get(normalize_name(name))
+
+    # returns a copy of the learned station name -> node id table
+    def node_id_table(self):
+        return dict(self._node_ids)
+
+    # records a node id found through the API and appends it to the learned table
+    # only exact matches are stored under the csv name, anything else under the typed name
+    def learn(self, name, node_id):
+        station_name = self._exact.get(normalize_name(name), normalize_name(name))
+        with self._lock:
+            if self._node_ids.get(station_name) == node_id:
+                return
+            self._node_ids[station_name] = node_id
+            if self.learned_path is None:
+                return
+            folder = os.path.dirname(self.learned_path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            write_header = not os.path.exists(self.learned_path)
+            with open(self.learned_path, "a", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(["station_name", "node_id"])
+                writer.writerow([station_name, node_id])
+
+    # learns the node ids of every station in a route_transit response
+    # names shared by distant stations (e.g. 大久保) are skipped, as the route only knows one of them
+    def learn_from_route(self, response):
+        for route in response.get("items", []):
+            for section in route.get("sections", []):
+                stations = [section] if section.get("type") == "point" else []
+                stations += section.get("transport", {}).get("calling_at", [])
+                for station in stations:
+                    name, node_id = station.get("name"), station.get("node_id")
+                    if not name or not node_id:
+                        continue
+                    station_name = self._exact.get(normalize_name(name))
+                    if station_name is None or station_name in self._ambiguous:
+                        continue
+                    if station_name not in self._node_ids:
+                        self.learn(station_name, node_id)
+
+    # resolves several names at once; names missing from the table are fetched with
+    # the given coroutine function (name -> node id or None), at most max_concurrency at a time
+    async def resolve_many(self, names, fetch):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _resolve(name):
+            node_id = self.resolve(name)
+            if node_id is not None:
+                return node_id
+            async with semaphore:
+                node_id = await fetch(name)
+            if node_id is not None:
+                self.learn(name, node_id)
+            return node_id
+
+        return await asyncio.gather(*(_resolve(name) for name in names))
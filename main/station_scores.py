@@ -0,0 +1,119 @@
+import os
+
+NEAREST_STATION_PATH = "../data/hotels/nearest_station.csv"
+HOTELS_SCORES_PATH = "../data/hotels/hotels_scores.csv"
+STATION_SCORES_PATH = "../data/hotels/station_scores.csv"
+
+# number of hotels averaged into a station score
+TOP_HOTELS = 5
+HOTEL_COLUMNS = ["hotelcode_{}".format(i + 1) for i in range(TOP_HOTELS)]
+
+
+# returns a dataframe with one row per physical station (station_g_cd and name, as in
+# station_groups; the g_cd is -1 for data built before nearest_station_g_cd existed):
+# the station score (average of the top 5 hotels' scores, missing hotels count as 0)
+# and the top 5 hotel codes ("none" when there are fewer than 5 hotels)
+# stations sharing a name (福島, 郡山) are scored apart, each from its own hotels
+def compute_station_scores(nearest_station_df, hotels_scores_df):
+    import pandas as pd
+
+    keys = ["station_g_cd", "station_name"]
+    stations_df = pd.DataFrame(
+        {
+            "hotelcode": nearest_station_df["hotelcode"],
+            "station_g_cd": nearest_station_df.get(
+                "nearest_station_g_cd", pd.Series(-1, index=nearest_station_df.index)
+            ),
+            "station_name": nearest_station_df["nearest_station_name"],
+        }
+    ).dropna(subset=["station_name"])
+    stations_df["station_g_cd"] = stations_df["station_g_cd"].fillna(-1).astype("int64")
+    # hotels_scores_df on the left keeps the order TripPlanner.get_hotels_scores returns
+    hotels_df = hotels_scores_df[["hotelcode", "score"]].merge(stations_df, on="hotelcode")
+    hotels_df = hotels_df.sort_values(
+        keys + ["score"], ascending=[True, True, False], kind="stable"
+    )
+    hotels_df["rank"] = hotels_df.groupby(keys).cumcount()
+    top_df = hotels_df[hotels_df["rank"] < TOP_HOTELS]
+
+    codes_df = top_df.pivot(index=keys, columns="rank", values="hotelcode").reindex(
+        columns=range(TOP_HOTELS)
+    )
+    codes_df.columns = HOTEL_COLUMNS
+    scores = top_df.groupby(keys)["score"].sum() / TOP_HOTELS
+
+    stations = pd.MultiIndex.from_frame(stations_df[keys].drop_duplicates())
+    station_scores_df = pd.DataFrame(index=stations)
+    station_scores_df["score"] = scores.reindex(stations).fillna(0).to_numpy()
+    station_scores_df = station_scores_df.join(codes_df).fillna({c: "none" for c in HOTEL_COLUMNS})
+    return station_scores_df.reset_index()
+
+
+# the station score table has to be rebuilt when an input is newer than it
+def is_stale(
+    station_scores_path=STATION_SCORES_PATH,
+    input_paths=(NEAREST_STATION_PATH, HOTELS_SCORES_PATH),
+):
+    if not os.path.exists(station_scores_path):
+        return True
+    built_at = os.path.getmtime(station_scores_path)
+    return any(os.path.getmtime(path) > built_at for path in input_paths)
+
+
+def build_station_scores(
+    nearest_station_path=NEAREST_STATION_PATH,
+    hotels_scores_path=HOTELS_SCORES_PATH,
+    station_scores_path=STATION_SCORES_PATH,
+):
+    import pandas as pd
+
+    station_scores_df = compute_station_scores(
+        pd.read_csv(nearest_station_path), pd.read_csv(hotels_scores_path)
+    )
+    station_scores_df.to_csv(station_scores_path, index=False)
+    return station_scores_df
+
+
+# returns the station score table as a dataframe
+# the table is rebuilt first if hotels_scores.csv or nearest_station.csv changed
+def load_station_scores_df(
+    nearest_station_path=NEAREST_STATION_PATH,
+    hotels_scores_path=HOTELS_SCORES_PATH,
+    station_scores_path=STATION_SCORES_PATH,
+):
+    import pandas as pd
+
+    if is_stale(station_scores_path, (nearest_station_path, hotels_scores_path)):
+        return build_station_scores(
+            nearest_station_path, hotels_scores_path, station_scores_path
+        )
+    return pd.read_csv(station_scores_path)
+
+
+# returns a dict of (station_g_cd, station name) -> (station score, list of top 5 hotel codes)
+def station_scores_dict(station_scores_df):
+    return {
+        (int(g_cd), name): (score, list(hotels))
+        for g_cd, name, score, *hotels in station_scores_df[
+            ["station_g_cd", "station_name", "score"] + HOTEL_COLUMNS
+        ].itertuples(index=False)
+    }
+
+
+def load_station_scores(
+    nearest_station_path=NEAREST_STATION_PATH,
+    hotels_scores_path=HOTELS_SCORES_PATH,
+    station_scores_path=STATION_SCORES_PATH,
+):
+    return station_scores_dict(
+        load_station_scores_df(nearest_station_path, hotels_scores_path, station_scores_path)
+    )
+
+
+def main():
+    station_scores_df = build_station_scores()
+    print("{} stations written to {}".format(len(station_scores_df), STATION_SCORES_PATH))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,167 +1,455 @@
-import aiohttp
 import datetime
 import asyncio
 import json
 import os
+import time
 
-from aiohttp import TCPConnector
-from dotenv import load_dotenv
+import aiohttp
 
-load_dotenv()
+import instrumentation
+import navitime_client
+import route_parser
 
-RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
+# route_transit params shared by every query: no shinkansen, limited express or flights
+UNUSE = "domestic_flight.superexpress_train.sleeper_ultraexpress.ultraexpress_train.express_train.semiexpress_train.shuttle_bus"
 
 def datetime_to_str(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%S")
 
 
-
-def str_to_datetime(s):
-    return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S+09:00")
+# a trip's next day starts at 9:00
+def _next_day(start_time):
+    return (start_time + datetime.timedelta(days=1)).replace(hour=9, minute=0, second=0)
 
 
 class StopOptionsLister:
-    async def __init__(
-        self, start, goal, start_time, max_travel_time=60 * 6, latest_stop_time=19
+    def __init__(
+        self,
+        start,
+        goal,
+        start_time,
+        max_travel_time=60 * 6,
+        latest_stop_time=19,
+        route_cache=None,
+        station_resolver=None,
+        client=None,
+        speculative=0,
+        choose_next_start=None,
+        local_router=None,
+        offline=False,
+        window_minutes=40,
+        stop_ranker=None,
+        corridor_cache=None,
+        station_groups=None,
     ):
-      
-        url = "https://navitime-transport.p.rapidapi.com/transport_node"
-        headers = {
-            "X-RapidAPI-Key": RAPIDAPI_KEY,
-            "X-RapidAPI-Host": "navitime-transport.p.rapidapi.com",
-        }
-
-        
-        connector = TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            
-            async def _get_id(station):
-                res = await session.get(url, headers=headers, params={"word": station})
-                data = await res.json()
-                return data["items"][0]["id"]
-
-           
-            self.start_station, self.goal_station = await asyncio.gather(
-                _get_id(start),
-                _get_id(goal)
-            )
-
-        
-        self.session = aiohttp.ClientSession(connector=TCPConnector(ssl=False))
-        
+        # route_cache.RouteCache for route_transit responses, None disables caching
+        self.route_cache = route_cache
+        # station_resolver.StationResolver for station names, None always asks transport_node
+        self.station_resolver = station_resolver
+        # navitime_client.AsyncNavitimeClient shared between listers; one is created when None
+        self._owns_client = client is None
+        self.client = client if client is not None else navitime_client.AsyncNavitimeClient()
+
+        self.start = start
+        self.goal = goal
+        self.start_station = None
+        self.goal_station = None
         self.trip_start_time = start_time
         self.max_travel_time = max_travel_time  
         self.latest_stop_time = latest_stop_time 
         self.stop_options_lists = []  
 
-    
+        # number of next-day route queries fired for the top stop options before the next start is known
+        self.speculative = speculative
+        # (stop_options, terminal_station) -> node id of the next day's start, may be a coroutine function
+        # by default the trip continues from the route's own terminal station
+        self.choose_next_start = choose_next_start
+        self.speculation_stats = {
+            "issued": 0,
+            "used": 0,
+            "wasted": 0,
+            "cancelled": 0,
+            "saved_seconds": 0.0,
+        }
+        self._speculation_tasks = []
+        # rail_graph.RailGraph estimating each day offline: the next day's query is fired
+        # from the terminal station it predicts before today's response is back (needs speculative)
+        # its routes are never used as answers, only route_transit's are, unless offline
+        self.local_router = local_router
+        # with offline=True every day is answered by the local router at once, and each day's
+        # route_transit query (all fired together) confirms it; see _list_offline
+        self.offline = offline
+        # calling_at stations reached within this many minutes before the stop are options too
+        self.window_minutes = window_minutes
+        # stop_ranking.StopRanker: when set, the options come from every returned route,
+        # best first, instead of only the first route
+        self.stop_ranker = stop_ranker
+        # corridor_cache.CorridorCache of precomputed days, asked before the route cache and the API
+        self.corridor_cache = corridor_cache
+        # station_groups.StationGroups: options at the same physical station are kept once
+        self.station_groups = station_groups
+
+    # resolves the start and goal names to node ids
+    @instrumentation.timed("resolve_stations")
+    async def resolve_stations(self):
+        if self.station_resolver is not None:
+            self.start_station, self.goal_station = await self.station_resolver.resolve_many(
+                [self.start, self.goal], self.client.station_name_to_id
+            )
+        else:
+            self.start_station, self.goal_station = await asyncio.gather(
+                self.client.station_name_to_id(self.start),
+                self.client.station_name_to_id(self.goal),
+            )
+        if not (self.start_station and self.goal_station):
+            raise ValueError("station not found: {} / {}".format(self.start, self.goal))
+
     async def get_stop_options_lists(self):
         return self.stop_options_lists
 
   
+    @instrumentation.timed("search_route")
     async def search_route(self, start = None, goal = None, start_time = None):
         if start == None: start= self.start_station
         if goal == None: goal= self.goal_station
         if start_time == None: start_time = self.trip_start_time
-        url = "https://navitime-route-totalnavi.p.rapidapi.com/route_transit"
-        headers = {
-            "X-RapidAPI-Key": RAPIDAPI_KEY,
-            "X-RapidAPI-Host": "navitime-route-totalnavi.p.rapidapi.com",
-        }
 
         querystring = {
-            "unuse": "domestic_flight.superexpress_train.sleeper_ultraexpress.ultraexpress_train.express_train.semiexpress_train.shuttle_bus",
+            "unuse": UNUSE,
             "options": "railway_calling_at",
             "start": start,
             "goal": goal,
             "start_time": datetime_to_str(start_time)
         }
 
-   
-        async with self.session.get(url, headers=headers, params=querystring) as response:
-            return await response.json()
+        if self.route_cache is not None:
+            cached = self.route_cache.get(querystring)
+            if cached is not None:
+                return cached
+
+        result = await self.client.route_transit(querystring)
+        if self.route_cache is not None and result.get("items"):
+            self.route_cache.put(querystring, result)
+        if self.station_resolver is not None:
+            self.station_resolver.learn_from_route(result)
+        if self.local_router is not None:
+            self.local_router.learn_from_route(result)
+        return result
 
    
     async def list_stop_stations(self):
-        start = self.start_station
-        start_time = self.trip_start_time
+        if self.offline and self.local_router is not None:
+            return await self._list_offline()
+        return await self._list_online(self.start_station, self.trip_start_time)
+
+    async def _list_online(self, start, start_time):
+        speculation = None
+
+        try:
+            while True:
+                precomputed = self._precomputed(start, start_time)
+                predicted = {}
+                if precomputed is not None:
+                    stop_options, terminal_station = precomputed
+                else:
+                    predicted = self._predict(start, start_time)
+                    if speculation is not None:
+                        res = await self._use_speculation(speculation)
+                    else:
+                        res = await self.search_route(start, self.goal_station, start_time)
+                    stop_options, terminal_station = self.parse_stop_stations(res, start_time)
+                # no terminal station: the first route reaches the goal today
+                if not stop_options or not terminal_station:
+                    self._discard_speculations(predicted.values())
+                    break
+                self.stop_options_lists.append(stop_options)
 
-        while True:
-       
-            stop_options, terminal_station = await self.next_stop_stations(
-                start, self.goal_station, start_time
-            )
-            if not stop_options:
-                break
-            self.stop_options_lists.append(stop_options)
-            start = terminal_station
-         
-            start_time = start_time + datetime.timedelta(days=1)
-          
-            start_time = start_time.replace(hour=9, minute=0, second=0)
+                start_time = _next_day(start_time)
+
+                if predicted:
+                    confirmed = terminal_station in predicted
+                    instrumentation.count("local_router.confirmed" if confirmed else "local_router.missed")
+                speculations = self._speculate(stop_options, terminal_station, start_time, predicted)
+                start = await self._next_start(stop_options, terminal_station)
+                speculation = speculations.pop(start, None)
+                self._discard_speculations(speculations.values())
+        finally:
+            await self._finish_speculations()
 
         return self.stop_options_lists
 
-    
-    async def next_stop_stations(self, start, goal, start_time):
-        res = await self.search_route(start, goal, start_time)
-        route = res["items"][0]
-        stop_options = []
-
-        travel_time = 0
-        last_section_id = None
-        terminal_station = None
-        previous_start_time = start_time
-
-        for section_id, section in enumerate(route["sections"]):
-            if section["type"] == "move":
-                section_to_time = str_to_datetime(section["to_time"])
-       
-                duration = (section_to_time - previous_start_time).total_seconds() // 60
-                travel_time += duration
-                previous_start_time = section_to_time
-
-                
-                if travel_time > self.max_travel_time or section_to_time.hour > self.latest_stop_time:
-                    stop_options.append({
-                        "name": route["sections"][section_id - 1]["name"],
-                        "node_id": route["sections"][section_id - 1]["node_id"],
-                        "coord": route["sections"][section_id - 1]["coord"],
-                    })
-                    last_section_id = section_id - 2
-                    terminal_station = route["sections"][section_id - 1]["node_id"]
+    # offline mode: the local router answers every day up front, chaining each day from the
+    # terminal station it predicts, and the route_transit queries of all days are fired at once
+    # each day is then confirmed in order: while route_transit ends the day at the predicted
+    # terminal station its options are used; from the first day it does not, the rest of the trip
+    # is planned online from route_transit's terminal station
+    # when route_transit cannot be reached, the router's answer stands
+    async def _list_offline(self):
+        start, start_time = self.start_station, self.trip_start_time
+        days = []
+        while True:
+            precomputed = self._precomputed(start, start_time)
+            if precomputed is not None:
+                stop_options, terminal_station = precomputed
+                task = None
+            else:
+                res = self.local_router.route_transit(
+                    {"start": start, "goal": self.goal_station, "start_time": start_time}
+                )
+                if res is not None:
+                    stop_options, terminal_station = self.parse_stop_stations(res, start_time)
+                # a station the router does not know, or a day it cannot get past:
+                # the rest of the trip is planned online
+                if res is None or (terminal_station == start and stop_options):
+                    days.append((start, start_time, None, None, None))
                     break
-
-     
-        if last_section_id is None:
-            return [], terminal_station
-
-
-        for station in route["sections"][last_section_id]["transport"]["calling_at"]:
-            if "to_time" not in station:
+                task = asyncio.ensure_future(self.search_route(start, self.goal_station, start_time))
+                self._speculation_tasks.append(task)
+            days.append((start, start_time, task, stop_options, terminal_station))
+            if not stop_options or not terminal_station:
+                break
+            start = await self._next_start(stop_options, terminal_station)
+            start_time = _next_day(start_time)
+
+        try:
+            for start, start_time, task, stop_options, terminal_station in days:
+                if stop_options is None:
+                    return await self._list_online(start, start_time)
+                if task is not None:
+                    try:
+                        res = await task
+                    except (OSError, asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                        instrumentation.count("local_router.unconfirmed")
+                    else:
+                        confirmed_options, confirmed_terminal = self.parse_stop_stations(res, start_time)
+                        confirmed = confirmed_terminal == terminal_station
+                        instrumentation.count("local_router.confirmed" if confirmed else "local_router.missed")
+                        stop_options, terminal_station = confirmed_options, confirmed_terminal
+                        if not confirmed:
+                            if not stop_options or not terminal_station:
+                                return self.stop_options_lists
+                            self.stop_options_lists.append(stop_options)
+                            start = await self._next_start(stop_options, terminal_station)
+                            return await self._list_online(start, _next_day(start_time))
+                if not stop_options or not terminal_station:
+                    return self.stop_options_lists
+                self.stop_options_lists.append(stop_options)
+            return self.stop_options_lists
+        finally:
+            await self._finish_speculations()
+
+    async def _next_start(self, stop_options, terminal_station):
+        if self.choose_next_start is None:
+            return terminal_station
+        start = self.choose_next_start(stop_options, terminal_station)
+        if asyncio.iscoroutine(start):
+            start = await start
+        return start
+
+    # fires the next day's route queries for the terminal station and the first stop options
+    # on top of the ones already issued (the local router's prediction)
+    # returns a dict of node id -> (task, issued at)
+    def _speculate(self, stop_options, terminal_station, start_time, issued=None):
+        speculations = dict(issued or {})
+        if not self.speculative:
+            return speculations
+        node_ids = [terminal_station] + [stop["node_id"] for stop in stop_options]
+        for node_id in node_ids:
+            if len(speculations) >= self.speculative:
+                break
+            if node_id in speculations or self._precomputed(node_id, start_time) is not None:
                 continue
-            to_time = str_to_datetime(station["to_time"])
-            terminal_to_time = str_to_datetime(route["sections"][last_section_id]["to_time"])
-      
-            if (terminal_to_time - to_time).total_seconds() < 40 * 60:
-                stop_options.append({
-                    "name": station["name"],
-                    "node_id": station["node_id"],
-                    "coord": station["coord"],
-                })
-
+            speculations[node_id] = self._issue(node_id, start_time)
+        return speculations
+
+    # the task is stamped with the time its query finished inside the task itself, as done
+    # callbacks may not have run yet when an awaiting coroutine resumes
+    def _issue(self, node_id, start_time):
+        async def _search():
+            try:
+                return await self.search_route(node_id, self.goal_station, start_time)
+            finally:
+                task.finished_at = time.monotonic()
+
+        task = asyncio.ensure_future(_search())
+        self._speculation_tasks.append(task)
+        self._count("issued")
+        return task, time.monotonic()
+
+    # estimates the day from start with the local router and fires the next day's query from
+    # the terminal station it predicts, while today's query is still running
+    # the prediction is only used once route_transit's own terminal station confirms it
+    # returns a dict of node id -> (task, issued at), empty without a prediction
+    def _predict(self, start, start_time):
+        if self.local_router is None or not self.speculative:
+            return {}
+        res = self.local_router.route_transit(
+            {"start": start, "goal": self.goal_station, "start_time": start_time}
+        )
+        if res is None:
+            return {}
+        stop_options, terminal_station = route_parser.stop_options(
+            route_parser.first_route(res),
+            start_time,
+            self.max_travel_time,
+            self.latest_stop_time,
+            self.window_minutes,
+        )
+        # the router only predicts stations whose node id has been learned
+        if not stop_options or not terminal_station or terminal_station == start:
+            return {}
+        next_start_time = _next_day(start_time)
+        if self._precomputed(terminal_station, next_start_time) is not None:
+            return {}
+        instrumentation.count("local_router.predictions")
+        return {terminal_station: self._issue(terminal_station, next_start_time)}
+
+    # returns the speculative response and records how long the query had been running for us:
+    # from its issue until it finished, or until we needed it if it was still running then
+    async def _use_speculation(self, speculation):
+        task, issued_at = speculation
+        needed_at = time.monotonic()
+        res = await task
+        self._count("used")
+        self._count("saved_seconds", min(task.finished_at, needed_at) - issued_at)
+        return res
+
+    # unused queries are cancelled, unless there is a route cache to keep their responses in
+    def _discard_speculations(self, speculations):
+        for task, _ in speculations:
+            self._count("wasted")
+            if self.route_cache is None and not task.done():
+                task.cancel()
+                self._count("cancelled")
+
+    # speculation_stats of this lister, also counted as "speculation.<stat>" by instrumentation
+    # for the totals over every trip planned
+    def _count(self, stat, value=1):
+        self.speculation_stats[stat] += value
+        instrumentation.count("speculation." + stat, value)
+
+    async def _finish_speculations(self):
+        for task in self._speculation_tasks:
+            if self.route_cache is None and not task.done():
+                task.cancel()
+        await asyncio.gather(*self._speculation_tasks, return_exceptions=True)
+        self._speculation_tasks = []
+
+    @instrumentation.timed("next_stop_stations")
+    async def next_stop_stations(self, start, goal, start_time):
+        if goal == self.goal_station:
+            precomputed = self._precomputed(start, start_time)
+            if precomputed is not None:
+                return precomputed
+        res = await self.search_route(start, goal, start_time)
+        return self.parse_stop_stations(res, start_time)
+
+    # returns the day's (stop options, terminal station) from the corridor cache, or None
+    # ranked options are never precomputed; a build made without station groups is deduplicated here
+    def _precomputed(self, start, start_time):
+        if self.corridor_cache is None or self.stop_ranker is not None:
+            return None
+        precomputed = self.corridor_cache.get(
+            start,
+            self.goal_station,
+            start_time,
+            self.max_travel_time,
+            self.latest_stop_time,
+            self.window_minutes,
+        )
+        if precomputed is None or self.station_groups is None:
+            return precomputed
+        stop_options, terminal_station = precomputed
+        return self.station_groups.dedup(stop_options), terminal_station
+
+    # picks the stop options for the day out of a route_transit response
+    @instrumentation.timed("parse_stop_stations")
+    def parse_stop_stations(self, res, start_time):
+        if self.stop_ranker is not None:
+            stop_options, terminal_station = self.rank_stop_stations(res, start_time)
+        else:
+            stop_options, terminal_station = route_parser.stop_options(
+                route_parser.first_route(res),
+                start_time,
+                self.max_travel_time,
+                self.latest_stop_time,
+                self.window_minutes,
+            )
+        if self.station_groups is not None:
+            stop_options = self.station_groups.dedup(stop_options)
         return stop_options, terminal_station
 
+    # the candidates of every route in the response, ranked by the stop ranker
+    # each option keeps the terminal station of its own route, and the next day continues from
+    # the terminal of the stop the night is spent at (the first option with a positive hotel
+    # score, as TripPlanner.get_best_stations_batch picks it, else the best ranked one);
+    # when the first route reaches the goal today there are no options, whatever the other routes do
+    def rank_stop_stations(self, res, start_time):
+        routes = route_parser.all_routes(res)
+        candidates, terminals, terminal_station = route_parser.candidate_stops(
+            routes,
+            start_time,
+            self.max_travel_time,
+            self.latest_stop_time,
+            self.window_minutes,
+        )
+        if terminal_station is None:
+            return [], None
+        goal = next(
+            (section.stop for section in reversed(routes[0]) if section.stop is not None),
+            None,
+        ) if routes else None
+        ranked = self.stop_ranker.rank(candidates, goal, self.max_travel_time, terminals)
+        chosen = next((option for option in ranked if option["hotel_score"] > 0), ranked[0])
+        return ranked, chosen["terminal"]
+
   
     @staticmethod
-    async def create(start, goal, start_time, max_travel_time=60*6, latest_stop_time=19):
-        instance = StopOptionsLister.__new__(StopOptionsLister)
-        await instance.__init__(start, goal, start_time, max_travel_time, latest_stop_time)
+    async def create(start, goal, start_time, max_travel_time=60*6, latest_stop_time=19, **kwargs):
+        instance = StopOptionsLister(start, goal, start_time, max_travel_time, latest_stop_time, **kwargs)
+        await instance.resolve_stations()
         return instance
 
 
     async def close(self):
-        await self.session.close()
+        if self._owns_client:
+            await self.client.close()
+
+
+# plans many (start, goal, start_time) requests at once on one shared client
+# returns one list of daily stop options per request, in order;
+# a request that failed gets its exception instead, so one bad request does not cancel the rest
+# cancelling the returned coroutine cancels every request still running
+async def plan_many(requests, client=None, max_concurrency=8, requests_per_second=5.0, **kwargs):
+    owns_client = client is None
+    if owns_client:
+        client = navitime_client.AsyncNavitimeClient(
+            max_concurrency=max_concurrency, requests_per_second=requests_per_second
+        )
+
+    async def _plan(start, goal, start_time):
+        lister = await StopOptionsLister.create(start, goal, start_time, client=client, **kwargs)
+        return await lister.list_stop_stations()
+
+    try:
+        return await asyncio.gather(
+            *(_plan(*request) for request in requests), return_exceptions=True
+        )
+    finally:
+        if owns_client:
+            await client.close()
+
+
+# synchronous wrappers for callers outside an event loop (TripPlanner)
+def list_stop_stations_sync(start, goal, start_time, **kwargs):
+    result = asyncio.run(plan_many([(start, goal, start_time)], **kwargs))[0]
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def plan_many_sync(requests, **kwargs):
+    return asyncio.run(plan_many(requests, **kwargs))
 
 
 async def save_to_json(data, file_path, indent=4, ensure_ascii=False):
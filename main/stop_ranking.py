@@ -0,0 +1,102 @@
+import math
+
+import numpy as np
+
+from rail_graph import LOCAL_SPEED_KMH
+from spatial_index import haversine_m
+
+DETOUR_FACTOR = 1.2
+
+
+# returns a boolean mask of the rows of objectives (all to be maximized) no other row dominates
+# one row dominates another when it is at least as good everywhere and better somewhere
+# rows are visited best-first lexicographically, so a row can only be dominated by rows
+# visited before it, and checking it against the front found so far is enough
+def pareto_front(objectives):
+    objectives = np.asarray(objectives, dtype=float)
+    front = np.zeros(len(objectives), dtype=bool)
+    if len(objectives) == 0:
+        return front
+    order = np.lexsort(-objectives.T[::-1])
+    front_rows = np.empty((0, objectives.shape[1]))
+    for i in order:
+        row = objectives[i]
+        dominated = (
+            (front_rows >= row).all(axis=1) & (front_rows > row).any(axis=1)
+        ).any()
+        if not dominated:
+            front[i] = True
+            front_rows = np.vstack([front_rows, row])
+    return front
+
+
+# ranks a day's candidate overnight stops by
+# - hotel score: the station score the planner gives the stop (TripPlanner.get_station_score),
+#   so names NAVITIME spells differently are scored through the same fallbacks
+# - remaining distance: great-circle km from the stop to the goal
+# - next-day feasibility: days still needed from the stop at max_travel_time minutes a day
+# the pareto front over the three comes first, each part ordered by the weighted sum of
+# the min-max normalized objectives; the top k are kept
+class StopRanker:
+    def __init__(
+        self,
+        station_score,
+        k=10,
+        score_weight=1.0,
+        distance_weight=0.5,
+        days_weight=0.5,
+    ):
+        # (station name, latitude, longitude) -> (station score, top 5 hotels), e.g. TripPlanner.get_station_score
+        self.station_score = station_score
+        self.k = k
+        self.weights = np.array([score_weight, distance_weight, days_weight])
+
+    # returns the hotel scores, remaining km and remaining days of the stops, and the top 5 hotels
+    # each stop's score came with, so the planner can reuse them instead of scoring it again
+    def objectives(self, stops, goal, max_travel_time):
+        scored = [self.station_score(stop.name, stop.lat, stop.lon) for stop in stops]
+        scores = np.array([score for score, _ in scored], dtype=float)
+        hotels = [list(stop_hotels) for _, stop_hotels in scored]
+        latitudes = np.array([stop.lat for stop in stops], dtype=float)
+        longitudes = np.array([stop.lon for stop in stops], dtype=float)
+        if goal is not None and goal.lat is not None:
+            remaining_km = haversine_m(latitudes, longitudes, goal.lat, goal.lon) / 1000
+        else:
+            remaining_km = np.zeros(len(stops))
+        remaining_km = np.nan_to_num(remaining_km, nan=np.nanmax(remaining_km, initial=0))
+        minutes_per_km = 60 / LOCAL_SPEED_KMH * DETOUR_FACTOR
+        days = np.ceil(remaining_km * minutes_per_km / max(max_travel_time, 1))
+        return np.nan_to_num(scores), remaining_km, days, hotels
+
+    # returns the top k stop option dicts, best first, each with its objectives and top 5 hotels
+    # terminals: the terminal station's node id of each stop's route, kept as option["terminal"]
+    def rank(self, stops, goal, max_travel_time, terminals=None):
+        if not stops:
+            return []
+        scores, remaining_km, days, hotels = self.objectives(stops, goal, max_travel_time)
+        # all three maximized
+        objectives = np.column_stack([scores, -remaining_km, -days])
+        front = pareto_front(objectives)
+
+        spread = objectives.max(axis=0) - objectives.min(axis=0)
+        normalized = (objectives - objectives.min(axis=0)) / np.where(spread > 0, spread, 1)
+        combined = normalized @ self.weights
+
+        k = min(self.k, len(stops))
+        # front first, then by the combined objective; argpartition keeps it linear for many candidates
+        key = combined + front * (self.weights.sum() + 1)
+        top = np.argpartition(-key, k - 1)[:k]
+        top = top[np.argsort(-key[top], kind="stable")]
+
+        ranked = []
+        for i in top:
+            option = stops[i].to_dict()
+            option["hotel_score"] = float(scores[i])
+            option["hotels"] = hotels[i]
+            option["remaining_km"] = float(remaining_km[i])
+            option["remaining_days"] = int(days[i]) if math.isfinite(days[i]) else None
+            option["pareto"] = bool(front[i])
+            if terminals is not None:
+                option["terminal"] = terminals[i]
+            ranked.append(option)
+        return ranked
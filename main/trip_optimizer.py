@@ -0,0 +1,105 @@
+import asyncio
+import datetime
+
+import instrumentation
+
+
+# a partial trip: the station the next day starts from, and the nights chosen so far
+class _State:
+    __slots__ = ("node_id", "total_score", "nights")
+
+    def __init__(self, node_id, total_score=0.0, nights=()):
+        self.node_id = node_id
+        self.total_score = total_score
+        # tuple of (stop option dict, station score, top 5 hotels) per night
+        self.nights = nights
+
+
+# beam search over (night, stop station) states for the whole trip
+# every night each kept state is expanded with its branch best-scored stop options,
+# and the next day's route is searched from the station actually chosen
+# - stop options come from the lister, so max_travel_time and latest_stop_time apply as usual
+# - states at the same station on the same night are merged (dynamic programming), keeping the best
+# - the first night a state reaches the goal ends the search; of the trips finishing that night
+#   the one with the highest total hotel score wins
+# - route searches are memoized per (station, day), so states sharing a station share one query
+class TripOptimizer:
+    def __init__(self, lister, station_score, beam_width=4, branch=3, max_nights=14):
+        # stop_options.StopOptionsLister with resolved start and goal stations
+        self.lister = lister
+        # (station name, latitude, longitude) -> (station score, top 5 hotels), e.g. TripPlanner.get_station_score
+        self.station_score = station_score
+        self.beam_width = beam_width
+        self.branch = branch
+        self.max_nights = max_nights
+        self._segments = {}
+        self.segment_queries = 0
+
+    # returns (stop options, terminal station) for the day from node_id, searched once per (station, day)
+    async def _segment(self, node_id, start_time):
+        key = (node_id, start_time)
+        if key not in self._segments:
+            self.segment_queries += 1
+            self._segments[key] = asyncio.ensure_future(
+                self.lister.next_stop_stations(node_id, self.lister.goal_station, start_time)
+            )
+        return await self._segments[key]
+
+    def _expand(self, state, stop_options):
+        scored = []
+        for stop in stop_options:
+            # the stop can be the station the day started from (a late start with no train
+            # before latest_stop_time): the night is spent there and the trip goes on the next day
+            # ranked options (stop_ranking) already carry their score
+            if "hotels" in stop:
+                score, hotels = stop["hotel_score"], stop["hotels"]
+            else:
+                score, hotels = self.station_score(
+                    stop["name"], stop["coord"]["lat"], stop["coord"]["lon"]
+                )
+            scored.append((score, stop, hotels))
+        # stable: equal scores keep the route order, as get_best_station does
+        scored.sort(key=lambda item: -item[0])
+        return [
+            _State(
+                stop["node_id"],
+                state.total_score + score,
+                state.nights + ((stop, score, hotels if score > 0 else None),),
+            )
+            for score, stop, hotels in scored[: self.branch]
+        ]
+
+    # returns the best trip as a list of (stop option dict, station score, top 5 hotels) per night
+    @instrumentation.timed("optimize_trip")
+    async def optimize(self):
+        start_time = self.lister.trip_start_time
+        beam = [_State(self.lister.start_station)]
+
+        for _ in range(self.max_nights + 1):
+            segments = await asyncio.gather(
+                *(self._segment(state.node_id, start_time) for state in beam)
+            )
+            finished = [
+                state for state, (stop_options, _) in zip(beam, segments) if not stop_options
+            ]
+            if finished:
+                return list(max(finished, key=lambda state: state.total_score).nights)
+
+            children = {}
+            for state, (stop_options, _) in zip(beam, segments):
+                for child in self._expand(state, stop_options):
+                    best = children.get(child.node_id)
+                    if best is None or child.total_score > best.total_score:
+                        children[child.node_id] = child
+            beam = sorted(children.values(), key=lambda state: -state.total_score)[
+                : self.beam_width
+            ]
+
+            start_time = start_time + datetime.timedelta(days=1)
+            start_time = start_time.replace(hour=9, minute=0, second=0)
+
+        raise ValueError(
+            "no trip from {} to {} within {} nights".format(
+                self.lister.start, self.lister.goal, self.max_nights
+            )
+        )
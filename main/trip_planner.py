@@ -1,17 +1,29 @@
-import pandas as pd
+import numpy as np
+import asyncio
 import datetime
-import stop_options
-from geopy.distance import geodesic
+import corridor_cache
+import data_bundle
+import instrumentation
+import plan_cache
+import route_cache
+import station_groups
+import station_resolver
+import spatial_index
+import station_scores
 import os
+import sys
 
-print("Current Directory:", os.getcwd())
+# stderr, so the jsonl output of plan_cli stays clean
+print("Current Directory:", os.getcwd(), file=sys.stderr)
 
 import datetime
-import tkinter as tk
-from tkinter import ttk
-from tkcalendar import DateEntry
 
 def pick_datetime():
+    # tkinter is only needed for the dialog, so servers never import it
+    import tkinter as tk
+    from tkinter import ttk
+    from tkcalendar import DateEntry
+
     root = tk.Tk()
     root.title("出発時刻を選択")
     # 1. 核心修复：把窗口调大，从380x180改成550x220，确保所有组件都能放下
@@ -60,62 +72,136 @@ def pick_datetime():
     return select_str
 
 
+def _isnan(value):
+    return value is None or value != value
+
+
 class TripPlanner:
     def __init__(self):
-        self.nearest_station_df = pd.read_csv("../data/hotels/nearest_station.csv")
-        self.hotels_scores_df = pd.read_csv("../data/hotels/hotels_scores.csv")
+        # route_transit responses shared by every plan_trip call
+        self.route_cache = route_cache.RouteCache("../data/cache/route_cache.sqlite")
+        # days of busy corridors precomputed by corridor_cache.py warm, None until one is built
+        self.corridor_cache = corridor_cache.load_corridor_cache()
+        # station name -> NAVITIME node id without calling transport_node
+        self.station_resolver = station_resolver.StationResolver()
+        # plan_trip results of the datasets loaded above, served again for the same request
+        self.plan_cache = plan_cache.PlanCache("../data/cache/plan_cache.sqlite")
+        # one record per physical station (station_g_cd), None until make_station_groups.py has run
+        self.station_groups = station_groups.load_station_groups()
+        # rail_graph.RailGraph for local_router and offline planning, built on first use
+        self._rail_graph = None
+        # the csv files compiled into memory-mapped arrays, rebuilt when a csv changes
+        self.use_bundle(data_bundle.load_bundle())
+
+    # points the planner at a compiled bundle; hotels and station scores are looked up in its
+    # arrays in place, and the indexes built over the previous bundle are dropped
+    def use_bundle(self, bundle):
+        self.bundle = bundle
+        # grid index over the hotels' nearest station coordinates for the radius fallback
+        self._station_index = None
+        # hotel_search.HotelSearch over every hotel's coordinates, for radius_m searches
+        self._hotel_search = None
+
+    def station_index(self):
+        if self._station_index is None:
+            self._station_index = spatial_index.SpatialIndex(
+                self.bundle.array("nearest_station.latitude"),
+                self.bundle.array("nearest_station.longitude"),
+            )
+        return self._station_index
 
     # returns a list of hotel codes which nearest station is the given station
+    # the station is looked up among the physical stations (station_groups) first, so names
+    # NAVITIME spells differently (福島（福島県）) still find the hotels of the station
     def search_hotels_from_station(
         self, station_name, station_latitude, station_longitude
     ):
-        result = self.nearest_station_df[
-            self.nearest_station_df["nearest_station_name"] == station_name
-        ]["hotelcode"].tolist()
+        return self.bundle.hotelcode_list(
+            self._station_hotels(station_name, station_latitude, station_longitude)
+        )
+
+    # nearest_station.csv rows of the hotels near the given station, as hotel ids
+    def _station_hotels(self, station_name, station_latitude, station_longitude):
+        hotels = self.bundle.array("nearest_station.hotel")
+        stations = self.bundle.array("nearest_station.station")
+        if self.station_groups is not None:
+            row = self.station_groups.locate(station_name, station_latitude, station_longitude)
+            if row is not None:
+                rows = self.bundle.rows("nearest_station", "group", int(self.station_groups.g_cds[row]))
+                station_id = self.bundle.station_id(self.station_groups.names[row])
+                named_rows = rows[stations[rows] == station_id]
+                rows = named_rows if len(named_rows) else rows
+                if len(rows):
+                    return hotels[rows]
+
+        station_id = self.bundle.station_id(station_name)
+        rows = self.bundle.rows("nearest_station", "station", station_id) if station_id >= 0 else []
+        # a name several stations share does not tell their hotels apart
+        if len(np.unique(self.bundle.array("nearest_station.group")[rows])) > 1:
+            rows = []
         # if there is no station with the given name, search hotels within 100 meters from the given latitude and longitude
-        if not result:
-            distance = self.nearest_station_df.apply(
-                lambda row: geodesic(
-                    (row["nearest_station_latitude"], row["nearest_station_longitude"]),
-                    (station_latitude, station_longitude),
-                ).m
-                if not row.isnull().any()
-                else 1000,
-                axis=1,
+        if not len(rows) and not _isnan(station_latitude) and not _isnan(station_longitude):
+            positions, _ = self.station_index().query_radius(
+                station_latitude, station_longitude, 100, exact=True
             )
-            result = self.nearest_station_df[distance <= 100]["hotelcode"].tolist()
-        return result
+            rows = np.sort(positions)
+        return hotels[rows]
 
     # returns a dataframe of hotels with scores
     def get_hotels_scores(self, hotels_list):
-        return self.hotels_scores_df[
-            self.hotels_scores_df["hotelcode"].isin(hotels_list)
-        ]
+        hotels_scores_df = self.bundle.hotels_scores_df()
+        return hotels_scores_df[hotels_scores_df["hotelcode"].isin(hotels_list)]
+
+    # the (station_g_cd, station name) key of the station score table a stop is, or None
+    # the stop is located among the physical stations, so a name several stations share
+    # (福島, 郡山) never mixes their hotels; without groups only unambiguous names are looked up
+    def station_key(self, station_name, station_latitude, station_longitude):
+        if self.station_groups is not None:
+            row = self.station_groups.locate(station_name, station_latitude, station_longitude)
+            if row is not None:
+                return int(self.station_groups.g_cds[row]), self.station_groups.names[row]
+        station_id = self.bundle.station_id(station_name)
+        if station_id < 0:
+            return None
+        rows = self.bundle.rows("station_scores", "station", station_id)
+        if len(rows) != 1:
+            return None
+        return int(self.bundle.array("station_scores.group")[rows[0]]), station_name
 
-    # returns a tuple of station score and a dataframe of top 5 hotels with scores
+    # the station_scores.csv row of a station key, or None
+    def _station_score_row(self, key):
+        if key is None:
+            return None
+        g_cd, station_name = key
+        rows = self.bundle.rows("station_scores", "group", g_cd)
+        rows = rows[self.bundle.array("station_scores.station")[rows] == self.bundle.station_id(station_name)]
+        return int(rows[0]) if len(rows) else None
+
+    # returns a tuple of station score and a list of top 5 hotels
+    @instrumentation.timed("get_station_score")
     def get_station_score(self, station_name, station_latitude, station_longitude):
-        hotels_list = self.search_hotels_from_station(
-            station_name, station_latitude, station_longitude
-        )
-        nearby_hotels_with_scores_df = self.get_hotels_scores(hotels_list)
-        sorted_hotels_with_scores_df = nearby_hotels_with_scores_df.sort_values(
-            "score", ascending=False
+        row = self._station_score_row(
+            self.station_key(station_name, station_latitude, station_longitude)
         )
-        # station score is the average of the top 5 hotels' scores
-        if len(sorted_hotels_with_scores_df) < 5:
-            data = [["none", 0] for x in range(5)]
-            indices = [
-                i
-                for i in range(
-                    len(sorted_hotels_with_scores_df),
-                    len(sorted_hotels_with_scores_df) + 5,
-                )
-            ]
-            df = pd.DataFrame(data, columns=["hotelcode", "score"], index=indices)
-            sorted_hotels_with_scores_df = pd.concat([sorted_hotels_with_scores_df, df])
+        if row is not None:
+            instrumentation.count("station_scores.hits")
+            return (
+                float(self.bundle.array("station_scores.score")[row]),
+                self.bundle.hotelcode_list(self.bundle.array("station_scores.hotels")[row]),
+            )
+        instrumentation.count("station_scores.misses")
 
-        station_score = sorted_hotels_with_scores_df["score"].head(5).mean()
-        return station_score, sorted_hotels_with_scores_df["hotelcode"].head(5).tolist()
+        # stations without a precomputed score fall back to the radius search
+        hotel_ids = self._station_hotels(station_name, station_latitude, station_longitude)
+        score_rows = self.bundle.array("hotel_ids.score_row")[hotel_ids[hotel_ids >= 0]]
+        # hotels in hotels_scores.csv order, best first
+        score_rows = np.unique(score_rows[score_rows >= 0])
+        scores = self.bundle.array("hotels_scores.score")[score_rows]
+        order = np.argsort(-scores, kind="stable")[: station_scores.TOP_HOTELS]
+        # station score is the average of the top 5 hotels' scores
+        station_score = float(scores[order].sum()) / station_scores.TOP_HOTELS
+        hotels = self.bundle.hotelcode_list(self.bundle.array("hotels_scores.hotel")[score_rows[order]])
+        return station_score, hotels + ["none"] * (station_scores.TOP_HOTELS - len(hotels))
 
     # returns a tuple of best station name and top 5 hotels near the station
     def get_best_station(self, stations_names, latitudes, longitudes):
@@ -134,23 +220,246 @@ class TripPlanner:
                 best_hotels = hotels
         return best_station_name, best_hotels
 
+    # scores every night of many trips at once
+    # trips_stops_options: a list of trips, each a list of nights' stop options from list_stop_stations
+    # returns a list of trips, each a list of (best station name, top 5 hotels) per night
+    # with ranked=True the options are already ranked (stop_ranking.StopRanker) and the first
+    # one with hotels wins instead of the one with the highest score
+    # with radius_m set, stops are scored by every hotel within radius_m of them,
+    # decayed by distance (see hotel_search), instead of by their name
+    @instrumentation.timed("get_best_stations_batch")
+    def get_best_stations_batch(self, trips_stops_options, ranked=False, radius_m=None):
+        options = [
+            ((trip, night), stop)
+            for trip, stops_options_list in enumerate(trips_stops_options)
+            for night, stops_options in enumerate(stops_options_list)
+            for stop in stops_options
+        ]
+        candidates = [
+            (night_key, (stop["name"], stop["coord"]["lat"], stop["coord"]["lon"]))
+            for night_key, stop in options
+        ]
+        if radius_m is not None:
+            scores, hotels = self.hotel_search().score_stops(
+                np.array([stop[1] for _, stop in candidates], dtype=float),
+                np.array([stop[2] for _, stop in candidates], dtype=float),
+                radius_m,
+            )
+            entries = list(zip(scores.tolist(), hotels))
+        else:
+            # each distinct stop is scored once; ranked options already carry their score
+            scored = {}
+            entries = []
+            for (_, option), (_, stop) in zip(options, candidates):
+                if "hotels" in option:
+                    entries.append((option["hotel_score"], option["hotels"]))
+                    continue
+                entry = scored.get(stop)
+                if entry is None:
+                    entry = scored[stop] = self.get_station_score(*stop)
+                entries.append(entry)
+
+        # the first station with the highest positive score wins, as in get_best_station
+        best = {}
+        for (night_key, stop), (score, hotels) in zip(candidates, entries):
+            if not score > 0:
+                continue
+            if night_key not in best or (not ranked and score > best[night_key][0]):
+                best[night_key] = (score, stop[0], list(hotels))
+        return [
+            [
+                best[(trip, night)][1:] if (trip, night) in best else (None, None)
+                for night in range(len(stops_options_list))
+            ]
+            for trip, stops_options_list in enumerate(trips_stops_options)
+        ]
+
     # return a list of stops
     # each stop is a tuple of station name and top 5 hotels near the station
-    def plan_trip(self, start, goal, start_time):
-        stops_lister = stop_options.StopOptionsLister(start, goal, start_time)
-        stops_options_list = stops_lister.list_stop_stations()
-        suggest_stops = []
-        for stops_options in stops_options_list:
-            station_names = [stop["name"] for stop in stops_options]
-            station_latitudes = [stop["coord"]["lat"] for stop in stops_options]
-            station_longitudes = [stop["coord"]["lon"] for stop in stops_options]
-            suggest_stops.append(
-                self.get_best_station(
-                    station_names, station_latitudes, station_longitudes
-                )
+    # with ranked=True every route NAVITIME returns is considered and the stops are ranked
+    # by hotel score, remaining distance and next-day feasibility (see stop_ranking)
+    # with optimize=True the nights are chosen together by trip_optimizer.TripOptimizer,
+    # and each day continues from the station chosen the night before
+    # local_router, offline and speculative: see _lister_options
+    # results are memoized in plan_cache per (start, goal, 5 minute departure bucket, options)
+    @instrumentation.timed("plan_trip")
+    def plan_trip(
+        self,
+        start,
+        goal,
+        start_time,
+        ranked=False,
+        optimize=False,
+        radius_m=None,
+        local_router=False,
+        offline=False,
+        speculative=0,
+        **optimizer_options
+    ):
+        lister_options = self._lister_options(ranked, local_router, offline, speculative)
+        if not self.plan_cache.usable():
+            return self._plan_trip(
+                start, goal, start_time, ranked, optimize, radius_m, lister_options, **optimizer_options
+            )
+        # the optimizer scores stops by name, so radius_m does not change its plans;
+        # offline plans can hold the router's days when route_transit was unreachable
+        key = self.plan_cache_key(
+            start,
+            goal,
+            start_time,
+            ranked=ranked,
+            optimize=optimize,
+            radius_m=None if optimize else radius_m,
+            offline=offline or None,
+            **optimizer_options
+        )
+        result = self.plan_cache.get(key)
+        if result is None:
+            result = self._plan_trip(
+                start, goal, start_time, ranked, optimize, radius_m, lister_options, **optimizer_options
             )
+            self.plan_cache.put(key, result)
+        return result
+
+    # the plan cache key of a request, with start and goal resolved to node ids where possible
+    # only exact names are resolved, so a mistyped name never shares the key of the station
+    # it happens to be close to
+    def plan_cache_key(self, start, goal, start_time, **options):
+        start_node, goal_node = (
+            self.station_resolver.resolve(name, exact=True) or station_resolver.normalize_name(name)
+            for name in (start, goal)
+        )
+        return self.plan_cache.make_key(start_node, goal_node, start_time, **options)
+
+    def _plan_trip(
+        self, start, goal, start_time, ranked, optimize, radius_m, lister_options, **optimizer_options
+    ):
+        # imported here so that loading the planner does not pull in aiohttp
+        import stop_options
+
+        if optimize:
+            return self.optimize_trip(start, goal, start_time, ranked, **optimizer_options)
+
+        stops_options_list = stop_options.list_stop_stations_sync(
+            start, goal, start_time, **lister_options
+        )
+        return self.suggest_stops(stops_options_list, ranked=ranked, radius_m=radius_m)
+
+    # StopOptionsLister options shared by every way of planning
+    # with local_router=True the offline JR graph (rail_graph.RailGraph) predicts each day and
+    # the next day's query is fired from its terminal station before the day's response is back;
+    # with offline=True the graph answers every day and route_transit only confirms it;
+    # speculative=N fires the next day's queries of the top N stop options before the next
+    # start is known (see StopOptionsLister), which only changes how fast a plan is found
+    def _lister_options(self, ranked=False, local_router=False, offline=False, speculative=0):
+        return {
+            "route_cache": self.route_cache,
+            "corridor_cache": self.corridor_cache,
+            "station_resolver": self.station_resolver,
+            "station_groups": self.station_groups,
+            "stop_ranker": self.stop_ranker() if ranked else None,
+            "local_router": self.rail_graph() if local_router or offline else None,
+            # the router's prediction is a speculative query
+            "speculative": max(speculative, 1 if local_router else 0),
+            "offline": offline,
+        }
+
+    # returns the optimized trip as a list of (station name, top 5 hotels or None) per night
+    def optimize_trip(self, start, goal, start_time, ranked=False, **optimizer_options):
+        import stop_options
+        import trip_optimizer
+
+        async def _optimize():
+            lister = await stop_options.StopOptionsLister.create(
+                start, goal, start_time, **self._lister_options(ranked)
+            )
+            try:
+                optimizer = trip_optimizer.TripOptimizer(
+                    lister, self.get_station_score, **optimizer_options
+                )
+                return await optimizer.optimize()
+            finally:
+                await lister.close()
+
+        return [(stop["name"], hotels) for stop, _, hotels in asyncio.run(_optimize())]
+
+    # plans many (start, goal, start_time) trips with concurrent route searches
+    # returns a list of plan_trip results, or the exception for trips that failed
+    # trips found in the plan cache are not planned again
+    def plan_trips(
+        self,
+        requests,
+        max_concurrency=8,
+        ranked=False,
+        radius_m=None,
+        local_router=False,
+        offline=False,
+        speculative=0,
+    ):
+        import stop_options
+
+        requests = list(requests)
+        keys = [None] * len(requests)
+        results = [None] * len(requests)
+        if self.plan_cache.usable():
+            keys = [
+                self.plan_cache_key(
+                    start,
+                    goal,
+                    start_time,
+                    ranked=ranked,
+                    optimize=False,
+                    radius_m=radius_m,
+                    offline=offline or None,
+                )
+                for start, goal, start_time in requests
+            ]
+            results = [self.plan_cache.get(key) for key in keys]
+        pending = [i for i, result in enumerate(results) if result is None]
+
+        planned_results = stop_options.plan_many_sync(
+            [requests[i] for i in pending],
+            max_concurrency=max_concurrency,
+            **self._lister_options(ranked, local_router, offline, speculative)
+        )
+        planned = [result for result in planned_results if not isinstance(result, BaseException)]
+        suggestions = iter(self.get_best_stations_batch(planned, ranked=ranked, radius_m=radius_m))
+        for i, result in zip(pending, planned_results):
+            if isinstance(result, BaseException):
+                results[i] = result
+                continue
+            results[i] = next(suggestions)
+            if keys[i] is not None:
+                self.plan_cache.put(keys[i], results[i])
+        return results
+
+    # returns the best station and top 5 hotels for each night's stop options
+    def suggest_stops(self, stops_options_list, ranked=False, radius_m=None):
+        return self.get_best_stations_batch(
+            [stops_options_list], ranked=ranked, radius_m=radius_m
+        )[0]
 
-        return suggest_stops
+    # the hotel catalogue indexed by coordinates, built on first use
+    def hotel_search(self):
+        if self._hotel_search is None:
+            import hotel_search
+
+            self._hotel_search = hotel_search.from_bundle(self.bundle)
+        return self._hotel_search
+
+    # the JR graph answering route_transit queries offline, built on first use
+    def rail_graph(self):
+        if self._rail_graph is None:
+            import rail_graph
+
+            self._rail_graph = rail_graph.RailGraph(node_ids=self.station_resolver.node_id_table())
+        return self._rail_graph
+
+    # a stop ranker over this planner's station scores
+    def stop_ranker(self, **kwargs):
+        import stop_ranking
+
+        return stop_ranking.StopRanker(self.get_station_score, **kwargs)
 
 
 def test():
@@ -161,7 +470,6 @@ def test():
     planner = TripPlanner()
     suggests = planner.plan_trip(start, goal, start_time)
   
-    hotel_df = pd.read_csv("../data/hotels/KNT_hotels.csv")
     # prints suggested stops
     for i, suggest in enumerate(suggests):
         print("{}泊目".format(i + 1))
@@ -170,11 +478,7 @@ def test():
         for hotelcode in suggest[1]:
             if hotelcode == "none":
                 continue
-            print(
-                "  {}".format(
-                    hotel_df[hotel_df["hotelcode"] == hotelcode]["name"].values[0]
-                )
-            )
+            print("  {}".format(planner.bundle.hotel_name(hotelcode)))
            
         print("*************************************")
 